@@ -18,6 +18,8 @@
 #
 # (4) Custom brain and brainstem atlases for the purpose of this study.
 # Save them in config["path_atlases"].
+# If config["packed_atlas"], all the ROIs are also saved as a single bit-packed label volume (atlas_packed.nii.gz)
+# with its label table (atlas_packed.json).
 #
 # Created: 2017-04-01
 # Modified: 2018-10-20
@@ -27,9 +29,13 @@ import os
 import pandas as pd
 import datetime
 import pickle
-import numpy as np
+import multiprocessing
 from spinalcordtoolbox.image import Image, zeros_like
 
+from common.nifti_stream import is_binary
+from common.fingerprint import load_manifest, save_manifest, cached_check, code_version
+from packed_atlas import pack_atlas, PACKED_ATLAS_FNAME
+
 from config_file import config
 
 DATE_TIME_STG = datetime.datetime.now().strftime("%Y%m%d%H%M")
@@ -54,6 +60,7 @@ BRAIN_DCT = {'M1_R': 'Right-M1-S-MATT.nii',
             'SMA_L': 'Left-SMA-S-MATT.nii'}
 
 def custom_brainstem(ifolder, ofolder, thr):
+    '''Save the thresholded right, left and merged CST in ofolder, return the binary masks as a list of (roi_name, data).'''
     cst_r_ifile = os.path.join(ifolder, BRAINSTEM_DCT['CST_R'])
     cst_l_ifile = os.path.join(ifolder, BRAINSTEM_DCT['CST_L'])
 
@@ -81,102 +88,160 @@ def custom_brainstem(ifolder, ofolder, thr):
     cst_r_im.save(cst_r_ofile)
     cst_l_im.save(cst_l_ofile)
     cst_im.save(cst_ofile)
+    mask_lst = [('brainstem_CST_R', cst_r_im.data > 0.0), ('brainstem_CST_L', cst_l_im.data > 0.0)]
     del cst_r_im, cst_l_im, cst_im
+    return mask_lst
 
 
 def custom_brain(ifolder, ofolder):
+    '''Save each S-MATT ROI and their union in ofolder, return the binary masks as a list of (roi_name, data).'''
     ifname_dct = {}
     for roi in BRAIN_DCT:
         ifname_dct[roi] = os.path.join(ifolder, BRAIN_DCT[roi])
 
-    for roi in ifname_dct:
+    mask_lst = []
+    sum_roi_data = None
+    for roi in sorted(ifname_dct):
         ofname = os.path.join(ofolder, 'brain_' + roi + '.nii.gz')
 
         i_im = Image(ifname_dct[roi])
         o_im = zeros_like(i_im)
+        if sum_roi_data is None:
+            union_im = zeros_like(i_im)
         o_im.data = i_im.data
         del i_im
 
+        # each ROI file is read once: the union is accumulated here
+        sum_roi_data = o_im.data.copy() if sum_roi_data is None else sum_roi_data + o_im.data
+
         o_im.data[:, :, :BRAMSTEM_ZTOP+1] = 0.0
 
         o_im.save(ofname)
+        mask_lst.append(('brain_' + roi, o_im.data > 0.0))
         del o_im
 
-    sum_roi_im = sum([Image(ifname_dct[roi]).data for roi in ifname_dct])
-    i_im = Image(ifname_dct[roi])
-    o_im = zeros_like(i_im)
-    del i_im
+    union_im.data[sum_roi_data > 0.0] = 1.0
+    union_im.data[:, :, :BRAMSTEM_ZTOP+1] = 0.0
 
-    o_im.data[sum_roi_im > 0.0] = 1.0
-    o_im.data[:, :, :BRAMSTEM_ZTOP+1] = 0.0
+    union_im.save(os.path.join(ofolder, 'brain.nii.gz'))
+    del union_im
+    return mask_lst
 
-    o_im.save(os.path.join(ofolder, 'brain.nii.gz'))
-    del o_im
 
 def _check_lesion_seg(fname):
     '''Check if the mask is only made of ones.'''
-    i = Image(fname)
-    check_bool = True
-    if not all([True if v in [0, 1] else False for v in np.unique(i.data)]):
-        check_bool = False
-    del i
+    return is_binary(fname)
+
+
+CHECK_CODE_FNAME_LST = ['0_check_data.py', '../common/nifti_stream.py']  # source files of the checks, see _init_worker
+
+_MANIFEST = {}  # manifest and version of the checks, shared by the workers (see _init_worker)
+_CHECK_VERSION = None
+
+
+def _init_worker(manifest, check_version):
+    '''Share the manifest with a worker once, instead of sending it with each subject.'''
+    global _MANIFEST, _CHECK_VERSION
+    _MANIFEST, _CHECK_VERSION = manifest, check_version
+
+
+def _cached_check(fname, check_fct, entry_dct):
+    '''Run check_fct on fname, unless its verdict is already in the manifest for the same file content and checks.'''
+    check_bool, entry_dct[os.path.abspath(fname)] = cached_check(fname, check_fct, _MANIFEST, version=_CHECK_VERSION)
     return check_bool
 
 
-def check_data(path_data, center_dct, subj_data_df):
+STG_LST = ['missing_subject', 'missing_img', 'missing_contrast', 'missing_lesion', 'incorrect_lesion']
+
+
+def _check_subject(s_folder, center, center_dct):
     '''
-    Goal: Identify subjects of interest and check if required files are available and correct.
+    Check the files of one subject.
 
-    Save lists of missing or incrorrect files/folders as pickle files.
+    Return a dict with the missing or incorrect files (see STG_LST), and the manifest entries of the checked files.
     '''
-    missing_subject, missing_img, missing_contrast = [], [], []
-    missing_lesion, incorrect_lesion = [], []
-    excluded_subject = []
-    for s, center, idx_s in zip(subj_data_df.subject.values, subj_data_df.center.values, subj_data_df.index.values):
-        s_folder = os.path.join(path_data, s)
-        if os.path.isdir(s_folder) and center in center_dct:
-            sc_folder = os.path.join(s_folder, 'brain')
-            for c in center_dct[center]:
-                c_folder = os.path.join(sc_folder, center_dct[center][c])
-                if center == 'karo' and c == 'anat':
-                    if not os.path.isfile(os.path.join(c_folder, center_dct[center][c] + '.nii.gz')):
-                        c_folder = os.path.join(sc_folder, 't2')
-                        cont = 't2'
-                    else:
-                        cont = center_dct[center][c]
+    res_dct = dict((stg, []) for stg in STG_LST)
+    entry_dct = {}
+    if os.path.isdir(s_folder) and center in center_dct:
+        sc_folder = os.path.join(s_folder, 'brain')
+        for c in center_dct[center]:
+            c_folder = os.path.join(sc_folder, center_dct[center][c])
+            if center == 'karo' and c == 'anat':
+                if not os.path.isfile(os.path.join(c_folder, center_dct[center][c] + '.nii.gz')):
+                    c_folder = os.path.join(sc_folder, 't2')
+                    cont = 't2'
                 else:
                     cont = center_dct[center][c]
-                if os.path.isdir(c_folder):
-                    c_img = os.path.join(c_folder, cont + '.nii.gz')
-                    c_lesion = os.path.join(c_folder, cont + '_lesion_manual.nii.gz')
-                    
-                    if not os.path.isfile(c_img):
-                        missing_img.append(os.path.abspath(c_img))
-                        excluded_subject.append(idx_s)
-
-                    if c == 'anat':
-                        if os.path.isfile(c_lesion):
-                            if not _check_lesion_seg(c_lesion):
-                                incorrect_lesion.append(os.path.abspath(c_lesion))
-                                excluded_subject.append(idx_s)
-                        else:
-                            missing_lesion.append(os.path.abspath(c_lesion))
-                            excluded_subject.append(idx_s)
-
-                    
-                else:
-                    missing_contrast.append(c_folder)
-                    excluded_subject.append(idx_s)
+            else:
+                cont = center_dct[center][c]
+            if os.path.isdir(c_folder):
+                c_img = os.path.join(c_folder, cont + '.nii.gz')
+                c_lesion = os.path.join(c_folder, cont + '_lesion_manual.nii.gz')
+
+                if not os.path.isfile(c_img):
+                    res_dct['missing_img'].append(os.path.abspath(c_img))
+
+                if c == 'anat':
+                    if os.path.isfile(c_lesion):
+                        if not _cached_check(c_lesion, _check_lesion_seg, entry_dct):
+                            res_dct['incorrect_lesion'].append(os.path.abspath(c_lesion))
+                    else:
+                        res_dct['missing_lesion'].append(os.path.abspath(c_lesion))
+
+            else:
+                res_dct['missing_contrast'].append(c_folder)
+
+    else:
+        res_dct['missing_subject'].append(s_folder)
+
+    return res_dct, entry_dct
+
+
+def _check_subject_star(args):
+    return _check_subject(*args)
+
+
+def check_data(path_data, center_dct, subj_data_df, n_jobs=1, fname_manifest=None):
+    '''
+    Goal: Identify subjects of interest and check if required files are available and correct.
 
-        else:
-            missing_subject.append(s_folder)
+    Subjects are checked in parallel if n_jobs > 1, results are merged in the csv order
+    so that the output is identical to the serial run.
+    If fname_manifest is provided, the verdicts of the files which did not change since the
+    previous run are read from this manifest instead of being re-computed.
+
+    Save lists of missing or incrorrect files/folders as pickle files.
+    '''
+    manifest = load_manifest(fname_manifest) if fname_manifest is not None else {}
+    path_code = os.path.dirname(os.path.abspath(__file__))
+    check_version = code_version([os.path.join(path_code, f) for f in CHECK_CODE_FNAME_LST])
+    args_lst = [(os.path.join(path_data, s), center, center_dct) for s, center in zip(subj_data_df.subject.values, subj_data_df.center.values)]
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(manifest, check_version))
+        try:
+            res_lst = pool.map(_check_subject_star, args_lst, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(manifest, check_version)
+        res_lst = [_check_subject(*args) for args in args_lst]
+
+    lst_dct = dict((stg, []) for stg in STG_LST)
+    excluded_subject = []
+    for idx_s, (res_dct, entry_dct) in zip(subj_data_df.index.values, res_lst):
+        manifest.update(entry_dct)
+        for stg in STG_LST:
+            lst_dct[stg] += res_dct[stg]
+        if any([len(res_dct[stg]) for stg in STG_LST]):
             excluded_subject.append(idx_s)
 
-    stg_lst = ['missing_subject', 'missing_img', 'missing_contrast', 'missing_lesion', 'incorrect_lesion']
-    lst_lst = [missing_subject, missing_img, missing_contrast, missing_lesion, incorrect_lesion]
-    for stg, lst in zip(stg_lst, lst_lst):
-        if len(lst):
-            dct = {stg: lst}
+    if fname_manifest is not None:
+        save_manifest(manifest, fname_manifest)
+
+    for stg in STG_LST:
+        if len(lst_dct[stg]):
+            dct = {stg: lst_dct[stg]}
             with open(DATE_TIME_STG + '_' + stg + '.pkl', 'wb') as f:
                 pickle.dump(dct, f)
 
@@ -192,7 +257,9 @@ def main(args=None):
 
     subj_check_df = check_data(path_data=path_data,
                                 center_dct=center_dct,
-                                subj_data_df=subj_data_df)
+                                subj_data_df=subj_data_df,
+                                n_jobs=config["n_jobs"],
+                                fname_manifest='0_manifest.pkl')
 
     subj_check_df.to_pickle('0_results.pkl')
 
@@ -200,17 +267,29 @@ def main(args=None):
     if not os.path.isdir(ofolder):
         os.makedirs(ofolder)
 
+    # packed atlas: all the ROIs in a single label volume, built from the same read of the atlas files
+    packed_atlas_path = os.path.join(ofolder, PACKED_ATLAS_FNAME)
+    build_packed = config["packed_atlas"] and not os.path.isfile(packed_atlas_path)
+    mask_lst = []
+
     brainstem_atlas_ifolder = config["path_brainstem_folder"]
     brainstem_atlas_ofolder = os.path.join(ofolder, 'brainstem')
-    if not os.path.isdir(brainstem_atlas_ofolder):
-        os.makedirs(brainstem_atlas_ofolder)
-        custom_brainstem(brainstem_atlas_ifolder, brainstem_atlas_ofolder, 0.01)
+    if not os.path.isdir(brainstem_atlas_ofolder) or build_packed:
+        if not os.path.isdir(brainstem_atlas_ofolder):
+            os.makedirs(brainstem_atlas_ofolder)
+        mask_lst += custom_brainstem(brainstem_atlas_ifolder, brainstem_atlas_ofolder, 0.01)
 
     brain_atlas_ifolder = config["path_smatt_folder"]
     brain_atlas_ofolder = os.path.join(ofolder, 'brain')
-    if not os.path.isdir(brain_atlas_ofolder):
-        os.makedirs(brain_atlas_ofolder)
-        custom_brain(brain_atlas_ifolder, brain_atlas_ofolder)
+    if not os.path.isdir(brain_atlas_ofolder) or build_packed:
+        if not os.path.isdir(brain_atlas_ofolder):
+            os.makedirs(brain_atlas_ofolder)
+        mask_lst += custom_brain(brain_atlas_ifolder, brain_atlas_ofolder)
+
+    if build_packed:
+        union_dct = {'brainstem_CST': [roi for roi, _ in mask_lst if roi.startswith('brainstem_CST_')],
+                    'brain': [roi for roi, _ in mask_lst if roi.startswith('brain_')]}
+        pack_atlas(mask_lst, union_dct, os.path.join(brainstem_atlas_ofolder, 'brainstem_CST.nii.gz'), packed_atlas_path)
 
 
 if __name__ == "__main__":
@@ -6,17 +6,219 @@
 # (1) Brain extraction of both T1 and flair imahes
 # (2) Register flair image to T1 image
 # (3) Register T1 image to MNI_1mm space
-# (4) Warp brain and brainstem atlases to the flair space.
+# (4) Warp brain and brainstem atlases to the flair space (not needed if config["quantification_space"] is 'mni').
+#
+# The steps of each subject are run as a dependency graph (see registration_steps): independent steps
+# (e.g. T1 and flair brain extractions) run in parallel (config["n_parallel_steps"] at a time),
+# and steps whose outputs are newer than their inputs are skipped.
+# Subjects are registered concurrently (config["n_jobs"] at a time), each job being limited to
+# config["n_threads_per_job"] threads, shared by its steps running at the same time.
+# The exit code and log of each subject are collected.
 #
 # Created: 2018-10-01
 # Modified: 2018-10-23
 # Contributors: Charley Gros
 
 import os
+import glob
+import json
+import numpy as np
 import pandas as pd
 
+from spinalcordtoolbox.image import Image, zeros_like
+
+from job_queue import run_dag, run_jobs, n_threads_per_job, fsl_standard
+from packed_atlas import split_packed_atlas, copy_label_table, fname_label_table, PACKED_ATLAS_FNAME
+
 from config_file import config
 
+FNAME_LOG = '1_register_data.log'  # saved in the brain folder of each subject
+
+ANIMA_THREADED_LST = ['animaPyramidalBMRegistration', 'animaDenseSVFBMRegistration', 'animaApplyTransformSerie']
+
+ATLAS_STACK_FNAME = 'atlas_stack.nii.gz'
+
+
+def atlas_fname_lst(path_atlases):
+    return sorted(glob.glob(os.path.join(path_atlases, 'brain', '*.nii.gz'))) + sorted(glob.glob(os.path.join(path_atlases, 'brainstem', '*.nii.gz')))
+
+
+def stack_atlases(fname_lst, fname_out):
+    '''Save the 3D atlases of fname_lst as a single 4D volume, and the list of their names in a json file.'''
+    o_im = zeros_like(Image(fname_lst[0]))
+    o_im.data = np.stack([Image(fname).data for fname in fname_lst], axis=3)
+    o_im.change_type(type='float32')
+    o_im.save(fname_out)
+    del o_im
+
+    with open(fname_out.split('.nii')[0] + '.json', 'w') as f:
+        json.dump([os.path.basename(fname) for fname in fname_lst], f, indent=4)
+
+
+def split_atlas_stack(fname_stack, fname_names, fname_ref, ofolder):
+    '''Save each volume of the 4D fname_stack as ofolder/<name>, names being listed in fname_names.'''
+    with open(fname_names, 'r') as f:
+        name_lst = json.load(f)
+
+    stack_im, ref_im = Image(fname_stack), Image(fname_ref)
+    stack_data = stack_im.data
+    del stack_im
+    for i_vol, name in enumerate(name_lst):
+        o_im = zeros_like(ref_im)
+        o_im.data = stack_data[:, :, :, i_vol]
+        o_im.change_type(type='float32')
+        o_im.save(os.path.join(ofolder, name))
+        del o_im
+    del ref_im
+
+
+def split_packed_atlas_reg(fname_atlas, fname_atlas_reg, ofolder):
+    copy_label_table(fname_atlas, fname_atlas_reg)
+    split_packed_atlas(fname_atlas_reg, ofolder)
+
+
+def remove_packed_atlas_reg(label_fold, path_atlases):
+    '''
+    Remove the atlases warped to label_fold by a previous run in 'packed' mode (nearest neighbour, binary ROIs), which
+    would otherwise be taken as up to date by the 'separate' and 'stack' modes (linear interpolation).
+    '''
+    packed_reg = os.path.join(label_fold, PACKED_ATLAS_FNAME)
+    if not os.path.isfile(packed_reg):
+        return
+    atlas_reg_lst = [os.path.join(label_fold, os.path.basename(f)) for f in atlas_fname_lst(path_atlases)]
+    for fname in [packed_reg, fname_label_table(packed_reg)] + atlas_reg_lst:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+def _step(name, cmd, inputs, outputs):
+    return {'name': name, 'cmd': cmd, 'inputs': inputs, 'outputs': outputs}
+
+
+def registration_steps(path_atlases, path_script_brain_extraction, anat_name, atlas_warp_mode='separate'):
+    '''
+    Registration steps of one subject, paths are relative to the brain folder of the subject.
+
+    Brain extraction, linear registration of anat to T1, registration of T1 to MNI (rigid, affine, non-linear),
+    warping of the atlases to the anat space, and warping of the lesion and brain masks to the MNI space.
+
+    atlas_warp_mode: 'separate' (one transformation call per atlas), 'stack' (the atlases stacked in a 4D volume
+    are warped in a single call) or 'packed' (the packed atlas is warped in a single call, nearest neighbour).
+    In the last two modes, the warped volume is split back into one file per atlas. If None, the atlases are not warped.
+        '''
+    a = anat_name
+    mni = fsl_standard('MNI152_T1_1mm_brain.nii.gz')
+    anat2mni_xml, mni2anat_xml = a+'/'+a+'2mni.xml', a+'/mni2'+a+'.xml'
+    step_lst = []
+
+    # Brain extraction of T1 and anat images
+    for c in ['t1', a]:
+        step_lst.append(_step('brain_extraction_'+c,
+                            ['python', os.path.join(path_script_brain_extraction, 'animaAtlasBasedBrainExtraction.py'), '-i', c+'/'+c+'.nii.gz'],
+                            [c+'/'+c+'.nii.gz'],
+                            [c+'/'+c+'_masked.nrrd', c+'/'+c+'_brainMask.nrrd']))
+        step_lst.append(_step('convert_brain_'+c,
+                            ['animaConvertImage', '-i', c+'/'+c+'_masked.nrrd', '-o', c+'/'+c+'_brain.nii.gz'],
+                            [c+'/'+c+'_masked.nrrd'],
+                            [c+'/'+c+'_brain.nii.gz']))
+
+    # Intra subject linear registration: anat --> T1
+    step_lst.append(_step('register_'+a+'2t1',
+                        ['animaPyramidalBMRegistration', '-r', 't1/t1_brain.nii.gz', '-m', a+'/'+a+'_brain.nii.gz', '-o', a+'/'+a+'_t1.nii.gz', '-O', a+'/'+a+'2t1.txt'],
+                        ['t1/t1_brain.nii.gz', a+'/'+a+'_brain.nii.gz'],
+                        [a+'/'+a+'_t1.nii.gz', a+'/'+a+'2t1.txt']))
+
+    # Rigid, affine and non-linear registrations of T1 to the MNI152_T1_1mm
+    step_lst.append(_step('register_t12mni_rig',
+                        ['animaPyramidalBMRegistration', '-r', mni, '-m', 't1/t1_brain.nii.gz', '-o', 't1/t1_mni_rig.nii.gz', '-O', 't1/t12mni_rig.txt'],
+                        [mni, 't1/t1_brain.nii.gz'],
+                        ['t1/t1_mni_rig.nii.gz', 't1/t12mni_rig.txt']))
+    step_lst.append(_step('register_t12mni_aff',
+                        ['animaPyramidalBMRegistration', '-r', mni, '-m', 't1/t1_mni_rig.nii.gz', '--ot', '2', '-o', 't1/t1_mni_aff.nii.gz', '-O', 't1/t12mni_aff.txt'],
+                        [mni, 't1/t1_mni_rig.nii.gz'],
+                        ['t1/t1_mni_aff.nii.gz', 't1/t12mni_aff.txt']))
+    step_lst.append(_step('register_t12mni_nonlin',
+                        ['animaDenseSVFBMRegistration', '-r', mni, '-m', 't1/t1_mni_aff.nii.gz', '-o', 't1/t1_mni_nonlin.nii.gz', '-O', 't1/t12mni_nonlin.nii.gz'],
+                        [mni, 't1/t1_mni_aff.nii.gz'],
+                        ['t1/t1_mni_nonlin.nii.gz', 't1/t12mni_nonlin.nii.gz']))
+
+    # Concatenate the transformations from the anat space to the MNI space, and the inverse
+    trf_lst = [a+'/'+a+'2t1.txt', 't1/t12mni_rig.txt', 't1/t12mni_aff.txt', 't1/t12mni_nonlin.nii.gz']
+    step_lst.append(_step('transform_'+a+'2mni',
+                        ['animaTransformSerieXmlGenerator'] + [arg for trf in trf_lst for arg in ['-i', trf]] + ['-o', anat2mni_xml],
+                        trf_lst,
+                        [anat2mni_xml]))
+    step_lst.append(_step('transform_mni2'+a,
+                        ['animaTransformSerieXmlGenerator'] + [arg for trf in trf_lst[::-1] for arg in ['-i', trf]] + ['-I', '1', '-I', '2', '-I', '3', '-I', '4', '-o', mni2anat_xml],
+                        trf_lst,
+                        [mni2anat_xml]))
+
+    # Apply the transformations
+    step_lst.append(_step('warp_'+a+'2mni',
+                        ['animaApplyTransformSerie', '-i', a+'/'+a+'_brain.nii.gz', '-g', mni, '-t', anat2mni_xml, '-o', a+'/'+a+'_mni.nii.gz'],
+                        [a+'/'+a+'_brain.nii.gz', mni, anat2mni_xml] + trf_lst,
+                        [a+'/'+a+'_mni.nii.gz']))
+
+    # Warp atlases to anat space
+    atlas_lst = atlas_fname_lst(path_atlases)
+    atlas_reg_lst = [a+'/label/'+os.path.basename(atlas_path) for atlas_path in atlas_lst]
+    if atlas_warp_mode is None:  # quantification in the MNI space: no atlas needed in the anat space
+        pass
+    elif atlas_warp_mode == 'separate':  # one transformation call per atlas
+        for atlas_path, atlas_reg in zip(atlas_lst, atlas_reg_lst):
+            step_lst.append(_step('warp_atlas_'+os.path.basename(atlas_path).split('.nii.gz')[0],
+                                ['animaApplyTransformSerie', '-g', a+'/'+a+'_brain.nii.gz', '-i', atlas_path, '-t', mni2anat_xml, '-n', 'linear', '-o', atlas_reg],
+                                [a+'/'+a+'_brain.nii.gz', atlas_path, mni2anat_xml] + trf_lst,
+                                [atlas_reg]))
+    else:  # single transformation call, then split into one file per atlas
+        if atlas_warp_mode == 'stack':
+            atlas_src, interp = os.path.join(path_atlases, ATLAS_STACK_FNAME), 'linear'
+        elif atlas_warp_mode == 'packed':
+            atlas_src, interp = os.path.join(path_atlases, PACKED_ATLAS_FNAME), 'nearest'
+        else:
+            raise ValueError('Unknown atlas warping mode: ' + atlas_warp_mode)
+        atlas_src_reg = a+'/label/'+os.path.basename(atlas_src)
+        step_lst.append(_step('warp_atlas_'+atlas_warp_mode,
+                            ['animaApplyTransformSerie', '-g', a+'/'+a+'_brain.nii.gz', '-i', atlas_src, '-t', mni2anat_xml, '-n', interp, '-o', atlas_src_reg],
+                            [a+'/'+a+'_brain.nii.gz', atlas_src, mni2anat_xml] + trf_lst,
+                            [atlas_src_reg]))
+        if atlas_warp_mode == 'stack':
+            split_fct, split_args = split_atlas_stack, [atlas_src_reg, atlas_src.split('.nii')[0]+'.json', a+'/'+a+'_brain.nii.gz', a+'/label']
+        else:
+            split_fct, split_args = split_packed_atlas_reg, [atlas_src, atlas_src_reg, a+'/label']
+        split_step = _step('split_atlas_'+atlas_warp_mode, None, [atlas_src_reg], atlas_reg_lst)
+        split_step.update({'fct': split_fct, 'args': split_args})
+        step_lst.append(split_step)
+
+    # Warp the lesion and brain masks from anat to MNI space
+    step_lst.append(_step('convert_brainMask_'+a,
+                        ['animaConvertImage', '-i', a+'/'+a+'_brainMask.nrrd', '-o', a+'/'+a+'_brainMask.nii.gz'],
+                        [a+'/'+a+'_brainMask.nrrd'],
+                        [a+'/'+a+'_brainMask.nii.gz']))
+    for mask in ['lesion_manual', 'brainMask']:
+        step_lst.append(_step('warp_'+mask+'2mni',
+                            ['animaApplyTransformSerie', '-i', a+'/'+a+'_'+mask+'.nii.gz', '-g', mni, '-t', anat2mni_xml, '-n', 'linear', '-o', a+'/'+a+'_'+mask+'_mni.nii.gz'],
+                            [a+'/'+a+'_'+mask+'.nii.gz', mni, anat2mni_xml] + trf_lst,
+                            [a+'/'+a+'_'+mask+'_mni.nii.gz']))
+
+    return step_lst
+
+
+def register_subject(subj_fold, path_atlases, path_script_brain_extraction, anat_name, atlas_warp_mode, n_steps, n_threads):
+    '''Run the registration steps of one subject, return 0 if all succeeded. The output is logged in subj_fold.'''
+    if atlas_warp_mode in ['separate', 'stack']:
+        remove_packed_atlas_reg(os.path.join(subj_fold, anat_name, 'label'), path_atlases)
+    step_lst = registration_steps(path_atlases, path_script_brain_extraction, anat_name, atlas_warp_mode)
+    for step in step_lst:
+        if 'fct' in step:  # paths of in-process steps are relative to subj_fold
+            step['args'] = [os.path.join(subj_fold, arg) for arg in step['args']]
+        elif step['cmd'][0] in ANIMA_THREADED_LST:
+            step['threads_flag'] = '-T'
+
+    exit_code_dct = run_dag(step_lst, subj_fold, os.path.join(subj_fold, FNAME_LOG), n_workers=n_steps, n_threads=n_threads)
+    failed_lst = [step['name'] for step in step_lst if exit_code_dct[step['name']] != 0]
+    return (exit_code_dct[failed_lst[0]] or 1) if len(failed_lst) else 0
+
 
 def main(args=None):
 
@@ -26,29 +228,37 @@ def main(args=None):
     center_dct = config["dct_center"]
     path_atlases = config["path_atlases"]
     path_script_brain_extraction = config["path_anima_brain_extraction"]
-    current_dir = os.getcwd()
+    n_jobs, n_steps = config["n_jobs"], config["n_parallel_steps"]
+    n_threads = n_threads_per_job(n_jobs, config["n_threads_per_job"])  # shared by the steps running at the same time
+    atlas_warp_mode = config["atlas_warp_mode"] if config["quantification_space"] == 'native' else None
 
-    # loop and run 1_register_data.sh
-    reg_subj_lst = []
+    # the 4D stack of atlases is built once, and shared by all the subjects
+    atlas_stack_path = os.path.join(path_atlases, ATLAS_STACK_FNAME)
+    if atlas_warp_mode == 'stack':
+        atlas_lst = atlas_fname_lst(path_atlases)
+        if not os.path.isfile(atlas_stack_path) or os.path.getmtime(atlas_stack_path) < max([os.path.getmtime(f) for f in atlas_lst]):
+            stack_atlases(atlas_lst, atlas_stack_path)
+
+    # steps already done are skipped by run_dag, so that every subject can be scheduled
+    job_lst = []
     for index, row in subj_data_df.iterrows():
         anat_name = center_dct[row.center]['anat']
         if not os.path.isfile(os.path.join(path_data, row.subject, 'brain', anat_name, anat_name+'.nii.gz')):
             anat_name = 't2'
 
         subj_fold = os.path.join(path_data, row.subject, 'brain')
-        flair_mni = os.path.join(subj_fold, anat_name, anat_name + '_mni.nii.gz')
-        flair_lesion_mni = os.path.join(subj_fold, anat_name, anat_name + '_lesion_manual_mni.nii.gz')
-        flair_brain_mni = os.path.join(subj_fold, anat_name, anat_name + '_brainMask_mni.nii.gz')
-        label_folder = os.path.join(subj_fold, anat_name, 'label')
-        brain_atlas_reg_path = os.path.join(subj_fold, anat_name, 'label', 'brain.nii.gz')
-        if not os.path.isfile(flair_mni) or not os.path.isdir(label_folder) or not os.path.isfile(flair_lesion_mni) or not os.path.isfile(flair_brain_mni):
-            print flair_mni
-            os.system('./1_register_data.sh ' + subj_fold + ' ' + path_atlases + ' ' + path_script_brain_extraction + ' ' + anat_name)
-            os.chdir(current_dir)
-        if os.path.isfile(brain_atlas_reg_path):
-            reg_subj_lst.append(row.subject)
-
-    subj_data_df = subj_data_df[subj_data_df.subject.isin(reg_subj_lst)]
+        job_lst.append((row.subject, register_subject, (subj_fold, path_atlases, path_script_brain_extraction, anat_name, atlas_warp_mode, n_steps, n_threads)))
+
+    # n_jobs subjects at a time, n_steps steps at a time per subject
+    print('Registration of '+str(len(job_lst))+' subjects ('+str(n_jobs)+' jobs, '+str(n_steps)+' steps per job, '+str(n_threads)+' threads per job).')
+    exit_code_dct = run_jobs(job_lst, n_jobs)
+
+    failed_subj_lst = sorted([s for s in exit_code_dct if exit_code_dct[s] != 0])
+    if len(failed_subj_lst):
+        print('\n\nRegistration failed for the following subjects, please check '+FNAME_LOG+' in their brain folder:')
+        print('\n'.join(['\t- '+s+' (exit code: '+str(exit_code_dct[s])+')' for s in failed_subj_lst]))
+
+    subj_data_df = subj_data_df[subj_data_df.subject.map(lambda s: exit_code_dct[s] == 0)]
     subj_data_df.to_pickle('1_results.pkl')
 
 if __name__ == "__main__":
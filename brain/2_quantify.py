@@ -21,153 +21,537 @@
 # - brain_S1_R, brain_S1_L:
 # - brain_SMA_R, brain_SMA_L:
 #
+# If config["quantification_space"] is 'mni', the measures are computed in the MNI space, on the lesion and brain masks
+# warped to the MNI space and the atlases in the MNI space (no atlas warped to the native space is needed).
+# Volumes are corrected to native mm3 with a jacobian map computed once per subject from the transformation serie.
+#
 # Created: 2018-10-15
 # Modified: 2019-06-10
 # Contributors: Charley Gros
 
 import os
+import multiprocessing
 import numpy as np
 import pandas as pd
 from skimage.measure import label
+from scipy.ndimage import binary_erosion
+
+from spinalcordtoolbox.image import Image, zeros_like
 
-from spinalcordtoolbox.image import Image
+from common.nifti_stream import count_values, read_header, voxel_volume
+from nrrd_io import read_nrrd, reorient, voxel_volume_affine
+from job_queue import run_command, run_jobs, n_threads_per_job, fsl_standard
+from packed_atlas import load_packed_atlas, PACKED_ATLAS_FNAME
+from common.fingerprint import load_manifest, save_manifest, fingerprint, code_version, is_up_to_date
+from common.records import join_records
+from common.lesion_table import label_lesions, save_label_image, lesion_rows, save_lesion_table, COLUMN_LST
 
 from config_file import config
 
+ROI_LST = ['brain_full', 'brainstem_full', 'brainstem_CST-R', 'brainstem_CST-L',
+            'brain_M1-R', 'brain_M1-L', 'brain_PMd-R', 'brain_PMd-L',
+            'brain_PMv-R', 'brain_PMv-L', 'brain_preSMA-R', 'brain_preSMA-L',
+            'brain_S1-R', 'brain_S1-L', 'brain_SMA-R', 'brain_SMA-L']
+ATLAS_PREF_LST = ['', '', 'brainstem_CST_R', 'brainstem_CST_L',
+                'brain_M1_R', 'brain_M1_L', 'brain_PMd_R', 'brain_PMd_L',
+                'brain_PMv_R', 'brain_PMv_L', 'brain_preSMA_R', 'brain_preSMA_L',
+                'brain_S1_R', 'brain_S1_L', 'brain_SMA_R', 'brain_SMA_L']
 
-def z_brainstem(image_fold):
-    brainstem_path = os.path.join(image_fold, 'label', 'brainstem_CST.nii.gz')
+_ATLAS_MNI_DCT = None  # atlases in the MNI space, see get_mni_atlases
 
-    brainstem_im = Image(brainstem_path)
-    brainstem_im.change_orientation('RPI')
-    z_brainstem_lst = list(set(np.where(brainstem_im.data)[2]))
-    del brainstem_im
+FNAME_CACHE = '2_cache.pkl'  # results and input fingerprints of each subject, see main
+CODE_FNAME_LST = ['2_quantify.py', '../common/nifti_stream.py', 'nrrd_io.py', 'packed_atlas.py', '../common/lesion_table.py',
+                  '../common/records.py', 'job_queue.py']
 
-    return np.min(z_brainstem_lst), np.max(z_brainstem_lst)
+FNAME_LOG = '2_quantify.log'  # saved in the brain folder of each subject
+LESION_THR_MNI = 0.5  # threshold of the lesion mask warped to the MNI space (linear interpolation) to count the lesions
+JAC_SLAB = 16  # number of MNI slices (first axis) whose jacobian determinant is computed at once
+JAC_VALID_THR = 0.999  # warped validity channel above which an MNI voxel is fully inside the native field of view
 
 
-def convert_nrrd2niigz(fname_in):
-    if not os.path.isfile(fname_in):
-        brain_mask_nrrd = fname_in.split('.nii.gz')[0] + '.nrrd'
-        os.system('animaConvertImage -i '+brain_mask_nrrd+' -o '+fname_in)
+def existing_mask(fname_in):
+    '''fname_in (.nii.gz) if it exists, otherwise its .nrrd version written by Anima.'''
+    return fname_in if os.path.isfile(fname_in) else fname_in.split('.nii.gz')[0] + '.nrrd'
 
 
-def compute_tbv(fname_in):
-    convert_nrrd2niigz(fname_in)
+def load_mask_rpi(fname_in):
+    '''Data (RPI) of the mask fname_in, read from its .nrrd version if fname_in does not exist (no conversion).'''
+    fname_in = existing_mask(fname_in)
+    if fname_in.endswith('.nrrd'):
+        data, affine = read_nrrd(fname_in)
+        return reorient(data, affine, 'RPI')
+    mask_im = Image(fname_in).change_orientation('RPI')
+    mask_data = mask_im.data
+    del mask_im
+    return mask_data
 
-    img = Image(fname_in).change_orientation('RPI')
-    res_x, res_y, res_z = img.dim[4:7]
-    data = img.data
-    del img
 
-    data = (data > 0.0).astype(np.int_)
-    return np.sum(data) * res_x * res_y * res_z
+def compute_tbv(fname_in):
+    fname_in = existing_mask(fname_in)
+    if fname_in.endswith('.nrrd'):
+        data, affine = read_nrrd(fname_in)
+        return np.count_nonzero(data > 0.0) * voxel_volume_affine(affine)
+
+    count_dct = count_values(fname_in)
+    nb_brain = sum([count_dct[v] for v in count_dct if v > 0.0])
+    return nb_brain * voxel_volume(read_header(fname_in))
+
+
+def segment_t1(img_file, mask_file, out_file, fname_log, n_threads=None, timeout=None):
+    '''Run Atropos (GM, WM, CSF), return its exit code. The output of a failed or killed run is removed.'''
+    exit_code = run_command(['Atropos', '-d', '3', '-i', 'KMeans[3]', '-a', img_file, '-x', mask_file, '-o', out_file],
+                            fname_log, n_threads=n_threads, timeout=timeout)
+    if exit_code != 0 and os.path.isfile(out_file):
+        os.remove(out_file)
+    return exit_code
+
+
+def segment_missing_t1(subject_lst):
+    '''
+    Segment the struct images of the subjects of subject_lst (list of (subject, center)) which are not segmented yet,
+    through a queue of config["n_jobs"] parallel jobs. Return the list of the subjects whose segmentation failed.
+    '''
+    center_dct = config["dct_center"]
+    n_jobs = config["n_jobs"]
+    n_threads = n_threads_per_job(n_jobs, config["n_threads_per_job"])
 
+    job_lst = []
+    for subject, center in subject_lst:
+        t1_fold, _ = subject_folders(subject, center)
+        t1_pref = os.path.join(t1_fold, center_dct[center]["struct"])
+        # missing, or computed before a correction of the struct image or of its brain mask
+        if not is_up_to_date(t1_pref+'_seg.nii.gz', [t1_pref+'.nii.gz', existing_mask(t1_pref+'_brainMask.nii.gz')]):
+            fname_log = os.path.join(os.path.dirname(t1_fold), FNAME_LOG)
+            job_lst.append((subject, segment_t1,
+                            (t1_pref+'.nii.gz', existing_mask(t1_pref+'_brainMask.nii.gz'), t1_pref+'_seg.nii.gz',
+                                fname_log, n_threads, config["atropos_timeout"])))
+    print('Brain segmentations to run: '+str(len(job_lst)))
 
-def segment_t1(img_file, mask_file, out_file):
-    cmd = 'Atropos -d 3 -i KMeans[3]'
-    cmd += ' -a '+img_file
-    cmd += ' -x '+mask_file
-    cmd += ' -o '+out_file
-    os.system(cmd)
+    exit_code_dct = run_jobs(job_lst, n_jobs)
+    return sorted([subject for subject in exit_code_dct if exit_code_dct[subject] != 0])
 
 
 def compute_bpf(seg_file):
-    seg = Image(seg_file)
-    nb_csf = np.count_nonzero(seg.data == 1)  # CSF
-    nb_gm = np.count_nonzero(seg.data == 2)  # GM
-    nb_wm = np.count_nonzero(seg.data == 3)  # WM
+    count_dct = count_values(seg_file)
+    nb_csf = count_dct.get(1, 0)  # CSF
+    nb_gm = count_dct.get(2, 0)  # GM
+    nb_wm = count_dct.get(3, 0)  # WM
     brain_parenchymal_fraction = (nb_wm + nb_gm) * 1.0 / (nb_csf + nb_wm + nb_gm)  # BPF
     return brain_parenchymal_fraction
 
 
-def compute_lesion_characteristics(img_fold, atlas_name='', roi_name=''):
-    if atlas_name == '':
-        mask_path = os.path.join(img_fold, img_fold.split('/')[-1]+'_brainMask.nii.gz')
-        convert_nrrd2niigz(mask_path)
+def z_brainstem(atlas_dct):
+    '''z range of the brainstem (brainstem_CST atlas, RPI).'''
+    z_brainstem_lst = np.where(atlas_dct['brainstem_CST'])[2]
+    return np.min(z_brainstem_lst), np.max(z_brainstem_lst)
+
+
+def load_subject_volumes(img_fold, atlas_pref_lst):
+    '''
+    Load once (RPI) the lesion mask, the brain mask and the atlases of atlas_pref_lst warped to the anat space.
+
+    In the 'packed' atlas warping mode (see 1_register_data.py), all the atlases are read from the warped packed atlas,
+    otherwise from one file per atlas.
+    Return (lesion_data, brain_data, {atlas_pref: data}, voxel volume).
+    '''
+    img_name = img_fold.split('/')[-1]
+    lesion_im = Image(os.path.join(img_fold, img_name+'_lesion_manual.nii.gz')).change_orientation('RPI')
+    lesion_data = lesion_im.data
+    res_x, res_y, res_z = lesion_im.dim[4:7]
+    del lesion_im
+    brain_data = load_mask_rpi(os.path.join(img_fold, img_name+'_brainMask.nii.gz'))
+
+    atlas_pref_lst = [a for a in atlas_pref_lst if a != ''] + ['brainstem_CST']
+    if config["atlas_warp_mode"] == 'packed':
+        atlas_dct = load_packed_atlas(os.path.join(img_fold, 'label', PACKED_ATLAS_FNAME), roi_lst=atlas_pref_lst, orientation='RPI')
+    else:
+        atlas_dct = {}
+        for atlas_pref in atlas_pref_lst:
+            atlas_im = Image(os.path.join(img_fold, 'label', atlas_pref+'.nii.gz')).change_orientation('RPI')
+            atlas_dct[atlas_pref] = atlas_im.data
+            del atlas_im
+
+    return lesion_data, brain_data, atlas_dct, res_x * res_y * res_z
+
+
+def compute_lesion_characteristics(img_fold, roi_lst, atlas_pref_lst, volumes=None):
+    '''
+    Lesion count, lesion volume and ROI volume of each ROI, computed from a single load of the subject volumes.
+
+    ROIs with an empty atlas name are the brain mask, restricted to the brainstem (z range of brainstem_CST) for
+    the ROIs starting with 'brainstem', or from the bottom of the brainstem upwards otherwise.
+    The lesions are labelled within their bounding box only.
+    volumes: output of load_subject_volumes, if already loaded.
+    Return a dict {roi: (count, tlv, mask_vol)}.
+    '''
+    if volumes is None:
+        volumes = load_subject_volumes(img_fold, atlas_pref_lst)
+    lesion_full_data, brain_data, atlas_dct, vox_vol = volumes
+    z_min, z_max = z_brainstem(atlas_dct)
+
+    # bounding box of the lesions
+    lesion_idx_lst = np.nonzero(lesion_full_data)
+    if len(lesion_idx_lst[0]):
+        bbox = tuple([slice(np.min(idx), np.max(idx)+1) for idx in lesion_idx_lst])
     else:
-        mask_path = os.path.join(img_fold, 'label', atlas_name+'.nii.gz')
-    lesion_path = os.path.join(img_fold, img_fold.split('/')[-1]+'_lesion_manual.nii.gz')
+        bbox = tuple([slice(0, 0)] * 3)
+
+    res_dct = {}
+    for roi, atlas_pref in zip(roi_lst, atlas_pref_lst):
+        if atlas_pref == '':
+            z_top = z_max+1 if roi.startswith('brainstem') else brain_data.shape[2]
+            mask_data, lesion_data = brain_data[:, :, z_min:z_top], lesion_full_data[:, :, z_min:z_top]
+            z_bbox = slice(max(bbox[2].start, z_min) - z_min, max(min(bbox[2].stop, z_top), z_min) - z_min)
+        else:
+            mask_data, lesion_data = atlas_dct[atlas_pref], lesion_full_data
+            z_bbox = bbox[2]
+
+        lesion_data = lesion_data * mask_data[:lesion_data.shape[0],:,:]
+
+        lesion_bbox_data = lesion_data[bbox[0], bbox[1], z_bbox]
+        count = label((lesion_bbox_data > 0).astype(np.int), neighbors=8, return_num=True)[1] if lesion_bbox_data.size else 0
+        tlv = np.sum(lesion_data) * vox_vol
+        mask_vol = np.sum(mask_data) * vox_vol
+        res_dct[roi] = (count, tlv, mask_vol)
+
+    return res_dct
+
+
+def compute_lesion_rows(img_fold, subject, volumes, roi_lst, atlas_pref_lst, fname_mni):
+    '''
+    Rows of the lesion table (see lesion_table.py) of one subject, from the volumes loaded by load_subject_volumes.
+
+    The lesion labels are warped to the MNI space (nearest neighbour) to get the centroids in the MNI space.
+    '''
+    lesion_data, brain_data, atlas_dct, vox_vol = volumes
+    img_name = img_fold.split('/')[-1]
+    subj_fold = os.path.dirname(img_fold)
+    label_data, n_lesion = label_lesions(lesion_data)
+
+    label_path = os.path.join(img_fold, img_name+'_lesion_label.nii.gz')
+    label_mni_path = os.path.join(img_fold, img_name+'_lesion_label_mni.nii.gz')
+    fname_log = os.path.join(subj_fold, FNAME_LOG)
+    save_label_image(label_data, os.path.join(img_fold, img_name+'_lesion_manual.nii.gz'), label_path)
+    if os.path.isfile(label_mni_path):  # labels of a previous run
+        os.remove(label_mni_path)
+    exit_code = run_command(['animaApplyTransformSerie', '-i', label_path, '-g', fname_mni, '-t', os.path.join(img_fold, img_name+'2mni.xml'),
+                                '-n', 'nearest', '-o', label_mni_path],
+                            fname_log, cwd=subj_fold)
+    if exit_code != 0 or not os.path.isfile(label_mni_path):
+        raise RuntimeError('Warping of the lesion labels of ' + img_name + ' to the MNI space failed, see ' + fname_log)
+    label_mni_im = Image(label_mni_path).change_orientation('RPI')
+    label_mni_data = label_mni_im.data
+    del label_mni_im
+
+    z_min, z_max = z_brainstem(atlas_dct)
+    roi_dct = {}
+    for roi, atlas_pref in zip(roi_lst, atlas_pref_lst):
+        if atlas_pref == '':
+            z_top = z_max+1 if roi.startswith('brainstem') else brain_data.shape[2]
+            roi_dct[roi] = np.zeros(brain_data.shape)
+            roi_dct[roi][:, :, z_min:z_top] = brain_data[:, :, z_min:z_top]
+        else:
+            roi_dct[roi] = atlas_dct[atlas_pref]
+
+    return lesion_rows(label_data, n_lesion, roi_dct, vox_vol, subject, img_name, label_template_data=label_mni_data)
+
+
+def jacobian_determinant(coord_data):
+    '''
+    Absolute determinant of the gradient of the coordinate field coord_data (x, y, z, 4), in float32.
+
+    coord_data holds the 3 native coordinates and a validity channel (1 inside the native field of view, 0 outside,
+    in between at its edge after the linear interpolation). The determinant is 0 in the voxels which are not fully
+    inside the field of view or have such a neighbour: their central differences would mix coordinates with the 0
+    of the outside, and give huge determinants along the edge.
+    It is computed by slabs of JAC_SLAB slices along x (with one more slice on each side for the central differences),
+    instead of a 3x3 gradient matrix for the whole volume.
+    '''
+    nx = coord_data.shape[0]
+    det_data = np.zeros(coord_data.shape[:3], dtype=np.float32)
+    for i_start in range(0, nx, JAC_SLAB):
+        i_stop = min(nx, i_start + JAC_SLAB)
+        p_start, p_stop = max(0, i_start - 1), min(nx, i_stop + 1)
+        slab_data = np.asarray(coord_data[p_start:p_stop], dtype=np.float32)
+        # jac_mat[..., c, d]: derivative of the native coordinate c along the MNI axis d
+        jac_mat = np.stack([np.stack(np.gradient(slab_data[:, :, :, c]), axis=-1) for c in range(3)], axis=-2)
+        valid_data = binary_erosion(slab_data[:, :, :, 3] >= JAC_VALID_THR, border_value=1)
+        det_slab = np.abs(np.linalg.det(jac_mat)) * valid_data
+        det_data[i_start:i_stop] = det_slab[i_start - p_start:i_stop - p_start]
+    return det_data
+
+
+def mni_transform_lst(img_fold):
+    '''
+    Files of the transformation serie from the anat folder img_fold to the MNI space (see registration_steps in
+    1_register_data.py): the serie (.xml, which only lists the file names) and the transformations it refers to.
+    '''
+    img_name = img_fold.split('/')[-1]
+    t1_pref = os.path.join(os.path.dirname(img_fold), 't1', 't1')
+    return [os.path.join(img_fold, img_name+'2mni.xml'), os.path.join(img_fold, img_name+'2t1.txt'),
+            t1_pref+'2mni_rig.txt', t1_pref+'2mni_aff.txt', t1_pref+'2mni_nonlin.nii.gz']
+
+
+def compute_jacobian_mni(img_fold, fname_mni):
+    '''
+    Compute the map of the native volume [mm3] of each MNI voxel, return its path.
+
+    The voxel coordinates of the native image are warped to the MNI space with the existing transformation serie:
+    the absolute determinant of their gradient, times the native voxel volume, gives the native volume of each MNI voxel.
+    The MNI voxels outside the native field of view, or at its edge, get 0 (see jacobian_determinant).
+    The map is reused until one of the transformations is more recent (e.g. after a new registration of the subject).
+    '''
+    img_name = img_fold.split('/')[-1]
+    jac_path = os.path.join(img_fold, img_name+'_jacobian_mni.nii.gz')
+    if is_up_to_date(jac_path, [os.path.join(img_fold, img_name+'.nii.gz')] + mni_transform_lst(img_fold)):
+        return jac_path
+
+    coord_path = os.path.join(img_fold, img_name+'_coord.nii.gz')
+    coord_mni_path = os.path.join(img_fold, img_name+'_coord_mni.nii.gz')
+
+    img_im = Image(os.path.join(img_fold, img_name+'.nii.gz'))
+    res_x, res_y, res_z = img_im.dim[4:7]
+    coord_im = zeros_like(img_im)
+    del img_im
+    # native coordinates, and a validity channel to tell the coordinate 0 from the outside of the field of view
+    grid_lst = np.meshgrid(*[np.arange(n) for n in coord_im.data.shape[:3]], indexing='ij')
+    coord_im.data = np.stack(grid_lst + [np.ones(grid_lst[0].shape)], axis=3).astype(np.float32)
+    coord_im.change_type(type='float32')
+    coord_im.save(coord_path)
+    del coord_im
+
+    # the transformation serie refers to paths relative to the brain folder of the subject
+    subj_fold = os.path.dirname(img_fold)
+    fname_log = os.path.join(subj_fold, FNAME_LOG)
+    try:
+        if os.path.isfile(coord_mni_path):  # from an interrupted run
+            os.remove(coord_mni_path)
+        exit_code = run_command(['animaApplyTransformSerie', '-i', coord_path, '-g', fname_mni, '-t', os.path.join(img_fold, img_name+'2mni.xml'),
+                                    '-n', 'linear', '-o', coord_mni_path],
+                                fname_log, cwd=subj_fold)
+        if exit_code != 0 or not os.path.isfile(coord_mni_path):
+            raise RuntimeError('Warping of the coordinates of ' + img_name + ' to the MNI space failed, see ' + fname_log)
+
+        coord_mni_im = Image(coord_mni_path)
+        coord_mni_data = coord_mni_im.data
+        del coord_mni_im
+    finally:
+        for fname in [coord_path, coord_mni_path]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    jac_im = zeros_like(Image(fname_mni))
+    jac_im.data = jacobian_determinant(coord_mni_data) * res_x * res_y * res_z
+    del coord_mni_data
+    jac_im.change_type(type='float32')
+    jac_im.save(jac_path)
+    del jac_im
+    return jac_path
+
+
+def load_mni_atlases(path_atlases, atlas_pref_lst):
+    '''Load the atlases in the MNI space once, they are shared by all the subjects.'''
+    atlas_dct = {}
+    for atlas_pref in set(atlas_pref_lst + ['brainstem_CST']) - set(['']):
+        atlas_im = Image(os.path.join(path_atlases, atlas_pref.split('_')[0], atlas_pref+'.nii.gz')).change_orientation('RPI')
+        atlas_dct[atlas_pref] = atlas_im.data
+        del atlas_im
+    return atlas_dct
+
+
+def compute_lesion_characteristics_mni(img_fold, atlas_dct, roi_lst, atlas_pref_lst, fname_mni):
+    '''
+    Same measures as compute_lesion_characteristics, computed in the MNI space for all the ROIs.
+
+    Volumes are corrected to native mm3 with the jacobian map (see compute_jacobian_mni).
+    Return a dict {roi: (count, tlv, mask_vol)}.
+    '''
+    img_name = img_fold.split('/')[-1]
+    data_dct = {}
+    for key, path in [('lesion', os.path.join(img_fold, img_name+'_lesion_manual_mni.nii.gz')),
+                        ('brain', os.path.join(img_fold, img_name+'_brainMask_mni.nii.gz')),
+                        ('jac', compute_jacobian_mni(img_fold, fname_mni))]:
+        im = Image(path).change_orientation('RPI')
+        data_dct[key] = im.data
+        del im
+    lesion_data, jac_data = data_dct['lesion'], data_dct['jac']
+
+    z_min, z_max = z_brainstem(atlas_dct)
+
+    res_dct = {}
+    for roi, atlas_pref in zip(roi_lst, atlas_pref_lst):
+        if atlas_pref == '':
+            mask_data = np.zeros(data_dct['brain'].shape)
+            z_top = z_max+1 if roi.startswith('brainstem') else mask_data.shape[2]
+            mask_data[:, :, z_min:z_top] = data_dct['brain'][:, :, z_min:z_top]
+        else:
+            mask_data = atlas_dct[atlas_pref]
+
+        lesion_roi_data = lesion_data * mask_data
+        count = label(((lesion_data >= LESION_THR_MNI) * (mask_data > 0)).astype(np.int), neighbors=8, return_num=True)[1]
+        tlv = np.sum(lesion_roi_data * jac_data)
+        mask_vol = np.sum(mask_data * jac_data)
+        res_dct[roi] = (count, tlv, mask_vol)
+
+    return res_dct
 
-    mask_im = Image(mask_path).change_orientation('RPI')
-    lesion_im = Image(lesion_path).change_orientation('RPI')
 
-    if atlas_name == '':
-        z_min, z_max = z_brainstem(img_fold)
-        if roi_name.startswith('brainstem'):
-            mask_data = mask_im.data[:, :, z_min:z_max+1]
-            lesion_data = lesion_im.data[:, :, z_min:z_max+1]
+def get_mni_atlases():
+    '''MNI atlases, loaded once per process.'''
+    global _ATLAS_MNI_DCT
+    if _ATLAS_MNI_DCT is None:
+        _ATLAS_MNI_DCT = load_mni_atlases(config["path_atlases"], ATLAS_PREF_LST)
+    return _ATLAS_MNI_DCT
+
+
+def subject_folders(subject, center):
+    '''Folders of the struct and anat images of a subject.'''
+    center_dct = config["dct_center"]
+    subj_fold = os.path.join(config['path_data'], subject, 'brain')
+    t1_fold = os.path.join(subj_fold, center_dct[center]["struct"])
+    flair_fold = os.path.join(subj_fold, center_dct[center]["anat"])
+    if not os.path.isfile(os.path.join(flair_fold, center_dct[center]["anat"]+'.nii.gz')):
+        flair_fold = os.path.join(subj_fold, 't2')
+    return t1_fold, flair_fold
+
+
+def subject_input_lst(subject, center, do_lesion_table):
+    '''Files the measures of a subject are derived from.'''
+    t1_fold, flair_fold = subject_folders(subject, center)
+    t1_pref = os.path.join(t1_fold, t1_fold.split('/')[-1])
+    a_pref = os.path.join(flair_fold, flair_fold.split('/')[-1])
+
+    fname_lst = [t1_pref+'.nii.gz', t1_pref+'_brainMask.nii.gz', t1_pref+'_brainMask.nrrd', t1_pref+'_seg.nii.gz',
+                    a_pref+'_lesion_manual.nii.gz', a_pref+'_brainMask.nii.gz', a_pref+'_brainMask.nrrd']
+    if config["quantification_space"] == 'mni':
+        # the jacobian map is derived from the transformations (see compute_jacobian_mni)
+        fname_lst += [a_pref+'_lesion_manual_mni.nii.gz', a_pref+'_brainMask_mni.nii.gz'] + mni_transform_lst(flair_fold)
+        fname_lst += [os.path.join(config["path_atlases"], a.split('_')[0], a+'.nii.gz')
+                        for a in sorted(set(ATLAS_PREF_LST + ['brainstem_CST']) - set(['']))]
+    else:
+        if config["atlas_warp_mode"] == 'packed':
+            fname_lst.append(os.path.join(flair_fold, 'label', PACKED_ATLAS_FNAME))
         else:
-            mask_data = mask_im.data[:, :, z_min:]
-            lesion_data = lesion_im.data[:, :, z_min:]
+            fname_lst += [os.path.join(flair_fold, 'label', a+'.nii.gz') for a in ATLAS_PREF_LST if a != '']
+            fname_lst.append(os.path.join(flair_fold, 'label', 'brainstem_CST.nii.gz'))
+        if do_lesion_table:
+            fname_lst += mni_transform_lst(flair_fold)
+    return fname_lst
+
+
+def subject_fingerprint(subject, center, do_lesion_table, manifest, code):
+    '''Fingerprint of the inputs (files, options and code version) of a subject, see fingerprint.py.'''
+    return {'files': fingerprint(subject_input_lst(subject, center, do_lesion_table), manifest),
+            'options': (config["quantification_space"], config["atlas_warp_mode"], do_lesion_table),
+            'code': code}
+
+
+def quantify_subject(subject, center, do_lesion_table):
+    '''
+    Quantify one subject.
+
+    Return (record, lesion rows) where record is the list of (column, value) of the subject, in the column order.
+    '''
+    center_dct = config["dct_center"]
+    mni_brain = fsl_standard('MNI152_T1_1mm_brain.nii.gz')
+    t1_fold, flair_fold = subject_folders(subject, center)
+    record, lesion_row_lst = [], []
+
+    # tbv
+    t1_brain_mask_nii = os.path.join(t1_fold, center_dct[center]["struct"]+'_brainMask.nii.gz')
+    record.append(('tbv_brainBrainstem_full', compute_tbv(t1_brain_mask_nii)))
+
+    # brain parenchymal fraction, nan if the segmentation failed (see segment_missing_t1)
+    t1_seg = os.path.join(t1_fold, center_dct[center]["struct"]+'_seg.nii.gz')  # GM, WM, CSF
+    record.append(('brain_parenchymal_fraction', compute_bpf(t1_seg) if os.path.isfile(t1_seg) else np.nan))
+
+    # lesion count, TLV, and vol_roi
+    if config["quantification_space"] == 'mni':
+        res_dct = compute_lesion_characteristics_mni(flair_fold, get_mni_atlases(), ROI_LST, ATLAS_PREF_LST, mni_brain)
     else:
-        mask_data, lesion_data = mask_im.data, lesion_im.data
+        volumes = load_subject_volumes(flair_fold, ATLAS_PREF_LST)
+        res_dct = compute_lesion_characteristics(flair_fold, ROI_LST, ATLAS_PREF_LST, volumes=volumes)
+        if do_lesion_table:
+            lesion_row_lst = compute_lesion_rows(flair_fold, subject, volumes, ROI_LST, ATLAS_PREF_LST, mni_brain)
+        del volumes
+    for roi, atlas_pref in zip(ROI_LST, ATLAS_PREF_LST):
+        count_cur, tlv_cur, vol_cur = res_dct[roi]
+        record.append(('count_'+roi, count_cur))
+        record.append(('vol_'+roi, vol_cur))
+        record.append(('tlv_'+roi if atlas_pref == '' else 'alv_'+roi, tlv_cur))
 
-    res_x, res_y, res_z = lesion_im.dim[4:7]
-    del mask_im, lesion_im
+    return record, lesion_row_lst
 
-    lesion_data = lesion_data * mask_data[:lesion_data.shape[0],:,:]
 
-    count = label((lesion_data > 0).astype(np.int), neighbors=8, return_num=True)[1]
-    tlv = np.sum(lesion_data) * res_x * res_y * res_z
-    mask_vol = np.sum(mask_data) * res_x * res_y * res_z
-    return count, tlv, mask_vol
+def _quantify_subject_star(args):
+    return quantify_subject(*args)
 
 
 def main():
 
     subj_data_df = pd.read_pickle('1_results.pkl')
 
-    path_data = config['path_data']
-    center_dct = config["dct_center"]
     path_results_pkl = os.path.join(config["path_results"], 'brain_brainstem_results.pickle')
     path_results_csv = os.path.join(config["path_results"], 'brain_brainstem_results.csv')
 
+    # Per-lesion table: computed from the atlases warped to the anat space
+    do_lesion_table = config["lesion_table"] and config["quantification_space"] == 'native'
+    path_lesion_table = os.path.join(config["path_results"], 'brain_brainstem_lesions.npz')
 
-    roi_lst = ['brain_full', 'brainstem_full', 'brainstem_CST-R', 'brainstem_CST-L',
-            'brain_M1-R', 'brain_M1-L', 'brain_PMd-R', 'brain_PMd-L',
-            'brain_PMv-R', 'brain_PMv-L', 'brain_preSMA-R', 'brain_preSMA-L',
-            'brain_S1-R', 'brain_S1-L', 'brain_SMA-R', 'brain_SMA-L']
-    atlas_pref_lst = ['', '', 'brainstem_CST_R', 'brainstem_CST_L',
-                    'brain_M1_R', 'brain_M1_L', 'brain_PMd_R', 'brain_PMd_L',
-                    'brain_PMv_R', 'brain_PMv_L', 'brain_preSMA_R', 'brain_preSMA_L',
-                    'brain_S1_R', 'brain_S1_L', 'brain_SMA_R', 'brain_SMA_L']
+    # Brain segmentations (brain parenchymal fraction), before the quantification which only reads them
+    subject_lst = [(row.subject, row.center) for _, row in subj_data_df.iterrows() if row.subject != 'montpellier_20170112_29']
+    failed_lst = segment_missing_t1(subject_lst)
+    if len(failed_lst):
+        print('\n\nThe brain segmentation failed for the following subjects (see 2_quantify.log in their brain folder):\n\t- '+'\n\t- '.join(failed_lst))
+
+    # Incremental run: only the subjects whose inputs changed since the last run are quantified
+    cache = load_manifest(FNAME_CACHE)
+    manifest, subj_cache_dct = cache.get('manifest', {}), cache.get('subjects', {})
+    path_code = os.path.dirname(os.path.abspath(__file__))
+    code = code_version([os.path.join(path_code, f) for f in CODE_FNAME_LST])
 
+    index_lst, res_dct, args_lst = [], {}, []
     for index, row in subj_data_df.iterrows():
-        subj_fold = os.path.join(path_data, row.subject, 'brain')
         if row.subject != 'montpellier_20170112_29':
+            index_lst.append(index)
+            subj_cache = subj_cache_dct.get(row.subject, {})
+            if subj_cache.get('fingerprint') == subject_fingerprint(row.subject, row.center, do_lesion_table, manifest, code):
+                res_dct[row.subject] = subj_cache['result']
+            else:
+                args_lst.append((row.subject, row.center, do_lesion_table))
+    print('Subjects to quantify: '+str(len(args_lst))+' / '+str(len(index_lst)))
+
+    # MNI space: the atlases are loaded once, before the workers are forked
+    if config["quantification_space"] == 'mni' and len(args_lst):
+        get_mni_atlases()
+
+    # each subject is quantified in a worker, which returns its record
+    n_jobs = config["n_jobs"]
+    if n_jobs > 1 and len(args_lst) > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            new_res_lst = pool.map(_quantify_subject_star, args_lst, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        new_res_lst = [quantify_subject(*args) for args in args_lst]
 
-            # tbv
-            t1_fold = os.path.join(subj_fold, center_dct[row.center]["struct"])
-            t1_brain_mask_nii = os.path.join(t1_fold, center_dct[row.center]["struct"]+'_brainMask.nii.gz')
-            subj_data_df.loc[index, 'tbv_brainBrainstem_full'] = compute_tbv(t1_brain_mask_nii)
-
-            # brain parenchymal fraction
-            t1_img = os.path.join(t1_fold, center_dct[row.center]["struct"]+'.nii.gz')
-            t1_seg = os.path.join(t1_fold, center_dct[row.center]["struct"]+'_seg.nii.gz')  # GM, WM, CSF
-            if not os.path.isfile(t1_seg):
-                print('Brain segmentation: '+row.subject)
-                segment_t1(t1_img, t1_brain_mask_nii, t1_seg)
-            subj_data_df.loc[index, 'brain_parenchymal_fraction'] = compute_bpf(t1_seg)
-
-            flair_fold = os.path.join(subj_fold, center_dct[row.center]["anat"])
-            if not os.path.isfile(os.path.join(flair_fold, center_dct[row.center]["anat"]+'.nii.gz')):
-                flair_fold = os.path.join(subj_fold, 't2')
-
-            # lesion count, TLV, and vol_roi
-            for roi, atlas_pref in zip(roi_lst, atlas_pref_lst):
-                count_cur, tlv_cur, vol_cur = compute_lesion_characteristics(flair_fold,
-                                                                            atlas_name=atlas_pref,
-                                                                            roi_name=roi)
-                subj_data_df.loc[index, 'count_'+roi] = count_cur
-                subj_data_df.loc[index, 'vol_'+roi] = vol_cur
-                if atlas_pref == '':
-                    subj_data_df.loc[index, 'tlv_'+roi] = tlv_cur
-                else:
-                    subj_data_df.loc[index, 'alv_'+roi] = tlv_cur
+    # the fingerprint is computed after the run, as some inputs are created by the quantification (e.g. _seg)
+    for (subject, center, _), res in zip(args_lst, new_res_lst):
+        res_dct[subject] = res
+        subj_cache_dct[subject] = {'fingerprint': subject_fingerprint(subject, center, do_lesion_table, manifest, code),
+                                    'result': res}
+    save_manifest({'manifest': manifest, 'subjects': subj_cache_dct}, FNAME_CACHE)
 
+    res_lst = [res_dct[subj_data_df.loc[index, 'subject']] for index in index_lst]
+    subj_data_df = join_records(subj_data_df, dict((index, record) for index, (record, _) in zip(index_lst, res_lst)))
     subj_data_df.to_csv(path_results_csv)
     subj_data_df.to_pickle(path_results_pkl)
 
+    if do_lesion_table:
+        lesion_row_lst = [r for _, row_lst in res_lst for r in row_lst]
+        save_lesion_table(lesion_row_lst, path_lesion_table, COLUMN_LST + ['overlap_'+roi for roi in ROI_LST])
+
 if __name__ == "__main__":
     main()
@@ -11,80 +11,186 @@ import pandas as pd
 import numpy as np
 import commands
 
-import sct_utils as sct
-from spinalcordtoolbox.image import Image, zeros_like
+from spinalcordtoolbox.image import Image
+
+from packed_atlas import load_packed_atlas, PACKED_ATLAS_FNAME
+from common.lfm_accumulator import sum_masks, sum_masks_sharded, sum_masks_groups, lfm_ratio, save_volume
+from common.lfm_matrix import matrix_uptodate, build_lfm_matrix, load_lfm_matrix, select_subjects, lfm_query
+from common.lfm_incremental import update_sums, load_group_sums, MANIFEST_FNAME
+from common.fingerprint import load_manifest, save_manifest
 
 from config_file import config
 
 
 TRACTS_LST = ['brain/brain.nii.gz', 'brainstem/brainstem_CST.nii.gz']
+PACKED_TRACTS_LST = ['brain', 'brainstem_CST']  # same ROIs, in the packed atlas
+
+SUBGROUP_LST = ['all', 'rem', 'pro', 'CIS', 'RR', 'SP', 'PP', 'edss_low', 'edss_med', 'edss_high', 'edssPy_low', 'edssPy_med', 'edssPy_high']
 
 
-def clean_LFM(fname_out, fname_brain):
-    img, brain = Image(fname_out), Image(fname_brain)
+def clean_LFM(lfm_data, fname_brain):
+    brain = Image(fname_brain)
     brain_data = brain.data
     del brain
 
-    img.data[np.where(brain_data == 0)] = 0
+    lfm_data[np.where(brain_data == 0)] = 0
+    return lfm_data
 
-    img.save(fname_out)
-    del img
 
+def load_cst_mask(path_atlases):
+    if config["packed_atlas"]:
+        roi_dct = load_packed_atlas(os.path.join(path_atlases, PACKED_ATLAS_FNAME), roi_lst=PACKED_TRACTS_LST)
+        cst_mask_data = np.sum([roi_dct[roi] for roi in PACKED_TRACTS_LST], axis=0)
+    else:
+        cst_mask_data = np.sum([Image(os.path.join(path_atlases, t)).data for t in TRACTS_LST], axis=0)
+    return (cst_mask_data > 0.0).astype(np.int_)
 
-def initialise_sumFile(fname_out, fname_standard):
-    img_out = zeros_like(Image(fname_standard))
-    img_out.save(fname_out)
-    del img_out
 
+def mask_CST(lfm_data, cst_mask_data):
+    lfm_cst_data = np.copy(lfm_data)
+    lfm_cst_data[np.where(cst_mask_data == 0.0)] = 0.0
+    return lfm_cst_data
 
-def add_mask(fname_new, fname_out):
-    img_new, img_in = Image(fname_new), Image(fname_out)
-    img_out = zeros_like(img_in)
-    img_out.data = img_new.data + img_in.data
-    del img_new, img_in
-    img_out.save(fname_out)
-    del img_out
 
+def subject_mask_pair(row, path_data, dct_center):
+    '''(lesion mask path, brain mask path) of the subject of row, in the MNI space, None if one of them is missing.'''
+    anat_folder = dct_center[row.center]['anat']
+    if not os.path.isfile(os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+".nii.gz")):
+        anat_folder = 't2'
 
-def mask_CST(fname_LFM, fname_LFM_CST, mask_lst):
-    img_lfm = Image(fname_LFM)
-    img_cst = zeros_like(img_lfm)
-    img_cst.data = img_lfm.data
-    del img_lfm
+    lesion_path = os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+'_lesion_manual_mni.nii.gz')
+    brain_path = os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+'_brainMask_mni.nii.gz')
+    if os.path.isfile(lesion_path) and os.path.isfile(brain_path):
+        return lesion_path, brain_path
+    return None
 
-    cst_mask_data = np.sum([Image(mask_fname).data for mask_fname in mask_lst], axis=0)
-    cst_mask_data = (cst_mask_data > 0.0).astype(np.int_)
 
-    img_cst.data[np.where(cst_mask_data == 0.0)] = 0.0
-    img_cst.save(fname_LFM_CST)
+def write_LFM(sum_lesion, sum_brain, fname_out, fname_out_cst, path_atlases, mni_brain):
+    fname_out_lesion = fname_out.split('_LFM.nii.gz')[0] + '_sumLesion.nii.gz'
+    fname_out_brain = fname_out.split('_LFM.nii.gz')[0] + '_sumBrain.nii.gz'
+    save_volume(sum_lesion, mni_brain, fname_out_lesion)
+    save_volume(sum_brain, mni_brain, fname_out_brain)
+
+    lfm_data = clean_LFM(lfm_ratio(sum_lesion, sum_brain), mni_brain)
+    save_volume(lfm_data, mni_brain, fname_out)
+    save_volume(mask_CST(lfm_data, load_cst_mask(path_atlases)), mni_brain, fname_out_cst)
 
 
 def generate_LFM(df, fname_out, fname_out_cst, path_data, dct_center, path_atlases):
     mni_brain = os.path.join(commands.getstatusoutput('echo $FSLDIR')[1], 'data', 'standard', 'MNI152_T1_1mm_brain.nii.gz')
 
-    fname_out_lesion = fname_out.split('_LFM.nii.gz')[0] + '_sumLesion.nii.gz'
-    fname_out_brain = fname_out.split('_LFM.nii.gz')[0] + '_sumBrain.nii.gz'
-    initialise_sumFile(fname_out_lesion, mni_brain)
-    initialise_sumFile(fname_out_brain, mni_brain)
-
+    pair_lst = []
     for index, row in df.iterrows():
-        anat_folder = dct_center[row.center]['anat']
-        if not os.path.isfile(os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+".nii.gz")):
-            anat_folder = 't2'
+        pair = subject_mask_pair(row, path_data, dct_center)
+        if pair is not None:
+            print row.subject
+            pair_lst.append(pair)
+
+    if config["lfm_sharded"]:
+        sum_lesion, sum_brain = sum_masks_sharded(pair_lst, mni_brain, config["n_jobs"])
+    else:
+        sum_lesion, sum_brain = sum_masks(pair_lst, mni_brain)
+    write_LFM(sum_lesion, sum_brain, fname_out, fname_out_cst, path_atlases, mni_brain)
+
+
+def generate_LFM_subgroups(subj_data_df, subgroup_lst, fname_lst, path_data, dct_center, path_atlases):
+    '''
+    Generate the LFMs of all the subgroups of subgroup_lst in a single pass over the subjects.
+
+    fname_lst: (LFM path, CST LFM path) of each subgroup.
+    '''
+    mni_brain = os.path.join(commands.getstatusoutput('echo $FSLDIR')[1], 'data', 'standard', 'MNI152_T1_1mm_brain.nii.gz')
+
+    # subject x subgroup membership
+    index_lst = [set(subgroup_df(subj_data_df, subgroup).index) for subgroup in subgroup_lst]
 
-        lesion_path = os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+'_lesion_manual_mni.nii.gz')
-        brain_path = os.path.join(path_data, row.subject, 'brain', anat_folder, anat_folder+'_brainMask_mni.nii.gz')
-        if os.path.isfile(lesion_path) and os.path.isfile(brain_path):
+    pair_lst, member_lst = [], []
+    for index, row in subj_data_df.iterrows():
+        group_lst = [i_group for i_group, group_index in enumerate(index_lst) if index in group_index]
+        pair = subject_mask_pair(row, path_data, dct_center) if len(group_lst) else None
+        if pair is not None:
             print row.subject
-            add_mask(lesion_path, fname_out_lesion)
-            add_mask(brain_path, fname_out_brain)
+            pair_lst.append(pair)
+            member_lst.append(group_lst)
 
-    sct.run(['sct_maths', '-i', fname_out_lesion,
-                         '-div', fname_out_brain,
-                         '-o', fname_out])
+    sum_lesion, sum_brain = sum_masks_groups(pair_lst, member_lst, len(subgroup_lst), mni_brain)
+    for i_group, (fname_out, fname_out_cst) in enumerate(fname_lst):
+        write_LFM(sum_lesion[i_group], sum_brain[i_group], fname_out, fname_out_cst, path_atlases, mni_brain)
 
-    clean_LFM(fname_out, mni_brain)
-    mask_CST(fname_out, fname_out_cst, [os.path.join(path_atlases, t) for t in TRACTS_LST])
+
+def update_matrix(subj_data_df, ofolder, path_data, dct_center, path_atlases):
+    '''Build the subject x voxel matrix of all the subjects in ofolder if needed (see common/lfm_matrix.py), then load it.'''
+    mni_brain = os.path.join(commands.getstatusoutput('echo $FSLDIR')[1], 'data', 'standard', 'MNI152_T1_1mm_brain.nii.gz')
+
+    pair_lst = [subject_mask_pair(row, path_data, dct_center) for index, row in subj_data_df.iterrows()]
+    if not matrix_uptodate(ofolder, list(subj_data_df.subject), pair_lst):
+        print('\nBuilding the subject x voxel matrix ('+str(len(subj_data_df.index))+' subjects).')
+        support_data = clean_LFM(np.ones(Image(mni_brain).data.shape), mni_brain)
+        build_lfm_matrix(list(subj_data_df.subject), pair_lst, support_data, load_cst_mask(path_atlases), mni_brain, ofolder)
+    return load_lfm_matrix(ofolder)
+
+
+def generate_LFM_matrix(lfm_mat, df, fname_out, fname_out_cst):
+    lfm_data, lfm_cst_data = lfm_query(lfm_mat, select_subjects(lfm_mat, df))
+    save_volume(lfm_data, lfm_mat['ref'], fname_out)
+    save_volume(lfm_cst_data, lfm_mat['ref'], fname_out_cst)
+
+
+def generate_LFM_incremental(subj_data_df, path_lfm_fold, path_data, dct_center, path_atlases):
+    '''Update the sums of each subgroup with the added, removed or modified subjects (see common/lfm_incremental.py).'''
+    mni_brain = os.path.join(commands.getstatusoutput('echo $FSLDIR')[1], 'data', 'standard', 'MNI152_T1_1mm_brain.nii.gz')
+    path_sums = os.path.join(path_lfm_fold, 'brain_sums')
+    manifest = load_manifest(os.path.join(path_sums, MANIFEST_FNAME))
+
+    group_pair_dct = {}
+    for subgroup in SUBGROUP_LST:
+        group_pair_dct[subgroup] = {}
+        for index, row in subgroup_df(subj_data_df, subgroup).iterrows():
+            pair = subject_mask_pair(row, path_data, dct_center)
+            if pair is not None:
+                group_pair_dct[subgroup][row.subject] = pair
+
+    # each added or removed mask is read once for all the subgroups
+    sum_dct = update_sums(path_sums, group_pair_dct, mni_brain, manifest)
+
+    for subgroup in SUBGROUP_LST:
+        path_lfm = os.path.join(path_lfm_fold, 'brain_LFM_'+subgroup+'.nii.gz')
+        path_lfm_cst = os.path.join(path_lfm_fold, 'brain_LFM_CST_'+subgroup+'.nii.gz')
+        if subgroup in sum_dct or not os.path.isfile(path_lfm) or not os.path.isfile(path_lfm_cst):
+            print('\nUpdating the LFM with '+subgroup+' subjects ('+str(len(group_pair_dct[subgroup]))+').')
+            if subgroup in sum_dct:
+                sum_lesion, sum_brain = sum_dct.pop(subgroup)
+            else:
+                sum_lesion, sum_brain = load_group_sums(path_sums, subgroup, Image(mni_brain).data.shape)
+            write_LFM(sum_lesion, sum_brain, path_lfm, path_lfm_cst, path_atlases, mni_brain)
+
+    save_manifest(manifest, os.path.join(path_sums, MANIFEST_FNAME))
+
+
+def subgroup_df(subj_data_df, subgroup):
+    '''Subjects of the subgroup (see SUBGROUP_LST).'''
+    if subgroup == 'all':
+        return subj_data_df
+    elif subgroup == 'pro':
+        return subj_data_df[subj_data_df.phenotype.isin(['PP', 'SP'])]
+    elif subgroup == 'rem':
+        return subj_data_df[subj_data_df.phenotype.isin(['CIS', 'RR'])]
+    elif subgroup in ['CIS', 'RR', 'SP', 'PP']:
+        return subj_data_df[subj_data_df.phenotype == subgroup]
+    elif subgroup.startswith('edss_'):
+        if subgroup.endswith('low'):
+            return subj_data_df[subj_data_df.edss_M0 <= 2.5]
+        elif subgroup.endswith('high'):
+            return subj_data_df[subj_data_df.edss_M0 >= 6.0]
+        elif subgroup.endswith('med'):
+            return subj_data_df[(subj_data_df.edss_M0 < 6.0) & (subj_data_df.edss_M0 > 2.5)]
+    elif subgroup.startswith('edssPy_'):
+        if subgroup.endswith('low'):
+            return subj_data_df[subj_data_df.edss_py_M0 < 1.0]
+        elif subgroup.endswith('high'):
+            return subj_data_df[subj_data_df.edss_py_M0 >= 3.0]
+        elif subgroup.endswith('med'):
+            return subj_data_df[(subj_data_df.edss_py_M0 < 3.0) & (subj_data_df.edss_py_M0 >= 1.0)]
 
 
 def main(args=None):
@@ -99,35 +205,32 @@ def main(args=None):
     if not os.path.isdir(path_lfm_fold):
         os.makedirs(path_lfm_fold)
 
-    for subgroup in ['all', 'rem', 'pro', 'CIS', 'RR', 'SP', 'PP', 'edss_low', 'edss_med', 'edss_high', 'edssPy_low', 'edssPy_med', 'edssPy_high']:
+    if config["lfm_incremental"]:
+        generate_LFM_incremental(subj_data_df, path_lfm_fold, path_data, dct_center, path_atlases)
+        return
+
+    lfm_mat = None
+    if config["lfm_matrix"]:
+        lfm_mat = update_matrix(subj_data_df, os.path.join(path_lfm_fold, 'brain_matrix'), path_data, dct_center, path_atlases)
+
+    todo_lst = []
+    for subgroup in SUBGROUP_LST:
         path_lfm = os.path.join(path_lfm_fold, 'brain_LFM_'+subgroup+'.nii.gz')
         path_lfm_cst = os.path.join(path_lfm_fold, 'brain_LFM_CST_'+subgroup+'.nii.gz')
-        if subgroup == 'all':
-            lfm_df = subj_data_df
-        elif subgroup == 'pro':
-            lfm_df = subj_data_df[subj_data_df.phenotype.isin(['PP', 'SP'])]
-        elif subgroup == 'rem':
-            lfm_df = subj_data_df[subj_data_df.phenotype.isin(['CIS', 'RR'])]
-        elif subgroup in ['CIS', 'RR', 'SP', 'PP']:
-            lfm_df = subj_data_df[subj_data_df.phenotype == subgroup]
-        elif subgroup.startswith('edss_'):
-            if subgroup.endswith('low'):
-                lfm_df = subj_data_df[subj_data_df.edss_M0 <= 2.5]
-            elif subgroup.endswith('high'):
-                lfm_df = subj_data_df[subj_data_df.edss_M0 >= 6.0]
-            elif subgroup.endswith('med'):
-                lfm_df = subj_data_df[(subj_data_df.edss_M0 < 6.0) & (subj_data_df.edss_M0 > 2.5)]
-        elif subgroup.startswith('edssPy_'):
-            if subgroup.endswith('low'):
-                lfm_df = subj_data_df[subj_data_df.edss_py_M0 < 1.0]
-            elif subgroup.endswith('high'):
-                lfm_df = subj_data_df[subj_data_df.edss_py_M0 >= 3.0]
-            elif subgroup.endswith('med'):
-                lfm_df = subj_data_df[(subj_data_df.edss_py_M0 < 3.0) & (subj_data_df.edss_py_M0 >= 1.0)]
+        lfm_df = subgroup_df(subj_data_df, subgroup)
 
         if not os.path.isfile(path_lfm) or not os.path.isfile(path_lfm_cst):
             print('\nGenerating the LFM with '+subgroup+' subjects ('+str(len(lfm_df.index))+').')
-            generate_LFM(lfm_df, path_lfm, path_lfm_cst, path_data, dct_center, path_atlases)
+            if lfm_mat is not None:
+                generate_LFM_matrix(lfm_mat, lfm_df, path_lfm, path_lfm_cst)
+            elif config["lfm_single_pass"]:
+                todo_lst.append((subgroup, path_lfm, path_lfm_cst))
+            else:
+                generate_LFM(lfm_df, path_lfm, path_lfm_cst, path_data, dct_center, path_atlases)
+
+    if len(todo_lst):
+        generate_LFM_subgroups(subj_data_df, [t[0] for t in todo_lst], [t[1:] for t in todo_lst],
+                                path_data, dct_center, path_atlases)
 
 if __name__ == "__main__":
     main()
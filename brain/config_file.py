@@ -31,3 +31,40 @@ config["path_anima_brain_extraction"] = "/Users/anne/Anima-Scripts-Public/brain_
 config["path_smatt_folder"] = "/Volumes/projects/ms_brain_spine/download_atlases/SMATT_website/"
 config["path_brainstem_folder"] = "/Volumes/projects/ms_brain_spine/download_atlases/Brainstem23BundleAtlas/"
 config["path_atlases"] = "/Volumes/projects/ms_brain_spine/atlases/"
+# Save all the brain and brainstem ROIs as a single bit-packed label volume (see packed_atlas.py)
+config["packed_atlas"] = False
+
+# Number of parallel workers (1: serial run)
+config["n_jobs"] = 1
+# Number of threads used by each parallel job running external tools (None: number of cores divided by n_jobs)
+config["n_threads_per_job"] = None
+# Number of independent registration steps run in parallel for each subject
+config["n_parallel_steps"] = 2
+# Warping of the atlases to the anat space: 'separate' (one call per atlas), 'stack' (single call on the 4D stack of atlases)
+# or 'packed' (single call on the packed atlas, nearest neighbour interpolation: requires config["packed_atlas"])
+# NB: 'packed' gives binary ROIs (nearest neighbour) instead of fractional ones, which changes the vol_* and alv_* values
+config["atlas_warp_mode"] = 'separate'
+# Space where lesions are quantified: 'native' (atlases warped to the anat space) or 'mni' (lesion and brain masks warped
+# to the MNI space, volumes corrected with the jacobian of the transformation, no atlas warping during the registration)
+config["quantification_space"] = 'native'
+
+# If True, 2_quantify.py also saves a per-lesion table (brain_brainstem_lesions.npz in path_results),
+# only available if quantification_space is 'native'
+config["lesion_table"] = False
+
+# Time limit (s) of each brain segmentation run by 2_quantify.py (None: no limit)
+config["atropos_timeout"] = None
+
+# If True, 3_generate_LFM.py generates all the missing subgroup LFMs in a single pass over the subjects
+config["lfm_single_pass"] = False
+
+# If True, 3_generate_LFM.py packs the masks of all the subjects in a subject x voxel matrix (rebuilt when a mask
+# changes), used to compute the subgroup LFMs without reading the masks again (see common/lfm_matrix.py)
+config["lfm_matrix"] = False
+
+# If True, 3_generate_LFM.py saves the sums of each subgroup, and only adds / subtracts the masks of the added, removed
+# or modified subjects on the next runs (see common/lfm_incremental.py)
+config["lfm_incremental"] = False
+
+# If True, 3_generate_LFM.py sums the masks of each subgroup by shards of subjects, in n_jobs worker processes
+config["lfm_sharded"] = False
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Goal: Run external commands (Anima, ANTs) concurrently, without oversubscribing the machine.
+#
+# - run_command: run one command with a thread budget, log its output and return its exit code
+# - run_jobs: run a list of jobs through a bounded pool of workers
+# - run_dag: run a list of steps (commands with input and output files) as a dependency graph:
+#   a step starts as soon as the steps producing its inputs are done, independent steps run in parallel,
+#   and steps whose outputs are newer than their inputs are skipped. The thread budget is shared by the steps
+#   running at the same time: a step running alone (e.g. on the critical path) gets the whole budget.
+# - fsl_standard: path of an FSL standard image (e.g. the MNI template) used by the commands
+#
+# Created: 2026-10-18
+
+import os
+import time
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+TIMEOUT_EXIT_CODE = -9  # exit code reported when a command is killed after its timeout
+ERROR_EXIT_CODE = 1  # exit code reported when a step cannot be run (e.g. missing input)
+POLL_INTERVAL = 1.0  # s
+
+
+def n_threads_per_job(n_jobs, n_threads=None):
+    '''Thread budget of each job: n_threads if set, otherwise the number of cores divided by n_jobs.'''
+    if n_threads:
+        return n_threads
+    return max(1, multiprocessing.cpu_count() // max(1, n_jobs))
+
+
+def thread_env(n_threads):
+    '''Environment limiting the number of threads used by ITK based tools (Anima, ANTs) and OpenMP.'''
+    env = os.environ.copy()
+    if n_threads:
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(n_threads)
+        env['OMP_NUM_THREADS'] = str(n_threads)
+    return env
+
+
+def fsl_standard(fname):
+    '''Path of fname in the standard folder of FSL ($FSLDIR/data/standard), raise a RuntimeError if FSLDIR is not set.'''
+    if not os.environ.get('FSLDIR'):
+        raise RuntimeError('FSLDIR is not set, cannot find ' + fname + ' (load the FSL configuration first)')
+    return os.path.join(os.environ['FSLDIR'], 'data', 'standard', fname)
+
+
+def run_command(cmd_lst, fname_log, cwd=None, n_threads=None, timeout=None):
+    '''
+    Run the command cmd_lst (list of str), append its stdout and stderr to fname_log.
+
+    Return the exit code of the command, or TIMEOUT_EXIT_CODE if it was killed after timeout seconds.
+    '''
+    with open(fname_log, 'a') as log:
+        log.write('$ ' + ' '.join(cmd_lst) + '\n')
+        log.flush()
+        proc = subprocess.Popen(cmd_lst, stdout=log, stderr=subprocess.STDOUT, cwd=cwd, env=thread_env(n_threads))
+        if timeout is None:
+            exit_code = proc.wait()
+        else:
+            t_start = time.time()
+            while proc.poll() is None and time.time() - t_start < timeout:
+                time.sleep(POLL_INTERVAL)
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+                exit_code = TIMEOUT_EXIT_CODE
+                log.write('Killed after ' + str(timeout) + ' s.\n')
+            else:
+                exit_code = proc.returncode
+        log.write('Exit code: ' + str(exit_code) + '\n\n')
+
+    return exit_code
+
+
+def _run_job(job):
+    name, fct, args = job
+    return name, fct(*args)
+
+
+def run_jobs(job_lst, n_jobs):
+    '''
+    Run the jobs of job_lst, a list of (name, function, args), with n_jobs workers.
+
+    Return a dict {name: value returned by function(*args)}.
+    '''
+    if n_jobs > 1 and len(job_lst) > 1:
+        pool = ThreadPool(n_jobs)  # threads are enough: the work is done by the external commands
+        try:
+            res_lst = pool.map(_run_job, job_lst, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        res_lst = [_run_job(job) for job in job_lst]
+
+    return dict(res_lst)
+
+
+def _log(fname_log, stg):
+    with open(fname_log, 'a') as log:
+        log.write(stg + '\n')
+
+
+def _is_up_to_date(step, cwd):
+    '''True if all the outputs of step exist and are not older than its inputs.'''
+    in_lst = [os.path.join(cwd, f) for f in step['inputs']]
+    out_lst = [os.path.join(cwd, f) for f in step['outputs']]
+    if not all([os.path.exists(f) for f in out_lst]) or not all([os.path.exists(f) for f in in_lst]):
+        return False
+    return not len(in_lst) or min([os.path.getmtime(f) for f in out_lst]) >= max([os.path.getmtime(f) for f in in_lst])
+
+
+def _run_step(step, cwd, fname_log, n_threads):
+    try:
+        if _is_up_to_date(step, cwd):
+            _log(fname_log, 'Up to date: ' + step['name'])
+            return step['name'], 0
+
+        missing_lst = [f for f in step['inputs'] if not os.path.exists(os.path.join(cwd, f))]
+        if len(missing_lst):
+            _log(fname_log, 'Missing input(s) for ' + step['name'] + ': ' + ', '.join(missing_lst))
+            return step['name'], ERROR_EXIT_CODE
+
+        for f in step['outputs']:
+            ofolder = os.path.dirname(os.path.join(cwd, f))
+            if not os.path.isdir(ofolder):
+                try:
+                    os.makedirs(ofolder)
+                except OSError:  # created in the meantime by a parallel step
+                    pass
+
+        _log(fname_log, 'Running: ' + step['name'])
+        if 'fct' in step:  # in-process step
+            step['fct'](*step['args'])
+            return step['name'], 0
+        cmd_lst = step['cmd'] + ([step['threads_flag'], str(n_threads)] if 'threads_flag' in step else [])
+        return step['name'], run_command(cmd_lst, fname_log, cwd=cwd, n_threads=n_threads)
+    except Exception as e:
+        _log(fname_log, 'Error in ' + step['name'] + ': ' + str(e))
+        return step['name'], ERROR_EXIT_CODE
+
+
+def run_dag(step_lst, cwd, fname_log, n_workers=1, n_threads=None):
+    '''
+    Run the steps of step_lst as a dependency graph.
+
+    Each step is a dict with the keys 'name', 'cmd' (list of str), 'inputs' and 'outputs' (file paths relative to cwd).
+    Instead of 'cmd', a step can have the keys 'fct' and 'args': fct(*args) is then run in-process (with absolute paths).
+    A step can also have a 'threads_flag' key (e.g. '-T'), followed by its number of threads in its command.
+    A step depends on the steps producing its inputs. Up to n_workers independent steps run at the same time,
+    sharing n_threads threads: each step gets n_threads divided by the number of steps running when it starts.
+    The steps depending on a failed step are not run.
+
+    Return a dict {step name: exit code}, the exit code being None for the steps not run because of a failure.
+    '''
+    producer_dct = dict((f, step['name']) for step in step_lst for f in step['outputs'])
+    dep_dct = dict((step['name'], set([producer_dct[f] for f in step['inputs'] if f in producer_dct])) for step in step_lst)
+
+    exit_code_dct = {}
+    pending_lst = list(step_lst)
+    n_running, done_queue = 0, Queue()
+    pool = ThreadPool(max(1, n_workers))
+    try:
+        while len(pending_lst) or n_running:
+            ready_lst = []
+            for step in list(pending_lst):
+                dep_lst = dep_dct[step['name']]
+                if any([exit_code_dct[d] != 0 for d in dep_lst if d in exit_code_dct]):
+                    pending_lst.remove(step)
+                    exit_code_dct[step['name']] = None
+                elif all([d in exit_code_dct for d in dep_lst]):
+                    pending_lst.remove(step)
+                    ready_lst.append(step)
+
+            # the thread budget is split between the steps running at the same time
+            n_concurrent = min(max(1, n_workers), n_running + len(ready_lst))
+            step_threads = max(1, n_threads // max(1, n_concurrent)) if n_threads else None
+            for step in ready_lst:
+                n_running += 1
+                pool.apply_async(_run_step, (step, cwd, fname_log, step_threads), callback=done_queue.put)
+
+            if not n_running and len(pending_lst):
+                raise ValueError('Cyclic dependencies between the steps: ' + ', '.join([step['name'] for step in pending_lst]))
+            if n_running:
+                name, exit_code = done_queue.get()
+                n_running -= 1
+                exit_code_dct[name] = exit_code
+    finally:
+        pool.close()
+        pool.join()
+
+    return exit_code_dct
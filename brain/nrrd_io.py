@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Goal: Read the NRRD volumes written by Anima (e.g. brain masks) without converting them to NIfTI.
+#
+# Supported: single-file NRRD, attached data with raw or gzip encoding, 3D volumes with a physical space
+# (space directions and space origin, as written by ITK / Anima). The affine is returned in the RAS+ convention
+# (same as the NIfTI qform / sform), so that the volume can be reoriented like an Image (see reorient).
+#
+# Created: 2026-10-18
+
+import re
+import zlib
+import numpy as np
+import nibabel as nib
+
+NRRD_DTYPE_DCT = {'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+                    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+                    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+                    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+                    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+                    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+                    'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+                    'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+                    'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+                    'float': 'f4', 'double': 'f8'}
+
+# sign of the axes of each NRRD space, to go to RAS+
+SPACE_SIGN_DCT = {'right-anterior-superior': [1, 1, 1], 'ras': [1, 1, 1],
+                    'left-anterior-superior': [-1, 1, 1], 'las': [-1, 1, 1],
+                    'left-posterior-superior': [-1, -1, 1], 'lps': [-1, -1, 1]}
+
+
+def _parse_vector(stg):
+    return [float(v) for v in stg.strip().strip('()').split(',')]
+
+
+def read_nrrd_header(f):
+    '''Read the header of the NRRD file object f (opened in binary mode), up to the blank line. Return a dict {field: value (str)}.'''
+    magic = f.readline().decode('ascii').strip()
+    if not magic.startswith('NRRD'):
+        raise ValueError('Not a NRRD file')
+
+    hdr = {}
+    line = f.readline().decode('ascii').rstrip('\r\n')
+    while line:
+        if not line.startswith('#') and ':=' not in line:  # skip the comments and the key/value pairs
+            key, value = line.split(':', 1)
+            hdr[key.strip().lower()] = value.strip()
+        line = f.readline().decode('ascii').rstrip('\r\n')
+    return hdr
+
+
+def nrrd_affine(hdr):
+    '''Voxel to world (RAS+) affine of the NRRD header hdr.'''
+    sign_arr = np.array(SPACE_SIGN_DCT[hdr.get('space', 'left-posterior-superior').lower()], dtype=np.float64)
+    # vectors may contain spaces, e.g. (1, 0, 0) (0, 1, 0) (0, 0, 1), and 'none' for the non-spatial axes
+    direction_lst = [v for v in re.findall(r'\(([^)]*)\)|none', hdr['space directions']) if v != '']
+    affine = np.eye(4)
+    for i_axis, direction in enumerate(direction_lst):
+        affine[:3, i_axis] = sign_arr * np.array(_parse_vector(direction))
+    if 'space origin' in hdr:
+        affine[:3, 3] = sign_arr * np.array(_parse_vector(hdr['space origin']))
+    return affine
+
+
+def read_nrrd(fname):
+    '''Read the NRRD volume fname, return (data in the voxel order of the file, RAS+ affine).'''
+    with open(fname, 'rb') as f:
+        hdr = read_nrrd_header(f)
+        if 'data file' in hdr or 'datafile' in hdr:
+            raise ValueError('Detached NRRD data are not supported: ' + fname)
+        raw = f.read()
+
+    shape = tuple([int(s) for s in hdr['sizes'].split()])
+    dtype = np.dtype(NRRD_DTYPE_DCT[hdr['type'].lower()])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('>' if hdr.get('endian', 'little') == 'big' else '<')
+
+    encoding = hdr.get('encoding', 'raw').lower()
+    if encoding in ['gzip', 'gz']:
+        raw = zlib.decompress(raw, zlib.MAX_WBITS | 32)  # gzip or zlib stream
+    elif encoding != 'raw':
+        raise ValueError('Unsupported NRRD encoding (' + encoding + '): ' + fname)
+
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    byte_skip = int(hdr.get('byte skip', 0))
+    raw = raw[len(raw) - n_bytes:] if byte_skip == -1 else raw[byte_skip:byte_skip + n_bytes]
+    if len(raw) != n_bytes:
+        raise ValueError('Truncated NRRD data: ' + fname)
+
+    data = np.frombuffer(raw, dtype=dtype).reshape(shape, order='F')  # first axis is the fastest
+    return data, nrrd_affine(hdr)
+
+
+def reorient(data, affine, orientation='RPI'):
+    '''Reorient data to the orientation of spinalcordtoolbox.image.Image.change_orientation (e.g. 'RPI').'''
+    # SCT orientations give the origin side of each axis ('RPI': from right to left, ...), nibabel the end side
+    opposite_dct = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'S': 'I', 'I': 'S'}
+    target_ornt = nib.orientations.axcodes2ornt(tuple([opposite_dct[c] for c in orientation]))
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(affine), target_ornt)
+    return nib.orientations.apply_orientation(data, ornt)
+
+
+def voxel_volume_affine(affine):
+    '''Volume of one voxel in mm3.'''
+    return abs(np.linalg.det(affine[:3, :3]))
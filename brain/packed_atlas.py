@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Goal: Store the brain and brainstem ROIs as a single bit-packed label volume.
+#
+# Each ROI is assigned one bit of an integer volume, so that overlapping ROIs can be stored in the same voxel.
+# The label table (json file saved next to the volume) gives, for each ROI name, the value to use as bit mask:
+#   roi_mask = (atlas_data & label_dct[roi_name]) > 0
+# Unions of ROIs (e.g. 'brain', 'brainstem_CST') are stored in the table as the OR of their bits.
+#
+# Created: 2026-10-18
+
+import os
+import json
+import shutil
+import numpy as np
+
+from spinalcordtoolbox.image import Image, zeros_like
+
+PACKED_ATLAS_FNAME = 'atlas_packed.nii.gz'
+
+
+def fname_label_table(fname_atlas):
+    return fname_atlas.split('.nii')[0] + '.json'
+
+
+def pack_atlas(mask_lst, union_dct, fname_ref, fname_out):
+    '''
+    Save the binary masks of mask_lst (list of (roi_name, data)) as a bit-packed volume in fname_out.
+
+    union_dct: {union_name: list of roi_name} unions to add to the label table.
+    fname_ref: image in the same space as the masks, used for the header.
+    '''
+    if len(mask_lst) > 16:
+        raise ValueError('Too many ROIs to pack in uint16: ' + str(len(mask_lst)))
+
+    ref_im = Image(fname_ref)
+    packed_data = np.zeros(ref_im.data.shape[:3], dtype=np.uint16)
+    label_dct = {}
+    for i_roi, (roi, data) in enumerate(mask_lst):
+        if data.shape[:3] != packed_data.shape:
+            raise ValueError('ROI ' + roi + ' is not in the space of ' + fname_ref)
+        packed_data[data > 0] |= np.uint16(1 << i_roi)
+        label_dct[roi] = 1 << i_roi
+
+    for union in union_dct:
+        label_dct[union] = 0
+        for roi in union_dct[union]:
+            label_dct[union] |= label_dct[roi]
+
+    o_im = zeros_like(ref_im)
+    del ref_im
+    o_im.data = packed_data
+    o_im.change_type(type='uint16')
+    o_im.save(fname_out)
+    del o_im
+
+    with open(fname_label_table(fname_out), 'w') as f:
+        json.dump(label_dct, f, indent=4, sort_keys=True)
+
+
+def copy_label_table(fname_atlas, fname_atlas_dest):
+    shutil.copyfile(fname_label_table(fname_atlas), fname_label_table(fname_atlas_dest))
+
+
+def load_label_table(fname_atlas):
+    with open(fname_label_table(fname_atlas), 'r') as f:
+        return json.load(f)
+
+
+def unpack_atlas(packed_data, label_dct, roi_lst=None):
+    '''Return {roi_name: binary mask (int)} for each ROI of roi_lst (default: all the ROIs of the label table).'''
+    packed_data = packed_data.astype(np.uint16)
+    roi_lst = sorted(label_dct.keys()) if roi_lst is None else roi_lst
+    return dict((roi, ((packed_data & label_dct[roi]) > 0).astype(np.int_)) for roi in roi_lst)
+
+
+def load_packed_atlas(fname_atlas, roi_lst=None, orientation=None):
+    '''Load the packed atlas fname_atlas and return {roi_name: binary mask}, optionally reoriented (e.g. 'RPI').'''
+    atlas_im = Image(fname_atlas)
+    if orientation is not None:
+        atlas_im.change_orientation(orientation)
+    packed_data = atlas_im.data
+    del atlas_im
+
+    return unpack_atlas(packed_data, load_label_table(fname_atlas), roi_lst)
+
+
+def split_packed_atlas(fname_atlas, ofolder):
+    '''Save each ROI of the label table (including the unions) of the packed atlas as a binary volume ofolder/<roi_name>.nii.gz.'''
+    atlas_im = Image(fname_atlas)
+    label_dct = load_label_table(fname_atlas)
+    roi_dct = unpack_atlas(atlas_im.data, label_dct)
+    for roi in sorted(roi_dct):
+        o_im = zeros_like(atlas_im)
+        o_im.data = roi_dct[roi]
+        o_im.change_type(type='uint8')
+        o_im.save(os.path.join(ofolder, roi + '.nii.gz'))
+        del o_im
+    del atlas_im
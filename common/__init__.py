@@ -0,0 +1 @@
+# Modules shared by the brain/ and spinalcord/ scripts, see "How to run" in the README.
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Goal: Fingerprint input files, to skip the processing of files which did not change since the last run.
+#
+# A manifest is a dict {absolute path: entry} saved as a pickle, where each entry contains:
+# - size, mtime: used as a fast check, the file is not re-read if both are unchanged
+# - hash: sha1 of the file content
+# - verdicts: dict {check name (and version): result of the check} computed on this content
+#
+# fingerprint and code_version identify the inputs (data and code) a result was derived from.
+#
+# Created: 2026-10-18
+
+import os
+import pickle
+import hashlib
+
+BLOCK_SIZE = 2 ** 20
+
+
+def file_hash(fname):
+    '''sha1 of the file content, read by blocks.'''
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        block = f.read(BLOCK_SIZE)
+        while block:
+            sha.update(block)
+            block = f.read(BLOCK_SIZE)
+    return sha.hexdigest()
+
+
+def load_manifest(fname):
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    return {}
+
+
+def save_manifest(manifest, fname):
+    fname_tmp = fname + '.tmp'
+    with open(fname_tmp, 'wb') as f:
+        pickle.dump(manifest, f)
+    os.rename(fname_tmp, fname)  # atomic: an interrupted run does not corrupt the manifest
+
+
+def file_entry(fname, manifest):
+    '''Manifest entry of fname. The hash is reused from the manifest if size and mtime did not change.'''
+    st = os.stat(fname)
+    entry = {'size': st.st_size, 'mtime': st.st_mtime}
+    old_entry = manifest.get(os.path.abspath(fname), {})
+    if old_entry.get('size') == entry['size'] and old_entry.get('mtime') == entry['mtime']:
+        entry['hash'] = old_entry['hash']
+    else:
+        entry['hash'] = file_hash(fname)
+    return entry
+
+
+def cached_check(fname, check_fct, manifest, version=None):
+    '''
+    Return (result of check_fct(fname), new manifest entry of fname).
+
+    The result stored in the manifest is reused if the file content did not change, and if it was computed with
+    the same version of the check (e.g. code_version of its source files).
+    '''
+    entry = file_entry(fname, manifest)
+    old_entry = manifest.get(os.path.abspath(fname), {})
+    entry['verdicts'] = dict(old_entry.get('verdicts', {})) if old_entry.get('hash') == entry['hash'] else {}
+
+    check_name = check_fct.__name__ if version is None else check_fct.__name__ + ':' + version
+    if check_name not in entry['verdicts']:
+        for key in [k for k in entry['verdicts'] if k.split(':')[0] == check_fct.__name__]:  # other versions
+            del entry['verdicts'][key]
+        entry['verdicts'][check_name] = check_fct(fname)
+    return entry['verdicts'][check_name], entry
+
+
+def fingerprint(fname_lst, manifest):
+    '''
+    Return {absolute path: hash, None if the file does not exist} for the files of fname_lst.
+
+    The entries of these files in manifest are updated.
+    '''
+    fingerprint_dct = {}
+    for fname in fname_lst:
+        path = os.path.abspath(fname)
+        if os.path.isfile(fname):
+            manifest[path] = file_entry(fname, manifest)
+            fingerprint_dct[path] = manifest[path]['hash']
+        else:
+            fingerprint_dct[path] = None
+    return fingerprint_dct
+
+
+def code_version(fname_lst):
+    '''sha1 of the content of the source files fname_lst.'''
+    sha = hashlib.sha1()
+    for fname in fname_lst:
+        sha.update(file_hash(fname).encode('ascii'))
+    return sha.hexdigest()
+
+
+def is_up_to_date(fname_out, fname_in_lst):
+    '''True if fname_out exists and is not older than any of the existing files of fname_in_lst.'''
+    if not os.path.isfile(fname_out):
+        return False
+    t_out = os.path.getmtime(fname_out)
+    return all([os.path.getmtime(f) <= t_out for f in fname_in_lst if os.path.isfile(f)])
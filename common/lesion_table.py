@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Goal: Describe each lesion of a lesion mask, to run lesion-level analyses without re-reading the volumes.
+#
+# The lesions are labelled once (connected components), then each lesion is described within its bounding box:
+# - n_voxels, volume [mm3]
+# - centroid_x, centroid_y, centroid_z: centroid in the native space (voxel coordinates, RPI)
+# - centroid_template_x, _y, _z: centroid of the lesion label warped to the template space (voxel coordinates, RPI),
+#   nan if the lesion vanished during the warping
+# - z_min, z_max: z-extent in the native space (voxel coordinates, RPI)
+# - overlap_<roi>: fraction of the lesion volume in the ROI
+# The table is saved as one compressed array per column (npz file), see load_lesion_table.
+#
+# Created: 2026-10-18
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import find_objects
+from skimage.measure import label
+
+from spinalcordtoolbox.image import Image, zeros_like
+
+COLUMN_LST = ['subject', 'image', 'lesion_id', 'n_voxels', 'volume',
+                'centroid_x', 'centroid_y', 'centroid_z',
+                'centroid_template_x', 'centroid_template_y', 'centroid_template_z',
+                'z_min', 'z_max']
+
+
+def label_lesions(lesion_data):
+    '''Connected components of the lesion mask: return (label data, number of lesions).'''
+    return label((lesion_data > 0).astype(np.int_), neighbors=8, return_num=True)
+
+
+def save_label_image(label_data, fname_ref, fname_out, bbox=None):
+    '''Save label_data (RPI) with the header of fname_ref reoriented to RPI, in the box bbox (slices) of the image if set.'''
+    o_im = zeros_like(Image(fname_ref).change_orientation('RPI'))
+    if bbox is None:
+        o_im.data = label_data
+    else:
+        o_im.data = np.zeros(o_im.data.shape[:3], dtype=np.int32)
+        o_im.data[bbox] = label_data
+    o_im.change_type(type='int32')
+    o_im.save(fname_out)
+    del o_im
+
+
+def label_centroids(label_data, n_lesion):
+    '''Centroid of each label 1..n_lesion, array (n_lesion, 3), nan for the missing labels.'''
+    idx_lst = np.nonzero(label_data)
+    label_lst = label_data[idx_lst].astype(np.int64)
+    count_arr = np.bincount(label_lst, minlength=n_lesion+1)[1:n_lesion+1].astype(np.float64)
+    centroid_arr = np.zeros((n_lesion, 3))
+    for dim in range(3):
+        sum_arr = np.bincount(label_lst, weights=idx_lst[dim], minlength=n_lesion+1)[1:n_lesion+1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid_arr[:, dim] = sum_arr / count_arr
+    return centroid_arr
+
+
+def lesion_rows(label_data, n_lesion, roi_dct, vox_vol, subject, image, label_template_data=None, offset=(0, 0, 0)):
+    '''
+    One dict per lesion of label_data (see the columns above), with the overlap with each ROI of roi_dct {roi: data}.
+
+    offset: index in the native image of the first voxel of label_data (if label_data is a crop of the image).
+    '''
+    if label_template_data is None:
+        centroid_template_arr = np.nan * np.zeros((n_lesion, 3))
+    else:
+        centroid_template_arr = label_centroids(label_template_data, n_lesion)
+
+    row_lst = []
+    for i_lesion, bbox in enumerate(find_objects(label_data, max_label=n_lesion)):
+        lesion_id = i_lesion + 1
+        if bbox is None:
+            continue
+        lesion_data = label_data[bbox] == lesion_id
+        idx_lst = np.nonzero(lesion_data)
+        n_voxels = len(idx_lst[0])
+
+        row = {'subject': subject, 'image': image, 'lesion_id': lesion_id,
+                'n_voxels': n_voxels, 'volume': n_voxels * vox_vol,
+                'z_min': bbox[2].start + offset[2], 'z_max': bbox[2].stop - 1 + offset[2]}
+        for dim, axis in enumerate(['x', 'y', 'z']):
+            row['centroid_'+axis] = np.mean(idx_lst[dim]) + bbox[dim].start + offset[dim]
+            row['centroid_template_'+axis] = centroid_template_arr[i_lesion, dim]
+        for roi in roi_dct:
+            row['overlap_'+roi] = np.sum(roi_dct[roi][bbox][lesion_data]) * 1.0 / n_voxels
+        row_lst.append(row)
+
+    return row_lst
+
+
+def save_lesion_table(row_lst, fname, column_lst):
+    '''Save the rows (list of dict) as one compressed array per column of column_lst.'''
+    np.savez_compressed(fname, **dict((col, np.array([row[col] for row in row_lst])) for col in column_lst))
+
+
+def load_lesion_table(fname, column_lst=None):
+    '''Load the lesion table fname (or only its columns column_lst) as a pandas DataFrame.'''
+    npz = np.load(fname)
+    column_lst = npz.files if column_lst is None else column_lst
+    df = pd.DataFrame(dict((col, npz[col]) for col in column_lst), columns=column_lst)
+    npz.close()
+    return df
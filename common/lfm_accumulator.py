@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Goal: Accumulate the subject masks of a Lesion Frequency Map in memory.
+#
+# Each mask is read once and added to an array in memory, and the sum and LFM volumes are written once at the end,
+# instead of reading, updating and rewriting the (compressed) sum files for each subject.
+# The sums are counts (uint16, or uint32 for more than 65535 masks) when the masks are stored as integers, and float32
+# otherwise, which is the case of the template-space masks warped with a linear interpolation. The type is read from
+# the header of the first mask, and the counts are converted to float32 if a later mask is stored as floats.
+# The sums take 2 volumes per group (lesion, tissue): in float32, about 58 MB in the MNI space (182x218x182) and
+# 175 MB in the PAM50 space (141x141x1100) per group, plus the mask being read.
+# sum_masks_groups does the same for several groups of subjects (e.g. LFM subgroups) in a single pass:
+# each mask is read once and added to the accumulators of all the groups of the subject.
+# sum_masks_sharded splits the subjects in shards of SHARD_SIZE, summed by a pool of worker processes (the reading of
+# the compressed masks being the bottleneck): the shard sums are reduced in the order of the shards, so that the result
+# does not depend on the number of workers.
+#
+# Created: 2026-10-18
+
+import multiprocessing
+import numpy as np
+
+from spinalcordtoolbox.image import Image, zeros_like
+
+from common.nifti_stream import read_header
+
+SHARD_SIZE = 8  # number of subjects of each shard of sum_masks_sharded, independent of the number of workers
+
+
+def count_dtype(n_mask):
+    '''Unsigned integer type of the sum of n_mask binary masks.'''
+    return np.uint16 if n_mask <= np.iinfo(np.uint16).max else np.uint32
+
+
+def sum_dtype(fname_mask, n_mask):
+    '''Type of the sum of n_mask masks stored as fname_mask (header only): counts for integer types, float32 otherwise.'''
+    return count_dtype(n_mask) if read_header(fname_mask)['dtype'].kind in 'biu' else np.float32
+
+
+def pair_sum_dtypes(pair_lst):
+    '''{'lesion': type, 'tissue': type} of the sums of the masks of pair_lst, from the headers of its first pair.'''
+    if not len(pair_lst):
+        return {'lesion': count_dtype(0), 'tissue': count_dtype(0)}
+    return {'lesion': sum_dtype(pair_lst[0][0], len(pair_lst)), 'tissue': sum_dtype(pair_lst[0][1], len(pair_lst))}
+
+
+def promote_sum(sum_data, mask_data, float_dtype=np.float32):
+    '''
+    Return (sum_data, mask_data) converted to a common type, to add or subtract mask_data to sum_data in place.
+
+    The counts of sum_data are converted to float_dtype if mask_data is stored as floats (type only, the values are
+    not read).
+    '''
+    mask_data = np.asarray(mask_data)
+    if sum_data.dtype.kind == 'u' and mask_data.dtype.kind not in 'biu':
+        sum_data = sum_data.astype(float_dtype)
+    return sum_data, mask_data.astype(sum_data.dtype, copy=False)
+
+
+def _sum_pairs(pair_lst, shape, dtype_dct):
+    sum_dct = dict((name, np.zeros(shape, dtype=dtype_dct[name])) for name in ['lesion', 'tissue'])
+    for lesion_path, tissue_path in pair_lst:
+        for name, path in [('lesion', lesion_path), ('tissue', tissue_path)]:
+            mask_im = Image(path)
+            sum_dct[name], mask_data = promote_sum(sum_dct[name], mask_im.data)
+            del mask_im
+            sum_dct[name] += mask_data
+    return sum_dct['lesion'], sum_dct['tissue']
+
+
+def _sum_pairs_star(args):
+    return _sum_pairs(*args)
+
+
+def sum_masks(pair_lst, fname_ref):
+    '''
+    Voxel-wise sums of the masks of pair_lst, a list of (lesion mask path, tissue mask path), in the space of fname_ref.
+
+    Return (lesion sum, tissue sum), as counts or float32 arrays (see above).
+    '''
+    ref_im = Image(fname_ref)
+    shape = ref_im.data.shape
+    del ref_im
+    return _sum_pairs(pair_lst, shape, pair_sum_dtypes(pair_lst))
+
+
+def _reduce_shard(sum_dct, shard_lesion, shard_tissue):
+    for name, shard_data in [('lesion', shard_lesion), ('tissue', shard_tissue)]:
+        if shard_data.dtype != sum_dct[name].dtype:  # float32 shard
+            sum_dct[name] = sum_dct[name].astype(np.float32)
+        sum_dct[name] += shard_data
+
+
+def sum_masks_sharded(pair_lst, fname_ref, n_jobs):
+    '''Same as sum_masks, the shards of pair_lst being summed by n_jobs worker processes (see above).'''
+    ref_im = Image(fname_ref)
+    shape = ref_im.data.shape
+    del ref_im
+    dtype_dct = pair_sum_dtypes(pair_lst)  # the same for all the shards
+    sum_dct = dict((name, np.zeros(shape, dtype=dtype_dct[name])) for name in ['lesion', 'tissue'])
+
+    args_lst = [(pair_lst[i:i+SHARD_SIZE], shape, dtype_dct) for i in range(0, len(pair_lst), SHARD_SIZE)]
+    if n_jobs > 1 and len(args_lst) > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            # imap returns the shard sums in the order of the shards
+            for shard_lesion, shard_tissue in pool.imap(_sum_pairs_star, args_lst, chunksize=1):
+                _reduce_shard(sum_dct, shard_lesion, shard_tissue)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in args_lst:
+            _reduce_shard(sum_dct, *_sum_pairs(*args))
+
+    return sum_dct['lesion'], sum_dct['tissue']
+
+
+def sum_masks_groups(pair_lst, member_lst, n_group, fname_ref):
+    '''
+    Same as sum_masks for n_group groups of subjects, each mask being read once.
+
+    member_lst: for each (lesion mask path, tissue mask path) of pair_lst, the list of the indices of its groups.
+    Return (lesion sums, tissue sums), as counts or float32 arrays of shape (n_group, ...).
+    '''
+    ref_im = Image(fname_ref)
+    shape = (n_group,) + ref_im.data.shape
+    del ref_im
+    dtype_dct = pair_sum_dtypes(pair_lst)
+    sum_dct = dict((name, np.zeros(shape, dtype=dtype_dct[name])) for name in ['lesion', 'tissue'])
+
+    for (lesion_path, tissue_path), group_lst in zip(pair_lst, member_lst):
+        for name, path in [('lesion', lesion_path), ('tissue', tissue_path)]:
+            mask_im = Image(path)
+            sum_dct[name], mask_data = promote_sum(sum_dct[name], mask_im.data)
+            del mask_im
+            for i_group in group_lst:
+                sum_dct[name][i_group] += mask_data
+
+    return sum_dct['lesion'], sum_dct['tissue']
+
+
+def lfm_ratio(sum_lesion, sum_tissue):
+    '''Voxel-wise ratio lesion / tissue, with the same nan (0 / 0) and inf (x / 0) as sct_maths -div.'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.divide(sum_lesion, sum_tissue, dtype=np.float32)
+
+
+def save_volume(data, fname_ref, fname_out, data_type='float32'):
+    '''Save data with the header of fname_ref.'''
+    o_im = zeros_like(Image(fname_ref))
+    o_im.data = data
+    o_im.change_type(type=data_type)
+    o_im.save(fname_out)
+    del o_im
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Goal: Update the sums of a Lesion Frequency Map when subjects are added, removed or corrected, instead of
+# summing the masks of all the subjects again.
+#
+# The sums of each group of subjects (e.g. LFM subgroup) are saved in a folder as <group>.npz, with the path and the
+# content hash of the masks of each contributing subject (see fingerprint.py). On an update, the masks of the new and
+# modified subjects are added, and those of the removed subjects are subtracted, read from their path if their content
+# did not change. A group which included a mask modified or deleted since is summed again from the masks of all its
+# subjects: no copy of the masks is kept, at the cost of a full sum of the groups of a corrected subject.
+# All the groups are updated together: each mask is read once, and applied to all its groups.
+# The sums of masks stored as floats are float64 (float32 for the other LFM paths), so that repeated additions and
+# subtractions do not drift from a full sum. Those of masks stored as integers are exact counts.
+# Each group file is replaced atomically, with its sums and its subjects, so that an interrupted update can be rerun.
+#
+# Created: 2026-10-18
+
+import os
+import json
+import numpy as np
+
+from spinalcordtoolbox.image import Image
+
+from common.fingerprint import fingerprint
+from common.lfm_accumulator import promote_sum, count_dtype
+
+MANIFEST_FNAME = 'manifest.pkl'
+
+
+def _group_fname(ifolder, group):
+    return os.path.join(ifolder, group + '.npz')
+
+
+def load_group_members(ifolder, group):
+    '''{subject: [[lesion path, lesion hash], [tissue path, tissue hash]]} of the saved sums of group, empty if not saved yet.'''
+    if not os.path.isfile(_group_fname(ifolder, group)):
+        return {}
+    with np.load(_group_fname(ifolder, group)) as npz:
+        return json.loads(str(npz['members']))
+
+
+def load_group_sums(ifolder, group, shape):
+    '''Return (lesion sum, tissue sum) of group, zeros if not saved yet.'''
+    if not os.path.isfile(_group_fname(ifolder, group)):
+        return np.zeros(shape, dtype=count_dtype(0)), np.zeros(shape, dtype=count_dtype(0))
+    with np.load(_group_fname(ifolder, group)) as npz:
+        return npz['lesion'], npz['tissue']
+
+
+def save_group_sums(ofolder, group, sum_lesion, sum_tissue, member_dct):
+    fname_tmp = os.path.join(ofolder, group + '.tmp.npz')
+    np.savez_compressed(fname_tmp, lesion=sum_lesion, tissue=sum_tissue, members=np.array(json.dumps(member_dct)))
+    os.rename(fname_tmp, _group_fname(ofolder, group))  # atomic
+
+
+def _subtractable(path_hash_lst, manifest):
+    '''True if the masks of path_hash_lst [[path, hash], ...] still have this content, so that they can be subtracted.'''
+    if not all([os.path.isfile(path) for path, _ in path_hash_lst]):
+        return False
+    hash_dct = fingerprint([path for path, _ in path_hash_lst], manifest)
+    return all([hash_dct[os.path.abspath(path)] == mask_hash for path, mask_hash in path_hash_lst])
+
+
+def update_sums(ifolder, group_pair_dct, fname_ref, manifest):
+    '''
+    Update the saved sums of the groups of group_pair_dct {group: {subject: (lesion mask path, tissue mask path)}}.
+
+    Each mask to add or subtract is read once. The entries of the masks in manifest are updated.
+    Return {group: (lesion sum, tissue sum)} for the groups whose sums changed, as counts or float64 arrays.
+    '''
+    if not os.path.isdir(ifolder):
+        os.makedirs(ifolder)
+
+    # content hashes of the masks of each subject, computed once for all the groups
+    entry_dct = {}
+    for subject_pair_dct in group_pair_dct.values():
+        for subject, pair in subject_pair_dct.items():
+            if str(subject) not in entry_dct:
+                fingerprint_dct = fingerprint(pair, manifest)
+                entry_dct[str(subject)] = [[path, fingerprint_dct[os.path.abspath(path)]] for path in pair]
+
+    # (path, lesion / tissue index) of the masks to read: {mask: [(group, sign)]}
+    # a group which included a modified or deleted mask is summed again from all its masks
+    delta_dct, member_dct, rebuild_lst = {}, {}, []
+    for group in sorted(group_pair_dct):
+        member_dct[group] = dict((str(s), entry_dct[str(s)]) for s in group_pair_dct[group])
+        old_dct = load_group_members(ifolder, group)
+        remove_lst = [s for s in sorted(old_dct) if member_dct[group].get(s) != old_dct[s]]
+        add_lst = [s for s in sorted(member_dct[group]) if old_dct.get(s) != member_dct[group][s]]
+        if not all([_subtractable(old_dct[s], manifest) for s in remove_lst]):
+            rebuild_lst.append(group)
+            remove_lst, add_lst = [], sorted(member_dct[group])
+        for sign, s_lst, s_dct in [(-1, remove_lst, old_dct), (1, add_lst, member_dct[group])]:
+            for s in s_lst:
+                for i_mask, (path, _) in enumerate(s_dct[s]):
+                    delta_dct.setdefault((path, i_mask), []).append((group, sign))
+
+    changed_lst = sorted(set([g for op_lst in delta_dct.values() for g, _ in op_lst] + rebuild_lst))
+    if not len(changed_lst):
+        return {}
+
+    ref_im = Image(fname_ref)
+    shape = ref_im.data.shape
+    del ref_im
+    sum_dct = {}
+    for group in changed_lst:
+        dtype = count_dtype(len(member_dct[group]))
+        if group in rebuild_lst:
+            sum_dct[group] = [np.zeros(shape, dtype=dtype), np.zeros(shape, dtype=dtype)]
+            continue
+        sum_dct[group] = []
+        for sum_data in load_group_sums(ifolder, group, shape):
+            if sum_data.dtype.kind == 'u' and sum_data.dtype.itemsize < np.dtype(dtype).itemsize:  # more than 65535 subjects
+                sum_data = sum_data.astype(dtype)
+            sum_dct[group].append(sum_data)
+
+    # the masks to subtract are read first, so that the counts never go below 0
+    for path, i_mask in sorted(delta_dct, key=lambda k: (min([sign for _, sign in delta_dct[k]]), k)):
+        mask_im = Image(path)
+        mask_data = mask_im.data
+        del mask_im
+        for group, sign in delta_dct[(path, i_mask)]:
+            sum_dct[group][i_mask], group_mask_data = promote_sum(sum_dct[group][i_mask], mask_data, float_dtype=np.float64)
+            if sign > 0:
+                sum_dct[group][i_mask] += group_mask_data
+            else:
+                sum_dct[group][i_mask] -= group_mask_data
+
+    for group in changed_lst:
+        save_group_sums(ifolder, group, sum_dct[group][0], sum_dct[group][1], member_dct[group])
+    return dict((group, tuple(sum_dct[group])) for group in changed_lst)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Goal: Pack the template-space lesion and tissue (brain or cord) masks of all the subjects in a subject x voxel matrix,
+# to compute the Lesion Frequency Map of any selection of subjects without reading the masks again.
+#
+# The matrix is restricted to the support of the LFM (e.g. the voxels of the template brain) and stored in the CSR
+# format, one row per subject: the lesion masks as they are, the tissue masks as their complement (1 - mask, nonzero
+# only where the subject mask does not cover the support), so that both are mostly empty. The arrays are saved as
+# .npy files in a folder, with an info.json file, and are memory-mapped when loaded.
+# The LFM of a selection is then computed with two sparse matrix-vector products:
+# lesion sum = lesion^T . selection, tissue sum = n selected - (1 - tissue)^T . selection.
+#
+# Created: 2026-10-18
+
+import os
+import json
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from spinalcordtoolbox.image import Image
+
+from common.lfm_accumulator import lfm_ratio
+
+INFO_FNAME = 'info.json'
+ARRAY_LST = ['lesion_data', 'lesion_indices', 'lesion_indptr', 'tissue_data', 'tissue_indices', 'tissue_indptr',
+                'support', 'cst', 'has_mask']
+
+
+def _support_values(path, support_idx):
+    mask_im = Image(path)
+    values = np.asarray(mask_im.data).ravel()[support_idx].astype(np.float32)
+    del mask_im
+    return values
+
+
+def matrix_uptodate(ifolder, subject_lst, pair_lst):
+    '''True if the matrix of ifolder has been built with the same subjects and masks, all older than the matrix.'''
+    fname_info = os.path.join(ifolder, INFO_FNAME)
+    if not os.path.isfile(fname_info):
+        return False
+    with open(fname_info, 'r') as f:
+        info = json.load(f)
+    pair_lst = [list(pair) if pair is not None else None for pair in pair_lst]
+    if info['subjects'] != [str(s) for s in subject_lst] or info['pairs'] != pair_lst:
+        return False
+    t_matrix = os.path.getmtime(fname_info)
+    return all([os.path.getmtime(path) <= t_matrix for pair in pair_lst if pair is not None for path in pair])
+
+
+def build_lfm_matrix(subject_lst, pair_lst, support_data, cst_data, fname_ref, ofolder, zero_invalid=False):
+    '''
+    Build the matrix of the subjects of subject_lst in ofolder.
+
+    pair_lst: for each subject, (lesion mask path, tissue mask path) in the template space, None if one is missing.
+    support_data: voxels of the LFM, cst_data: voxels of the CST LFM, both in the space of fname_ref.
+    zero_invalid: if True, the undefined (nan, inf) and > 1 ratios are set to 0 by lfm_query.
+    '''
+    if not os.path.isdir(ofolder):
+        os.makedirs(ofolder)
+    fname_info = os.path.join(ofolder, INFO_FNAME)
+    if os.path.isfile(fname_info):  # the matrix is complete only once info.json is written
+        os.remove(fname_info)
+
+    support_idx = np.flatnonzero(support_data)
+    arr_dct = {'support': support_idx.astype(np.int64),
+                'cst': np.asarray(cst_data).ravel()[support_idx] > 0,
+                'has_mask': np.array([pair is not None for pair in pair_lst], dtype=np.bool_)}
+
+    for i_mask, name in enumerate(['lesion', 'tissue']):
+        data_lst, indices_lst, indptr_lst = [], [], [0]
+        for pair in pair_lst:
+            if pair is not None:
+                values = _support_values(pair[i_mask], support_idx)
+                if name == 'tissue':
+                    values = np.float32(1.0) - values
+                idx = np.flatnonzero(values)
+                data_lst.append(values[idx])
+                indices_lst.append(idx.astype(np.int32))
+                indptr_lst.append(indptr_lst[-1] + len(idx))
+            else:
+                indptr_lst.append(indptr_lst[-1])
+        arr_dct[name+'_data'] = np.concatenate(data_lst) if len(data_lst) else np.zeros(0, dtype=np.float32)
+        arr_dct[name+'_indices'] = np.concatenate(indices_lst) if len(indices_lst) else np.zeros(0, dtype=np.int32)
+        arr_dct[name+'_indptr'] = np.array(indptr_lst, dtype=np.int64)
+
+    for name in ARRAY_LST:
+        np.save(os.path.join(ofolder, name+'.npy'), arr_dct[name])
+
+    info = {'subjects': [str(s) for s in subject_lst],
+            'pairs': [list(pair) if pair is not None else None for pair in pair_lst],
+            'shape': [int(s) for s in np.shape(support_data)],
+            'ref': fname_ref,
+            'zero_invalid': bool(zero_invalid)}
+    with open(fname_info, 'w') as f:
+        json.dump(info, f)
+
+
+def load_lfm_matrix(ifolder):
+    '''Load the matrix of ifolder (memory-mapped), as a dict (see build_lfm_matrix).'''
+    with open(os.path.join(ifolder, INFO_FNAME), 'r') as f:
+        lfm_mat = json.load(f)
+    for name in ARRAY_LST:
+        lfm_mat[name] = np.load(os.path.join(ifolder, name+'.npy'), mmap_mode='r')
+
+    shape = (len(lfm_mat['subjects']), len(lfm_mat['support']))
+    for name in ['lesion', 'tissue']:
+        lfm_mat[name] = csr_matrix((lfm_mat[name+'_data'], lfm_mat[name+'_indices'], lfm_mat[name+'_indptr']), shape=shape)
+    return lfm_mat
+
+
+def select_subjects(lfm_mat, df, query=None):
+    '''
+    Boolean selection of the subjects of lfm_mat listed in df (e.g. the clinical csv, with a subject column),
+    optionally filtered by the pandas query string query (e.g. "age < 40 and disease_dur >= 5").
+    '''
+    if query is not None:
+        df = df.query(query)
+    subject_set = set([str(s) for s in df.subject])
+    return np.array([s in subject_set for s in lfm_mat['subjects']], dtype=np.bool_)
+
+
+def lfm_query(lfm_mat, selection):
+    '''
+    LFM and CST LFM of the subjects of the boolean selection (one value per subject of lfm_mat).
+
+    Return (LFM, CST LFM), as float32 arrays in the template space (0 outside the support).
+    '''
+    weight = (np.asarray(selection, dtype=np.bool_) & lfm_mat['has_mask']).astype(np.float64)
+    sum_lesion = lfm_mat['lesion'].T.dot(weight)
+    sum_tissue = np.sum(weight) - lfm_mat['tissue'].T.dot(weight)
+
+    ratio = lfm_ratio(sum_lesion, sum_tissue)
+    if lfm_mat['zero_invalid']:
+        with np.errstate(invalid='ignore'):
+            ratio[~np.isfinite(ratio) | (ratio > 1.0)] = 0.0
+
+    lfm_data = np.zeros(tuple(lfm_mat['shape']), dtype=np.float32)
+    lfm_cst_data = np.zeros(tuple(lfm_mat['shape']), dtype=np.float32)
+    lfm_data.flat[lfm_mat['support']] = ratio
+    lfm_cst_data.flat[lfm_mat['support'][lfm_mat['cst']]] = ratio[lfm_mat['cst']]
+    return lfm_data, lfm_cst_data
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Goal: Constant-memory reductions over (gzipped) NIfTI-1 volumes.
+#
+# The voxel data are decompressed and reduced chunk by chunk, so that the full array is never held in memory.
+# Available reductions:
+# - count_nonzero: number of non-zero voxels (with optional early exit)
+# - count_values: histogram of the voxel values
+# - is_binary: check if the volume is only made of 0 and 1 (early exit on the first other value)
+# - z_profile: number of non-zero voxels per z slice (in the voxel axes of the file, i.e. no reorientation)
+# and a header-only comparison of the voxel grid of two volumes (header_mismatch).
+#
+# Created: 2026-10-18
+
+import gzip
+import struct
+import numpy as np
+
+CHUNK_SIZE = 2 ** 20  # number of voxels decompressed at once
+
+NIFTI_DTYPE_DCT = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8',
+                    256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+
+def _open(fname):
+    return gzip.open(fname, 'rb') if fname.endswith('.gz') else open(fname, 'rb')
+
+
+def read_header(fname):
+    '''Read the NIfTI-1 header of fname, only the first 348 bytes are decompressed.'''
+    with _open(fname) as f:
+        hdr_bytes = f.read(348)
+
+    if len(hdr_bytes) != 348:
+        raise ValueError('Truncated NIfTI header: ' + fname)
+    if struct.unpack('<i', hdr_bytes[:4])[0] == 348:
+        endian = '<'
+    elif struct.unpack('>i', hdr_bytes[:4])[0] == 348:
+        endian = '>'
+    else:
+        raise ValueError('Not a NIfTI-1 file: ' + fname)
+
+    dim = struct.unpack(endian + '8h', hdr_bytes[40:56])
+    datatype = struct.unpack(endian + 'h', hdr_bytes[70:72])[0]
+    if datatype not in NIFTI_DTYPE_DCT:
+        raise ValueError('Unsupported NIfTI datatype (' + str(datatype) + '): ' + fname)
+
+    hdr = {'shape': tuple(dim[1:dim[0]+1]),
+            'dtype': np.dtype(endian + NIFTI_DTYPE_DCT[datatype]),
+            'pixdim': struct.unpack(endian + '8f', hdr_bytes[76:108]),
+            'vox_offset': int(struct.unpack(endian + 'f', hdr_bytes[108:112])[0]),
+            'scl_slope': struct.unpack(endian + 'f', hdr_bytes[112:116])[0],
+            'scl_inter': struct.unpack(endian + 'f', hdr_bytes[116:120])[0],
+            'qform_code': struct.unpack(endian + 'h', hdr_bytes[252:254])[0],
+            'sform_code': struct.unpack(endian + 'h', hdr_bytes[254:256])[0],
+            'quatern': struct.unpack(endian + '6f', hdr_bytes[256:280]),  # quatern_b, c, d, qoffset_x, y, z
+            'srow': struct.unpack(endian + '12f', hdr_bytes[280:328])}  # srow_x, srow_y, srow_z
+    return hdr
+
+
+def header_mismatch(hdr_ref, hdr, tol=1e-4):
+    '''
+    List of the header fields defining the voxel grid (shape, voxel size and orientation, qform and sform)
+    which differ between hdr and hdr_ref (both returned by read_header), floats being compared with the tolerance tol.
+    '''
+    mismatch_lst = []
+    if hdr['shape'][:3] != hdr_ref['shape'][:3]:
+        mismatch_lst.append('shape')
+    for key in ['qform_code', 'sform_code']:
+        if hdr[key] != hdr_ref[key]:
+            mismatch_lst.append(key)
+    for key, idx_lst in [('pixdim', range(4)), ('quatern', range(6)), ('srow', range(12))]:  # pixdim[0]: qfac
+        if not np.allclose([hdr[key][i] for i in idx_lst], [hdr_ref[key][i] for i in idx_lst], atol=tol):
+            mismatch_lst.append(key)
+    return mismatch_lst
+
+
+def voxel_volume(hdr):
+    '''Volume of one voxel in mm3.'''
+    return abs(hdr['pixdim'][1] * hdr['pixdim'][2] * hdr['pixdim'][3])
+
+
+def iter_chunks(fname, hdr=None, chunk_size=CHUNK_SIZE):
+    '''Yield (offset, data) where data is a flat chunk of the scaled voxel values, in the file (Fortran) order.'''
+    if hdr is None:
+        hdr = read_header(fname)
+    n_voxels = int(np.prod(hdr['shape']))
+    itemsize = hdr['dtype'].itemsize
+    # same convention as nibabel: no scaling if the slope is 0 or nan
+    slope, inter = hdr['scl_slope'], hdr['scl_inter']
+    inter = 0.0 if np.isnan(inter) else inter
+    scaling = slope != 0.0 and not np.isnan(slope) and (slope != 1.0 or inter != 0.0)
+
+    with _open(fname) as f:
+        f.read(hdr['vox_offset'])  # gzip files cannot seek backward, so skip the header by reading it
+        offset = 0
+        while offset < n_voxels:
+            n_cur = min(chunk_size, n_voxels - offset)
+            buf = f.read(n_cur * itemsize)
+            if len(buf) != n_cur * itemsize:
+                raise ValueError('Truncated NIfTI data: ' + fname)
+            data = np.frombuffer(buf, dtype=hdr['dtype'])
+            if scaling:
+                data = data * slope + inter
+            yield offset, data
+            offset += n_cur
+
+
+def count_nonzero(fname, max_count=None):
+    '''Number of non-zero voxels. If max_count is set, stop as soon as this number is exceeded.'''
+    count = 0
+    for _, data in iter_chunks(fname):
+        count += int(np.count_nonzero(data))
+        if max_count is not None and count > max_count:
+            break
+    return count
+
+
+def count_values(fname):
+    '''Histogram of the voxel values, returned as a dict {value: number of voxels}.'''
+    count_dct = {}
+    for _, data in iter_chunks(fname):
+        value_arr, count_arr = np.unique(data, return_counts=True)
+        for v, c in zip(value_arr.tolist(), count_arr.tolist()):
+            count_dct[v] = count_dct.get(v, 0) + c
+    return count_dct
+
+
+def is_binary(fname):
+    '''Check if the volume is only made of 0 and 1.'''
+    for _, data in iter_chunks(fname):
+        if not np.all((data == 0) | (data == 1)):
+            return False
+    return True
+
+
+def z_profile(fname):
+    '''Number of non-zero voxels per z slice (third voxel axis of the file), summed over the other axes.'''
+    hdr = read_header(fname)
+    shape = hdr['shape'] + (1,) * (3 - len(hdr['shape']))
+    slice_size, nz = shape[0] * shape[1], shape[2]
+
+    profile = np.zeros(nz, dtype=np.int64)
+    for offset, data in iter_chunks(fname, hdr=hdr):
+        z_idx = ((np.flatnonzero(data) + offset) // slice_size) % nz
+        profile += np.bincount(z_idx, minlength=nz)
+    return profile
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+#
+# Goal: Join the per-subject results returned by the quantification workers to the subject dataframe.
+#
+# Created: 2026-10-18
+
+import pandas as pd
+
+
+def join_records(subj_data_df, record_dct):
+    '''
+    Add the records {index: list of (column, value)} as float columns of subj_data_df, in the order of first appearance
+    (same columns and dtypes as assigning each value with .loc). The subjects without record get nan.
+    '''
+    col_lst = []
+    for index in subj_data_df.index:
+        for col, _ in record_dct.get(index, []):
+            if col not in col_lst:
+                col_lst.append(col)
+
+    value_dct = dict((col, {}) for col in col_lst)
+    for index in record_dct:
+        for col, value in record_dct[index]:
+            value_dct[col][index] = value
+    res_df = pd.DataFrame(dict((col, pd.Series(value_dct[col])) for col in col_lst), index=subj_data_df.index, columns=col_lst)
+
+    return subj_data_df.join(res_df.astype(float))
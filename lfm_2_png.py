@@ -17,9 +17,11 @@ from scipy.ndimage.morphology import binary_dilation
 from spinalcordtoolbox.image import Image
 
 from brain.config_file import config
+from brain.packed_atlas import load_packed_atlas, PACKED_ATLAS_FNAME
 
 path_smatt = '/Volumes/projects/ms_brain_spine/atlases/brain'
 path_brainstem = '/Volumes/projects/ms_brain_spine/atlases/brainstem'
+path_packed_atlas = os.path.join(config["path_atlases"], PACKED_ATLAS_FNAME)
 
 
 def load_data(path, thr_bin=0):
@@ -28,6 +30,13 @@ def load_data(path, thr_bin=0):
     del img
     return data
 
+
+def load_packed_data(roi_lst):
+    '''Sum of the binary masks of roi_lst, read from the packed atlas.'''
+    roi_dct = load_packed_atlas(path_packed_atlas, roi_lst=roi_lst, orientation='RPI')
+    return np.sum([roi_dct[roi] for roi in roi_lst], axis=0)
+
+
 def load_brain_brainstem_motor():
     # fname_M1_lst = ['Right-M1-S-MATT.nii', 'Left-M1-S-MATT.nii']
     fname_M1_lst = ['brain_M1_R.nii.gz', 'brain_M1_L.nii.gz',
@@ -39,8 +48,12 @@ def load_brain_brainstem_motor():
     fname_brainstem_lst = ['brainstem_CST_L.nii.gz', 'brainstem_CST_R.nii.gz']
     BRAMSTEM_ZTOP = 63
 
-    data_M1 = np.sum([load_data(os.path.join(path_smatt, f), thr_bin=0) for f in fname_M1_lst], axis=0)
-    data_brainstem = np.sum([load_data(os.path.join(path_brainstem, f), thr_bin=0.01) for f in fname_brainstem_lst], axis=0)
+    if config["packed_atlas"]:
+        data_M1 = load_packed_data([f.split('.nii.gz')[0] for f in fname_M1_lst])
+        data_brainstem = load_packed_data([f.split('.nii.gz')[0] for f in fname_brainstem_lst])
+    else:
+        data_M1 = np.sum([load_data(os.path.join(path_smatt, f), thr_bin=0) for f in fname_M1_lst], axis=0)
+        data_brainstem = np.sum([load_data(os.path.join(path_brainstem, f), thr_bin=0.01) for f in fname_brainstem_lst], axis=0)
 
     data_M1[:, :, :BRAMSTEM_ZTOP+1] = 0.0
     data_brainstem[:, :, BRAMSTEM_ZTOP+1:] = 0.0
@@ -55,8 +68,12 @@ def load_brain_brainstem_M1():
     fname_brainstem_lst = ['brainstem_CST_L.nii.gz', 'brainstem_CST_R.nii.gz']
     BRAMSTEM_ZTOP = 63
 
-    data_M1 = np.sum([load_data(os.path.join(path_smatt, f), thr_bin=0) for f in fname_M1_lst], axis=0)
-    data_brainstem = np.sum([load_data(os.path.join(path_brainstem, f), thr_bin=0.01) for f in fname_brainstem_lst], axis=0)
+    if config["packed_atlas"]:
+        data_M1 = load_packed_data([f.split('.nii.gz')[0] for f in fname_M1_lst])
+        data_brainstem = load_packed_data([f.split('.nii.gz')[0] for f in fname_brainstem_lst])
+    else:
+        data_M1 = np.sum([load_data(os.path.join(path_smatt, f), thr_bin=0) for f in fname_M1_lst], axis=0)
+        data_brainstem = np.sum([load_data(os.path.join(path_brainstem, f), thr_bin=0.01) for f in fname_brainstem_lst], axis=0)
     
     print(np.unique(data_M1[:,:,60]), np.unique(data_brainstem[:,:,60]))
     data_M1[:, :, :BRAMSTEM_ZTOP+1] = 0.0
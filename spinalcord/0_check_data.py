@@ -25,19 +25,22 @@ import os
 import pandas as pd
 import datetime
 import pickle
-import numpy as np
+import multiprocessing
 from skimage.measure import label
 from spinalcordtoolbox.image import Image
 
+from common.nifti_stream import is_binary, count_nonzero
+from common.fingerprint import load_manifest, save_manifest, cached_check, code_version
+
 from config_file import config
 
 
 def _check_sc_seg(fname):
     '''Check if the mask is only made of ones and only one connected object.'''
+    if not is_binary(fname):  # streamed, the full volume is only loaded for the connectivity check
+        return False
     i = Image(fname)
     check_bool = True
-    if not all([True if v in [0, 1] else False for v in np.unique(i.data)]):
-        check_bool = False
     if label(i.data, return_num=True)[1] != 1:
         check_bool = False
     del i
@@ -46,88 +49,129 @@ def _check_sc_seg(fname):
 
 def _check_lesion_seg(fname):
     '''Check if the mask is only made of ones.'''
-    i = Image(fname)
-    check_bool = True
-    if not all([True if v in [0, 1] else False for v in np.unique(i.data)]):
-        check_bool = False
-    del i
-    return check_bool
+    return is_binary(fname)
 
 
 def _check_label(fname):
     '''Check if the mask is only made of 2 voxels.'''
-    i = Image(fname)
-    check_bool = True
-    if len(np.where(i.data)[0]) != 2:
-        check_bool = False
-    del i
+    return count_nonzero(fname, max_count=2) == 2
+
+
+CHECK_CODE_FNAME_LST = ['0_check_data.py', '../common/nifti_stream.py']  # source files of the checks, see _init_worker
+
+_MANIFEST = {}  # manifest and version of the checks, shared by the workers (see _init_worker)
+_CHECK_VERSION = None
+
+
+def _init_worker(manifest, check_version):
+    '''Share the manifest with a worker once, instead of sending it with each subject.'''
+    global _MANIFEST, _CHECK_VERSION
+    _MANIFEST, _CHECK_VERSION = manifest, check_version
+
+
+def _cached_check(fname, check_fct, entry_dct):
+    '''Run check_fct on fname, unless its verdict is already in the manifest for the same file content and checks.'''
+    check_bool, entry_dct[os.path.abspath(fname)] = cached_check(fname, check_fct, _MANIFEST, version=_CHECK_VERSION)
     return check_bool
 
 
-def check_data(path_data, center_dct, subj_data_df):
+STG_LST = ['missing_subject', 'missing_img', 'missing_contrast', 'missing_sc', 'missing_lesion', 'missing_incorrect_labels', 'incorrect_sc', 'incorrect_lesion']
+
+
+def _check_subject(s_folder, center, center_dct):
+    '''
+    Check the files of one subject.
+
+    Return a dict with the missing or incorrect files (see STG_LST), and the manifest entries of the checked files.
+    '''
+    res_dct = dict((stg, []) for stg in STG_LST)
+    entry_dct = {}
+    if os.path.isdir(s_folder):
+        sc_folder = os.path.join(s_folder, 'spinalcord')
+        for c in center_dct[center]:
+            c_folder = os.path.join(sc_folder, c)
+            if os.path.isdir(c_folder):
+                c_img = os.path.join(c_folder, c + '.nii.gz')
+                c_seg = os.path.join(c_folder, c + '_seg_manual.nii.gz')
+                c_lesion = os.path.join(c_folder, c + '_lesion_manual.nii.gz')
+                c_labels = os.path.join(c_folder, 'labels_disc.nii.gz')
+                c_labels_vert = os.path.join(c_folder, 'labels_vert.nii.gz')
+                if not os.path.isfile(c_img):
+                    res_dct['missing_img'].append(os.path.abspath(c_img))
+
+                if os.path.isfile(c_seg):
+                    if not _cached_check(c_seg, _check_sc_seg, entry_dct):
+                        res_dct['incorrect_sc'].append(os.path.abspath(c_seg))
+                else:
+                    res_dct['missing_sc'].append(os.path.abspath(c_seg))
+
+                if os.path.isfile(c_lesion):
+                    if not _cached_check(c_lesion, _check_lesion_seg, entry_dct):
+                        res_dct['incorrect_lesion'].append(os.path.abspath(c_lesion))
+                else:
+                    res_dct['missing_lesion'].append(os.path.abspath(c_lesion))
+
+                if not os.path.isfile(c_labels) and not os.path.isfile(c_labels_vert):
+                    res_dct['missing_incorrect_labels'].append(os.path.abspath(c_labels))
+                else:
+                    c_labels = c_labels if os.path.isfile(c_labels) else c_labels_vert
+                    if not _cached_check(c_labels, _check_label, entry_dct):
+                        res_dct['missing_incorrect_labels'].append(os.path.abspath(c_labels))
+
+            else:
+                res_dct['missing_contrast'].append(c_folder)
+    else:
+        res_dct['missing_subject'].append(s_folder)
+
+    return res_dct, entry_dct
+
+
+def _check_subject_star(args):
+    return _check_subject(*args)
+
+
+def check_data(path_data, center_dct, subj_data_df, n_jobs=1, fname_manifest=None):
     '''
     Goal: Identify subjects of interest and check if required files are available and correct.
 
+    Subjects are checked in parallel if n_jobs > 1, results are merged in the csv order
+    so that the output is identical to the serial run.
+    If fname_manifest is provided, the verdicts of the files which did not change since the
+    previous run are read from this manifest instead of being re-computed.
+
     Save lists of missing or incrorrect files/folders as pickle files.
     '''
-    missing_subject, missing_img, missing_contrast = [], [], []
-    missing_sc, missing_lesion, missing_incorrect_labels = [], [], []
-    incorrect_sc, incorrect_lesion = [], []
+    manifest = load_manifest(fname_manifest) if fname_manifest is not None else {}
+    path_code = os.path.dirname(os.path.abspath(__file__))
+    check_version = code_version([os.path.join(path_code, f) for f in CHECK_CODE_FNAME_LST])
+    args_lst = [(os.path.join(path_data, s), center, center_dct) for s, center in zip(subj_data_df.subject.values, subj_data_df.center.values)]
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(manifest, check_version))
+        try:
+            res_lst = pool.map(_check_subject_star, args_lst, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(manifest, check_version)
+        res_lst = [_check_subject(*args) for args in args_lst]
+
+    lst_dct = dict((stg, []) for stg in STG_LST)
     excluded_subject = []
-    for s, center, idx_s in zip(subj_data_df.subject.values, subj_data_df.center.values, subj_data_df.index.values):
-        s_folder = os.path.join(path_data, s)
-        if os.path.isdir(s_folder):
-            sc_folder = os.path.join(s_folder, 'spinalcord')
-            for c in center_dct[center]:
-                c_folder = os.path.join(sc_folder, c)
-                if os.path.isdir(c_folder):
-                    c_img = os.path.join(c_folder, c + '.nii.gz')
-                    c_seg = os.path.join(c_folder, c + '_seg_manual.nii.gz')
-                    c_lesion = os.path.join(c_folder, c + '_lesion_manual.nii.gz')
-                    c_labels = os.path.join(c_folder, 'labels_disc.nii.gz')
-                    c_labels_vert = os.path.join(c_folder, 'labels_vert.nii.gz')
-                    if not os.path.isfile(c_img):
-                        missing_img.append(os.path.abspath(c_img))
-                        excluded_subject.append(idx_s)
-                        
-                    if os.path.isfile(c_seg):
-                        if not _check_sc_seg(c_seg):
-                            incorrect_sc.append(os.path.abspath(c_seg))
-                            excluded_subject.append(idx_s)
-                    else:
-                        missing_sc.append(os.path.abspath(c_seg))
-                        excluded_subject.append(idx_s)
-
-                    if os.path.isfile(c_lesion):
-                        if not _check_lesion_seg(c_lesion):
-                            incorrect_lesion.append(os.path.abspath(c_lesion))
-                            excluded_subject.append(idx_s)               
-                    else:
-                        missing_lesion.append(os.path.abspath(c_lesion))
-                        excluded_subject.append(idx_s)
-
-                    if not os.path.isfile(c_labels) and not os.path.isfile(c_labels_vert):
-                        missing_incorrect_labels.append(os.path.abspath(c_labels))
-                        excluded_subject.append(idx_s)
-                    else:
-                        c_labels = c_labels if os.path.isfile(c_labels) else c_labels_vert
-                        if not _check_label(c_labels):
-                            missing_incorrect_labels.append(os.path.abspath(c_labels))
-                            excluded_subject.append(idx_s)
-                    
-                else:
-                    missing_contrast.append(c_folder)
-                    excluded_subject.append(idx_s)
-        else:
-            missing_subject.append(s_folder)
+    for idx_s, (res_dct, entry_dct) in zip(subj_data_df.index.values, res_lst):
+        manifest.update(entry_dct)
+        for stg in STG_LST:
+            lst_dct[stg] += res_dct[stg]
+        if any([len(res_dct[stg]) for stg in STG_LST]):
             excluded_subject.append(idx_s)
 
+    if fname_manifest is not None:
+        save_manifest(manifest, fname_manifest)
+
     date_time_stg = datetime.datetime.now().strftime("%Y%m%d%H%M")
-    stg_lst = ['missing_subject', 'missing_img', 'missing_contrast', 'missing_sc', 'missing_lesion', 'missing_incorrect_labels', 'incorrect_sc', 'incorrect_lesion']
-    lst_lst = [missing_subject, missing_img, missing_contrast, missing_sc, missing_lesion, missing_incorrect_labels, incorrect_sc, incorrect_lesion]
-    for stg, lst in zip(stg_lst, lst_lst):
-        if len(lst):
-            dct = {stg: lst}
+    for stg in STG_LST:
+        if len(lst_dct[stg]):
+            dct = {stg: lst_dct[stg]}
             with open(date_time_stg + '_' + stg + '.pkl', 'wb') as f:
                 pickle.dump(dct, f)
 
@@ -143,7 +187,9 @@ def main(args=None):
 
     subj_check_df = check_data(path_data=path_data,
                                 center_dct=center_dct,
-                                subj_data_df=subj_data_df)
+                                subj_data_df=subj_data_df,
+                                n_jobs=config["n_jobs"],
+                                fname_manifest='0_manifest.pkl')
 
     subj_check_df.to_pickle('0_results.pkl')
 
@@ -10,49 +10,82 @@
 # Contributors: Charley Gros
 
 import os
+import shutil
 import pandas as pd
-import numpy as np
 import commands
+import datetime
+import pickle
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
 
+from common.nifti_stream import read_header, header_mismatch
+from vertebral_levels import level_index
 from config_file import config
 
 PARAM_REG = 'step=1,type=seg,algo=centermass,metric=MeanSquares,slicewise=1:step=2,type=seg,algo=bsplinesyn,metric=MeanSquares,slicewise=1,iter=3'
 
-def register_to_template(img_path, sc_path, contrast, label_path, label_flag, ofolder, qc_folder):
+def copy_header(img_path, fname, data_type=None):
+    '''Save the data of fname with the header of img_path.'''
+    im_ana, im = Image(img_path), Image(fname)
+    im_new = im_ana.copy() # copy hdr
+    im_new.data = im.data
+    if data_type is not None:
+        im_new.change_type(type=data_type)
+    im_new.save(fname)
 
-    registration_status = 1
 
+def preflight_header(img_path, sc_path, label_path):
+    '''
+    Compare the headers of the segmentation and label images with the header of the anatomical image (header-only read),
+    and copy the anatomical header on the mismatching ones.
+
+    Return (list of the repaired files, list of (file, reason) of the files which could not be repaired: different shape
+    or unreadable header).
+    '''
     try:
-        sct.run(['sct_register_to_template', '-i', img_path,
+        hdr_ana = read_header(img_path)
+    except (ValueError, IOError) as e:
+        return [], [(img_path, str(e))]
+
+    repaired_lst, failed_lst = [], []
+    for fname, data_type in [(sc_path, None), (label_path, 'uint8')]:
+        try:
+            mismatch_lst = header_mismatch(hdr_ana, read_header(fname))
+        except (ValueError, IOError) as e:
+            failed_lst.append((fname, str(e)))
+            continue
+        if 'shape' in mismatch_lst:
+            sct.printv('WARNING: Shape mismatch with the anat. image, header not repaired! Path: %s' % fname)
+            failed_lst.append((fname, 'shape mismatch with the anat. image'))
+        elif len(mismatch_lst):
+            copy_header(img_path, fname, data_type)
+            repaired_lst.append(fname)
+    return repaired_lst, failed_lst
+
+
+def register_to_template(img_path, sc_path, contrast, label_path, label_flag, ofolder, qc_folder, preflight=False):
+    '''
+    If preflight is False, the headers are only repaired (see preflight_header) after a failed registration, which is then re-run.
+    '''
+    registration_status = 1
+
+    cmd_lst = ['sct_register_to_template', '-i', img_path,
                                             '-s', sc_path,
                                             '-c', contrast,
                                             label_flag, label_path,
                                             '-param', PARAM_REG,
                                             '-ofolder', ofolder,
-                                            '-qc', qc_folder])
+                                            '-qc', qc_folder]
+    try:
+        sct.run(cmd_lst)
     except:
-        im_ana, im_seg = Image(img_path), Image(sc_path)
-        im_seg_new = im_ana.copy() # copy hdr --> segmentation
-        im_seg_new.data = im_seg.data
-        im_seg_new.save(sc_path)
-
-        im_labels = Image(label_path)
-        im_labels_new = im_ana.copy() # copy hdr --> labels
-        im_labels_new.data = im_labels.data 
-        im_labels_new.change_type(type='uint8')
-        im_labels_new.save(label_path)
-
         try: # re-run
-            sct.run(['sct_register_to_template', '-i', img_path,
-                                                '-s', sc_path,
-                                                '-c', contrast,
-                                                label_flag, label_path,
-                                                '-param', PARAM_REG,
-                                                '-ofolder', ofolder,
-                                                '-qc', qc_folder])
+            if preflight: # headers already checked: genuine registration failure
+                raise
+            copy_header(img_path, sc_path)
+            copy_header(img_path, label_path, 'uint8')
+            sct.run(cmd_lst)
         except:
             registration_status = 0
             sct.printv('ERROR: Could not complete registration for anat. --> template! Path: %s' % img_path)
@@ -68,8 +101,49 @@ def warp_template(dest_img, warping_field, ofolder, qc_folder):
                                     '-qc', qc_folder])
 
 
+def template_fname_lst():
+    '''Template files needed by the quantification (relative to the PAM50 folder), with their interpolation.'''
+    return [(os.path.join('template', 'PAM50_levels.nii.gz'), 'nn')] + \
+            [(os.path.join('atlas', fname), 'linear') for fname in sorted(config["dct_tracts"].values())]
+
+
+def template_warped(ofolder):
+    '''True if all the files of template_fname_lst are in ofolder.'''
+    return all([os.path.isfile(os.path.join(ofolder, fname)) for fname, _ in template_fname_lst()])
+
+
+def warp_template_selective(dest_img, warping_field, ofolder):
+    '''
+    Warp only the files of template_fname_lst, saved in ofolder with the same layout as sct_warp_template.
+
+    The files are warped in a temporary folder, renamed as ofolder once all of them are warped: a failed warp does not
+    leave a partly filled ofolder.
+    '''
+    path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50')
+    ofolder_tmp = ofolder + '_tmp'
+    if os.path.isdir(ofolder_tmp):  # left by an interrupted run
+        shutil.rmtree(ofolder_tmp)
+    for fname, interp in template_fname_lst():
+        ofname = os.path.join(ofolder_tmp, fname)
+        if not os.path.isdir(os.path.dirname(ofname)):
+            os.makedirs(os.path.dirname(ofname))
+        sct.run(['sct_apply_transfo', '-i', os.path.join(path_pam50, fname),
+                                        '-d', dest_img,
+                                        '-w', warping_field,
+                                        '-x', interp,
+                                        '-o', ofname])
+
+    if not template_warped(ofolder_tmp):
+        shutil.rmtree(ofolder_tmp)
+        return False
+    if os.path.isdir(ofolder):  # incomplete
+        shutil.rmtree(ofolder)
+    os.rename(ofolder_tmp, ofolder)
+    return True
+
+
 def exist_gap(lvl_filename_lst):
-    lvl_lvl_lst = [list(np.unique(Image(filename).data)) for filename in lvl_filename_lst]
+    lvl_lvl_lst = [level_index(filename)['values'] for filename in lvl_filename_lst]
     lvl_lst = list(set([int(l) for sublist in lvl_lvl_lst for l in sublist]))
     return sorted(lvl_lst) !=  range(min(lvl_lst), max(lvl_lst)+1)
 
@@ -95,7 +169,7 @@ def main(args=None):
     center_dct = config["dct_center"]
     path_qc = os.path.join(config["path_results"], 'qc')
 
-    excluded_subject, gap_subject_lst = [], []
+    excluded_subject, gap_subject_lst, repaired_subject_lst, header_failed_lst = [], [], [], []
     for index, row in subj_data_df.iterrows():
         image_lst = center_dct[row.center]
         subj_fold = os.path.join(path_data, row.subject, 'spinalcord')
@@ -104,56 +178,72 @@ def main(args=None):
             reg_status = 1
             subj_fold_qc = os.path.join(path_data, row.subject, row.subject+'_spinalcord') # Used to have the subject name in the QC
             os.rename(subj_fold, subj_fold_qc)
-            for img_prefixe in image_lst:
-                img_fold = os.path.join(subj_fold_qc, img_prefixe)
-                if os.path.isdir(img_fold):
-                    img_path = os.path.join(img_fold, img_prefixe + '.nii.gz')
-                    sc_path = os.path.join(img_fold, img_prefixe + '_seg_manual.nii.gz')
-                    label_path = os.path.join(img_fold, 'labels_disc.nii.gz')
-                    label_flag = '-ldisc'
-                    if not os.path.isfile(label_path):
-                        label_path = os.path.join(img_fold, 'labels_vert.nii.gz')
-                        label_flag = '-l'
-                    contrast = img_prefixe.split('_')[0]
-
-                    out_path = os.path.join(img_fold, 'template2anat.nii.gz')
-                    if not os.path.isfile(out_path):
-                        print row.subject, img_prefixe
-                        reg_status = register_to_template(img_path,
-                                                            sc_path,
-                                                            contrast,
-                                                            label_path,
-                                                            label_flag,
-                                                            img_fold,
-                                                            path_qc)
+            try:
+                for img_prefixe in image_lst:
+                    img_fold = os.path.join(subj_fold_qc, img_prefixe)
+                    if os.path.isdir(img_fold):
+                        img_path = os.path.join(img_fold, img_prefixe + '.nii.gz')
+                        sc_path = os.path.join(img_fold, img_prefixe + '_seg_manual.nii.gz')
+                        label_path = os.path.join(img_fold, 'labels_disc.nii.gz')
+                        label_flag = '-ldisc'
+                        if not os.path.isfile(label_path):
+                            label_path = os.path.join(img_fold, 'labels_vert.nii.gz')
+                            label_flag = '-l'
+                        contrast = img_prefixe.split('_')[0]
+
+                        out_path = os.path.join(img_fold, 'template2anat.nii.gz')
+                        if not os.path.isfile(out_path):
+                            print row.subject, img_prefixe
+                            if config["header_preflight"]:
+                                repaired_lst, failed_lst = preflight_header(img_path, sc_path, label_path)
+                                if len(repaired_lst):
+                                    repaired_subject_lst.append(row.subject+' '+img_prefixe)
+                                if len(failed_lst):  # not registered: the headers cannot be trusted
+                                    header_failed_lst += [(row.subject+' '+img_prefixe, fname, reason) for fname, reason in failed_lst]
+                                    reg_status = 0
+                                    continue
+                            reg_status = register_to_template(img_path,
+                                                                sc_path,
+                                                                contrast,
+                                                                label_path,
+                                                                label_flag,
+                                                                img_fold,
+                                                                path_qc,
+                                                                preflight=config["header_preflight"])
                         
-                    atlas_path = os.path.join(img_fold, 'label')
-                    warping_field_path = os.path.join(img_fold, 'warp_template2anat.nii.gz')
-                    if not os.path.isdir(atlas_path) and os.path.isfile(warping_field_path):
-                        warp_template(img_path,
-                                        warping_field_path,
-                                        atlas_path,
-                                        path_qc)
-                        if not os.path.isdir(atlas_path):
-                            reg_status = 0
-
-            if exist_gap([os.path.join(subj_fold_qc, img_prefixe, 'label', 'template', 'PAM50_levels.nii.gz') for img_prefixe in image_lst]):
-                gap_subject_lst.append(row.subject)
-
-            lesion_mask_path = os.path.join(subj_fold_qc, 'lesion_mask_template.nii.gz')
-            cord_mask_path = os.path.join(subj_fold_qc, 'cord_mask_template.nii.gz')
-            if not os.path.isfile(lesion_mask_path):
-                reg_status = merge_images_in_template(lesion_mask_path,
-                                                        subj_fold_qc,
-                                                        image_lst,
-                                                        'lesion_manual.nii.gz')
-            if not os.path.isfile(cord_mask_path):
-                reg_status = merge_images_in_template(cord_mask_path,
-                                                        subj_fold_qc,
-                                                        image_lst,
-                                                        'seg_manual.nii.gz')
-
-            os.rename(subj_fold_qc, subj_fold)
+                        atlas_path = os.path.join(img_fold, 'label')
+                        warping_field_path = os.path.join(img_fold, 'warp_template2anat.nii.gz')
+                        if not template_warped(atlas_path) and os.path.isfile(warping_field_path):
+                            if config["warp_template_selective"]:
+                                if not warp_template_selective(img_path,
+                                                                warping_field_path,
+                                                                atlas_path):
+                                    reg_status = 0
+                            else:
+                                warp_template(img_path,
+                                                warping_field_path,
+                                                atlas_path,
+                                                path_qc)
+                            if not template_warped(atlas_path):
+                                reg_status = 0
+
+                if exist_gap([os.path.join(subj_fold_qc, img_prefixe, 'label', 'template', 'PAM50_levels.nii.gz') for img_prefixe in image_lst]):
+                    gap_subject_lst.append(row.subject)
+
+                lesion_mask_path = os.path.join(subj_fold_qc, 'lesion_mask_template.nii.gz')
+                cord_mask_path = os.path.join(subj_fold_qc, 'cord_mask_template.nii.gz')
+                if not os.path.isfile(lesion_mask_path):
+                    reg_status = merge_images_in_template(lesion_mask_path,
+                                                            subj_fold_qc,
+                                                            image_lst,
+                                                            'lesion_manual.nii.gz')
+                if not os.path.isfile(cord_mask_path):
+                    reg_status = merge_images_in_template(cord_mask_path,
+                                                            subj_fold_qc,
+                                                            image_lst,
+                                                            'seg_manual.nii.gz')
+            finally:  # the folder is restored even if the registration of an image raised
+                os.rename(subj_fold_qc, subj_fold)
             if not reg_status:
                 excluded_subject.append(index)
 
@@ -164,5 +254,20 @@ def main(args=None):
         print '\n\nPlease check the following subjects, where we detected a gap in terms of vertebral distribution after registration on the PAM50 template.'
         print '\n\t- '.join(gap_subject_lst)
 
+    if len(repaired_subject_lst):
+        print '\n\nThe header of the segmentation and / or labels was replaced by the header of the image for the following images:'
+        print '\n\t- '.join(repaired_subject_lst)
+
+    if len(header_failed_lst):
+        print '\n\nThe header of the following files could not be repaired, the images were not registered:'
+        print '\n\t- '.join([img + ': ' + fname + ' (' + reason + ')' for img, fname, reason in header_failed_lst])
+
+    # same format as the lists of 0_check_data.py
+    date_time_stg = datetime.datetime.now().strftime("%Y%m%d%H%M")
+    for stg, lst in [('header_repaired', repaired_subject_lst), ('header_failed', header_failed_lst)]:
+        if len(lst):
+            with open(date_time_stg + '_' + stg + '.pkl', 'wb') as f:
+                pickle.dump({stg: lst}, f)
+
 if __name__ == "__main__":
     main()
@@ -22,30 +22,30 @@
 import os
 import pandas as pd
 import numpy as np
+import commands
+import multiprocessing
 from skimage.measure import label
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
 
+from common.fingerprint import load_manifest, save_manifest, fingerprint, code_version, is_up_to_date
+from csa import compute_csa, CSA_FNAME
+from vertebral_levels import level_index
+from common.records import join_records
+from common.lesion_table import label_lesions, save_label_image, lesion_rows, save_lesion_table, COLUMN_LST
 from config_file import config
 
-TRACTS_DCT = {'LCST-R': 'PAM50_atlas_05.nii.gz',
-                'LCST-L': 'PAM50_atlas_04.nii.gz',
-                'VCST-R': 'PAM50_atlas_23.nii.gz',
-                'VCST-L': 'PAM50_atlas_22.nii.gz'}
+TRACTS_DCT = config["dct_tracts"]
+LEVEL_DCT = dict((lvl, 'C'+str(lvl)) for lvl in range(1, 8))  # vertebral levels of the per-level table (PAM50 values)
 
+FNAME_CACHE = '2_cache.pkl'  # results and input fingerprints of each subject, see main
+CODE_FNAME_LST = ['2_quantify.py', '../common/lesion_table.py', '../common/records.py', 'csa.py', 'vertebral_levels.py']
 
-def z_slice_levels(levels_path):
-    levels_im = Image(levels_path)
-    levels_im.change_orientation('RPI')
-
-    lvl_dct = {}
-    for lvl in list(np.unique(levels_im.data)):
-        if lvl:
-            lvl_dct[lvl] = list(set(np.where(levels_im.data == lvl)[2]))
-    del levels_im
 
-    return lvl_dct
+def z_slice_levels(levels_path):
+    '''{level: list of the slices containing this level}, from the cached level index (see vertebral_levels.py).'''
+    return level_index(levels_path)['z_lst']
 
 
 def z_to_include(image_lst, subj_fold):
@@ -91,12 +91,29 @@ def removekey(d, key):
     return r
 
 
+def csa_pickle_path(img_fold):
+    '''CSA per slice table of img_fold, one file per config["csa_engine"].'''
+    if config["csa_engine"] == 'python':
+        return os.path.join(img_fold, 'csa', CSA_FNAME)
+    return os.path.join(img_fold, 'csa', 'csa_per_slice.pickle')  # sct_process_segmentation
+
+
+def csa_outdated(img_fold):
+    '''True if the CSA table of img_fold is missing, or older than the segmentation (e.g. after a correction).'''
+    sc_path = os.path.join(img_fold, img_fold.split('/')[-1] + '_seg_manual.nii.gz')
+    return not is_up_to_date(csa_pickle_path(img_fold), [sc_path])
+
+
 def compute_mean_csa(z_dct):
+    '''
+    Mean CSA over the slices of z_dct. The outdated tables of the python engine are computed from the segmentation
+    loaded by load_image_volumes (which must run first), those of sct_process_segmentation here.
+    '''
     csa_lst_lst = []
     for img_fold, z_min, z_max in zip(z_dct['img_fold_path'], z_dct['z_min'], z_dct['z_max']):
-        csa_pickle = os.path.join(img_fold, 'csa', 'csa_per_slice.pickle')
+        csa_pickle = csa_pickle_path(img_fold)
 
-        if not os.path.isfile(csa_pickle):
+        if config["csa_engine"] != 'python' and csa_outdated(img_fold):
             sc_path = os.path.join(img_fold, img_fold.split('/')[-1] + '_seg_manual.nii.gz')
             sct.run(['sct_process_segmentation', '-i', sc_path, '-p', 'csa', '-ofolder', os.path.join(img_fold, 'csa')])
 
@@ -107,68 +124,275 @@ def compute_mean_csa(z_dct):
     return np.mean([csa for sublst in csa_lst_lst for csa in sublst])
 
 
-def compute_lesion_characteristics(z_dct, roi_name=''):
-    count_lst, tlv_lst, sc_vol_lst = [], [], []
-    for img_fold, z_min, z_max in zip(z_dct['img_fold_path'], z_dct['z_min'], z_dct['z_max']):
-        sc_im = Image(os.path.join(img_fold, img_fold.split('/')[-1] + '_seg_manual.nii.gz')).change_orientation('RPI')
-        lesion_im = Image(os.path.join(img_fold, img_fold.split('/')[-1] + '_lesion_manual.nii.gz')).change_orientation('RPI')
-
-        sc_data = sc_im.data[:, :, z_min:z_max+1]
-        lesion_data = lesion_im.data[:, :, z_min:z_max+1]
-        res_x, res_y, res_z = lesion_im.dim[4:7]
-
+def load_image_volumes(img_fold, z_min, z_max, roi_name_lst, csa=False):
+    '''
+    Load once (RPI) the cord segmentation, the lesion mask and the tract atlases of roi_name_lst, cropped to
+    the bounding box of the cord and the lesions within z_min..z_max.
+    If csa is True, the CSA table (see csa.py) is computed from the full segmentation before it is cropped.
+
+    Return (sc_data, lesion_data, {roi_name: data, None if the atlas file does not exist}, voxel volume, bounding box),
+    the bounding box being given as slices in the z_min..z_max slab.
+    '''
+    data_lst = []
+    for suffixe in ['_seg_manual.nii.gz', '_lesion_manual.nii.gz']:
+        im = Image(os.path.join(img_fold, img_fold.split('/')[-1] + suffixe)).change_orientation('RPI')
+        res_x, res_y, res_z = im.dim[4:7]
+        if csa and suffixe == '_seg_manual.nii.gz':
+            compute_csa(im.data, (res_x, res_y, res_z), os.path.join(img_fold, 'csa'))
+        data_lst.append(im.data[:, :, z_min:z_max+1])
+        del im
+
+    idx_lst = np.nonzero((data_lst[0] > 0) | (data_lst[1] > 0))
+    if len(idx_lst[0]):
+        bbox = tuple([slice(np.min(idx), np.max(idx)+1) for idx in idx_lst])
+    else:
+        bbox = tuple([slice(0, 0)] * 3)
+    sc_data, lesion_data = data_lst[0][bbox], data_lst[1][bbox]
+
+    roi_dct = {}
+    for roi_name in roi_name_lst:
         roi_path = os.path.join(img_fold, 'label', 'atlas', roi_name)
+        roi_dct[roi_name] = None
         if os.path.isfile(roi_path):
             roi_im = Image(roi_path).change_orientation('RPI')
-            roi_data = roi_im.data[:, :, z_min:z_max+1]
-            sc_data = (sc_data * roi_data)
-            lesion_data = (lesion_data * roi_data)
-            lesion_threshold_indices = lesion_data > 0            
-            lesion_data[lesion_threshold_indices] = 1
-            sc_threshold_indices = sc_data > 0
-            sc_data[sc_threshold_indices] = 1
-            
+            roi_dct[roi_name] = roi_im.data[:, :, z_min:z_max+1][bbox]
             del roi_im
 
-        count_lst.append(label((lesion_data > 0).astype(np.int), neighbors=8, return_num=True)[1])
-        tlv_lst.append(np.sum(lesion_data) * res_x * res_y * res_z)
-        sc_vol_lst.append(np.sum(sc_data) * res_x * res_y * res_z)
+    return sc_data, lesion_data, roi_dct, res_x * res_y * res_z, bbox
+
+
+def roi_volumes(sc_data, lesion_data, roi_data):
+    '''Cord and lesion masks within the tract roi_data (binarized), unchanged if roi_data is None (full cord).'''
+    if roi_data is not None:
+        sc_data = (sc_data * roi_data)
+        lesion_data = (lesion_data * roi_data)
+        lesion_data[lesion_data > 0] = 1
+        sc_data[sc_data > 0] = 1
+    return sc_data, lesion_data
+
+
+def compute_lesion_characteristics(z_dct, roi_name_lst, volume_lst=None):
+    '''
+    Lesion count, lesion volume and cord volume in the full cord (roi_name '') and in each tract atlas of roi_name_lst,
+    computed from a single load of the volumes of each image (the full cord values are used if an atlas is missing).
+
+    volume_lst: output of load_image_volumes for each image of z_dct, if already loaded.
+    Return a dict {roi_name: (count, tlv, sc_vol)}.
+    '''
+    roi_name_lst = [''] + [r for r in roi_name_lst if r != '']
+    if volume_lst is None:
+        volume_lst = [load_image_volumes(img_fold, z_min, z_max, roi_name_lst[1:])
+                        for img_fold, z_min, z_max in zip(z_dct['img_fold_path'], z_dct['z_min'], z_dct['z_max'])]
+
+    res_lst_dct = dict((roi_name, ([], [], [])) for roi_name in roi_name_lst)
+    for sc_full_data, lesion_full_data, roi_dct, vox_vol, _ in volume_lst:
+
+        for roi_name in roi_name_lst:
+            sc_data, lesion_data = roi_volumes(sc_full_data, lesion_full_data, roi_dct.get(roi_name))
+
+            count_lst, tlv_lst, sc_vol_lst = res_lst_dct[roi_name]
+            count_lst.append(label((lesion_data > 0).astype(np.int), neighbors=8, return_num=True)[1] if lesion_data.size else 0)
+            tlv_lst.append(np.sum(lesion_data) * vox_vol)
+            sc_vol_lst.append(np.sum(sc_data) * vox_vol)
+
+    return dict((roi_name, tuple([sum(l) for l in res_lst_dct[roi_name]])) for roi_name in roi_name_lst)
+
+
+def compute_level_characteristics(z_dct, subject, volume_lst):
+    '''
+    Lesion count, lesion volume and cord volume per vertebral level (LEVEL_DCT) in the full cord and in each tract,
+    from the volumes loaded by load_image_volumes. Each slice is assigned to its dominant level (see vertebral_levels.py).
+
+    Return the rows (dict) of the long-format table: subject, level, roi, count, lv, vol.
+    '''
+    roi_lst = [('full', '')] + [(tract, TRACTS_DCT[tract]) for tract in sorted(TRACTS_DCT)]
+    res_dct = dict(((lvl, roi), [0, 0.0, 0.0]) for lvl in LEVEL_DCT for roi, _ in roi_lst)
+    for img_fold, z_min, (sc_full_data, lesion_full_data, roi_dct, vox_vol, bbox) in zip(z_dct['img_fold_path'], z_dct['z_min'], volume_lst):
+        z_dominant_dct = level_index(os.path.join(img_fold, 'label', 'template', 'PAM50_levels.nii.gz'))['z_dominant']
+        z_lvl_arr = np.array([z_dominant_dct.get(z + z_min, 0) for z in range(bbox[2].start, bbox[2].stop)], dtype=np.int64)
+
+        for roi, roi_name in roi_lst:
+            sc_data, lesion_data = roi_volumes(sc_full_data, lesion_full_data, roi_dct.get(roi_name))
+            for lvl in LEVEL_DCT:
+                z_lst = np.flatnonzero(z_lvl_arr == lvl)
+                if not len(z_lst):
+                    continue
+                lesion_lvl_data = lesion_data[:, :, z_lst[0]:z_lst[-1]+1] * (z_lvl_arr[z_lst[0]:z_lst[-1]+1] == lvl)
+                res = res_dct[(lvl, roi)]
+                res[0] += label((lesion_lvl_data > 0).astype(np.int), neighbors=8, return_num=True)[1]
+                res[1] += np.sum(lesion_lvl_data) * vox_vol
+                res[2] += np.sum(sc_data[:, :, z_lvl_arr == lvl]) * vox_vol
+
+    return [{'subject': subject, 'level': LEVEL_DCT[lvl], 'roi': roi,
+                'count': res_dct[(lvl, roi)][0], 'lv': res_dct[(lvl, roi)][1], 'vol': res_dct[(lvl, roi)][2]}
+            for lvl in sorted(LEVEL_DCT) for roi, _ in roi_lst]
+
+
+def compute_lesion_rows(z_dct, subject, volume_lst):
+    '''
+    Rows of the lesion table (see lesion_table.py) of one subject, from the volumes loaded by load_image_volumes.
+
+    The lesion labels are warped to the template space (nearest neighbour) to get the centroids in the template space,
+    and each lesion is assigned the dominant vertebral level of its centroid slice (0 if none).
+    '''
+    path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50/template/PAM50_t2.nii.gz')
+
+    row_lst = []
+    for img_fold, z_min, (sc_data, lesion_data, roi_dct, vox_vol, bbox) in zip(z_dct['img_fold_path'], z_dct['z_min'], volume_lst):
+        img_name = img_fold.split('/')[-1]
+        label_data, n_lesion = label_lesions(lesion_data)
+        offset = (bbox[0].start, bbox[1].start, bbox[2].start + z_min)
+
+        label_path = os.path.join(img_fold, img_name+'_lesion_label.nii.gz')
+        label_template_path = os.path.join(img_fold, img_name+'_lesion_label_template.nii.gz')
+        save_label_image(label_data, os.path.join(img_fold, img_name+'_lesion_manual.nii.gz'), label_path,
+                            bbox=tuple([slice(o, o + n) for o, n in zip(offset, label_data.shape)]))
+        sct.run(['sct_apply_transfo', '-i', label_path,
+                                        '-d', path_pam50,
+                                        '-w', os.path.join(img_fold, 'warp_anat2template.nii.gz'),
+                                        '-x', 'nn',
+                                        '-o', label_template_path])
+        label_template_im = Image(label_template_path).change_orientation('RPI')
+        label_template_data = label_template_im.data
+        del label_template_im
+
+        roi_overlap_dct = {'sc_full': sc_data}
+        for tract in TRACTS_DCT:
+            roi_data = roi_dct[TRACTS_DCT[tract]]
+            roi_overlap_dct['sc_'+tract] = np.nan * np.ones(sc_data.shape) if roi_data is None else roi_data
 
-        del sc_im, lesion_im
+        # dominant level of each slice, as in the per-level table (see compute_level_characteristics)
+        z_dominant_dct = level_index(os.path.join(img_fold, 'label', 'template', 'PAM50_levels.nii.gz'))['z_dominant']
 
-    count, tlv, sc_vol = sum(count_lst), sum(tlv_lst), sum(sc_vol_lst)
+        img_row_lst = lesion_rows(label_data, n_lesion, roi_overlap_dct, vox_vol, subject, img_name,
+                                    label_template_data=label_template_data, offset=offset)
+        for row in img_row_lst:
+            row['level'] = int(z_dominant_dct.get(int(round(row['centroid_z'])), 0))
+        row_lst += img_row_lst
 
-    return count, tlv, sc_vol
+    return row_lst
 
 
-def main(args=None):
+def subject_input_lst(subject, center):
+    '''Files the measures of a subject are derived from.'''
+    fname_lst = []
+    for img_prefixe in config["dct_center"][center]:
+        img_fold = os.path.join(config['path_data'], subject, 'spinalcord', img_prefixe)
+        fname_lst += [os.path.join(img_fold, img_prefixe+'_seg_manual.nii.gz'),
+                        os.path.join(img_fold, img_prefixe+'_lesion_manual.nii.gz'),
+                        os.path.join(img_fold, 'label', 'template', 'PAM50_levels.nii.gz'),
+                        csa_pickle_path(img_fold)]
+        fname_lst += [os.path.join(img_fold, 'label', 'atlas', TRACTS_DCT[tract]) for tract in sorted(TRACTS_DCT)]
+        if config["lesion_table"]:
+            fname_lst.append(os.path.join(img_fold, 'warp_anat2template.nii.gz'))
+    return fname_lst
 
-    subj_data_df = pd.read_pickle('1_results.pkl')
 
-    path_data = config['path_data']
-    center_dct = config["dct_center"]
-    path_results_pkl = os.path.join(config["path_results"], 'spinalcord_results.pickle')
-    path_results_csv = os.path.join(config["path_results"], 'spinalcord_results.csv')
+def subject_fingerprint(subject, center, manifest, code):
+    '''Fingerprint of the inputs (files, options and code version) of a subject, see fingerprint.py.'''
+    return {'files': fingerprint(subject_input_lst(subject, center), manifest),
+            'options': (config["lesion_table"], sorted(TRACTS_DCT.items()), config["csa_engine"]),
+            'code': code}
 
-    for index, row in subj_data_df.iterrows():
-        image_lst = center_dct[row.center]
-        subj_fold = os.path.join(path_data, row.subject, 'spinalcord')
 
-        z_dct = z_to_include(image_lst, subj_fold)
-        print row.subject
+def quantify_subject(subject, center):
+    '''
+    Quantify one subject.
 
-        # csa
-        subj_data_df.loc[index, 'csa_sc'] = compute_mean_csa(z_dct)
+    Return (record, lesion rows, level rows) where record is the list of (column, value) of the subject, in the column order.
+    '''
+    image_lst = config["dct_center"][center]
+    subj_fold = os.path.join(config['path_data'], subject, 'spinalcord')
 
-        # lesion count, TLV, NLV
-        subj_data_df.loc[index, 'count_sc_full'], subj_data_df.loc[index, 'tlv_sc_full'], subj_data_df.loc[index, 'vol_sc_full'] = compute_lesion_characteristics(z_dct, roi_name='')
+    z_dct = z_to_include(image_lst, subj_fold)
+    print subject
 
-        # Per tract: lesion count, ALV, NLV
-        for tract in TRACTS_DCT:
-            subj_data_df.loc[index, 'count_sc_'+tract], subj_data_df.loc[index, 'alv_sc_'+tract], subj_data_df.loc[index, 'vol_sc_'+tract] = compute_lesion_characteristics(z_dct, roi_name=TRACTS_DCT[tract])
+    # the CSA tables of the python engine are computed from the segmentations loaded here
+    roi_name_lst = [TRACTS_DCT[tract] for tract in TRACTS_DCT]
+    volume_lst = [load_image_volumes(img_fold, z_min, z_max, roi_name_lst,
+                                        csa=config["csa_engine"] == 'python' and csa_outdated(img_fold))
+                    for img_fold, z_min, z_max in zip(z_dct['img_fold_path'], z_dct['z_min'], z_dct['z_max'])]
 
+    # csa
+    record, lesion_row_lst = [('csa_sc', compute_mean_csa(z_dct))], []
+    res_dct = compute_lesion_characteristics(z_dct, roi_name_lst, volume_lst=volume_lst)
+    level_row_lst = compute_level_characteristics(z_dct, subject, volume_lst)
+    if config["lesion_table"]:
+        lesion_row_lst = compute_lesion_rows(z_dct, subject, volume_lst)
+    del volume_lst
+
+    # lesion count, TLV, NLV
+    record += zip(['count_sc_full', 'tlv_sc_full', 'vol_sc_full'], res_dct[''])
+
+    # Per tract: lesion count, ALV, NLV
+    for tract in TRACTS_DCT:
+        record += zip(['count_sc_'+tract, 'alv_sc_'+tract, 'vol_sc_'+tract], res_dct[TRACTS_DCT[tract]])
+
+    return record, lesion_row_lst, level_row_lst
+
+
+def _quantify_subject_star(args):
+    return quantify_subject(*args)
+
+
+def main(args=None):
+
+    subj_data_df = pd.read_pickle('1_results.pkl')
+
+    path_results_pkl = os.path.join(config["path_results"], 'spinalcord_results.pickle')
+    path_results_csv = os.path.join(config["path_results"], 'spinalcord_results.csv')
+    path_lesion_table = os.path.join(config["path_results"], 'spinalcord_lesions.npz')
+    path_levels_pkl = os.path.join(config["path_results"], 'spinalcord_results_levels.pickle')
+    path_levels_csv = os.path.join(config["path_results"], 'spinalcord_results_levels.csv')
+
+    # Incremental run: only the subjects whose inputs changed since the last run are quantified
+    cache = load_manifest(FNAME_CACHE)
+    manifest, subj_cache_dct = cache.get('manifest', {}), cache.get('subjects', {})
+    path_code = os.path.dirname(os.path.abspath(__file__))
+    code = code_version([os.path.join(path_code, f) for f in CODE_FNAME_LST])
+
+    res_dct, args_lst = {}, []
+    for _, row in subj_data_df.iterrows():
+        subj_cache = subj_cache_dct.get(row.subject, {})
+        if subj_cache.get('fingerprint') == subject_fingerprint(row.subject, row.center, manifest, code):
+            res_dct[row.subject] = subj_cache['result']
+        else:
+            args_lst.append((row.subject, row.center))
+    print 'Subjects to quantify: '+str(len(args_lst))+' / '+str(len(subj_data_df))
+
+    # each subject is quantified in a worker, which returns its record
+    n_jobs = config["n_jobs"]
+    if n_jobs > 1 and len(args_lst) > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            new_res_lst = pool.map(_quantify_subject_star, args_lst, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        new_res_lst = [quantify_subject(*args) for args in args_lst]
+
+    # the fingerprint is computed after the run, as some inputs are created by the quantification (e.g. csa)
+    for (subject, center), res in zip(args_lst, new_res_lst):
+        res_dct[subject] = res
+        subj_cache_dct[subject] = {'fingerprint': subject_fingerprint(subject, center, manifest, code),
+                                    'result': res}
+    save_manifest({'manifest': manifest, 'subjects': subj_cache_dct}, FNAME_CACHE)
+
+    res_lst = [res_dct[subject] for subject in subj_data_df['subject']]
+    subj_data_df = join_records(subj_data_df, dict((index, res[0]) for index, res in zip(subj_data_df.index, res_lst)))
     subj_data_df.to_csv(path_results_csv)
     subj_data_df.to_pickle(path_results_pkl)
 
+    # Per vertebral level: long-format table
+    level_df = pd.DataFrame([r for res in res_lst for r in res[2]], columns=['subject', 'level', 'roi', 'count', 'lv', 'vol'])
+    level_df.to_csv(path_levels_csv)
+    level_df.to_pickle(path_levels_pkl)
+
+    if config["lesion_table"]:
+        lesion_row_lst = [r for res in res_lst for r in res[1]]
+        save_lesion_table(lesion_row_lst, path_lesion_table,
+                            COLUMN_LST + ['level', 'overlap_sc_full'] + ['overlap_sc_'+tract for tract in TRACTS_DCT])
+
 if __name__ == "__main__":
     main()
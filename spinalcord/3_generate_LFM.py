@@ -11,84 +11,190 @@ import pandas as pd
 import numpy as np
 import commands
 
-import sct_utils as sct
-from spinalcordtoolbox.image import Image, zeros_like
+from spinalcordtoolbox.image import Image
 
+from common.lfm_accumulator import sum_masks, sum_masks_sharded, sum_masks_groups, lfm_ratio, save_volume
+from common.lfm_matrix import matrix_uptodate, build_lfm_matrix, load_lfm_matrix, select_subjects, lfm_query
+from common.lfm_incremental import update_sums, load_group_sums, MANIFEST_FNAME
+from common.fingerprint import load_manifest, save_manifest
 from config_file import config
 
 
 TRACTS_LST = ['PAM50_atlas_05.nii.gz', 'PAM50_atlas_04.nii.gz', 'PAM50_atlas_23.nii.gz', 'PAM50_atlas_22.nii.gz']
 
+SUBGROUP_LST = ['all', 'rem', 'pro', 'CIS', 'RR', 'SP', 'PP', 'edss_low', 'edss_med', 'edss_high', 'edssPy_low', 'edssPy_med', 'edssPy_high']
 
-def clean_LFM(fname_out, fname_cord, fname_lvl):
-    img, cord, lvl = Image(fname_out), Image(fname_cord), Image(fname_lvl)
+
+def clean_LFM(lfm_data, fname_cord, fname_lvl):
+    cord, lvl = Image(fname_cord), Image(fname_lvl)
     cord_data, lvl_data = cord.data, lvl.data
     del cord, lvl
 
-    img.data[np.where(cord_data == 0)] = 0
+    lfm_data[np.where(cord_data == 0)] = 0
     z_top = np.max(list(set(np.where(lvl_data == 1)[2]))) + 1
     z_bottom = np.min(list(set(np.where(lvl_data == 7)[2])))
-    img.data[:, :, :z_bottom] = 0
-    img.data[:, :, z_top:] = 0
-    img.data[np.isnan(img.data)]=0.0
-    img.data[img.data>1.0]=0.0
+    lfm_data[:, :, :z_bottom] = 0
+    lfm_data[:, :, z_top:] = 0
+    lfm_data[np.isnan(lfm_data)]=0.0
+    lfm_data[lfm_data>1.0]=0.0
+    return lfm_data
 
-    img.save(fname_out)
-    del img
 
+def mask_CST(lfm_data, mask_lst):
+    lfm_cst_data = np.copy(lfm_data)
 
-def initialise_sumFile(fname_out, fname_standard):
-    img_out = zeros_like(Image(fname_standard))
-    img_out.save(fname_out)
-    del img_out
+    cst_mask_data = np.sum([Image(mask_fname).data for mask_fname in mask_lst], axis=0)
+    cst_mask_data = (cst_mask_data > 0.0).astype(np.int_)
 
+    lfm_cst_data[np.where(cst_mask_data == 0.0)] = 0.0
+    return lfm_cst_data
 
-def add_mask(fname_new, fname_out):
-    img_new, img_in = Image(fname_new), Image(fname_out)
-    img_out = zeros_like(img_in)
-    img_out.data = img_new.data + img_in.data
-    del img_new, img_in
-    img_out.save(fname_out)
-    del img_out
 
+def subject_mask_pair(row, path_data):
+    '''(lesion mask path, cord mask path) of the subject of row, in the PAM50 space, None if one of them is missing.'''
+    lesion_path = os.path.join(path_data, row.subject, 'spinalcord', 'lesion_mask_template.nii.gz')
+    cord_path = os.path.join(path_data, row.subject, 'spinalcord', 'cord_mask_template.nii.gz')
+    if os.path.isfile(lesion_path) and os.path.isfile(cord_path):
+        return lesion_path, cord_path
+    return None
 
-def mask_CST(fname_LFM, fname_LFM_CST, mask_lst):
-    img_lfm = Image(fname_LFM)
-    img_cst = zeros_like(img_lfm)
-    img_cst.data = img_lfm.data
-    del img_lfm
 
-    cst_mask_data = np.sum([Image(mask_fname).data for mask_fname in mask_lst], axis=0)
-    cst_mask_data = (cst_mask_data > 0.0).astype(np.int_)
+def write_LFM(sum_lesion, sum_cord, fname_out, fname_out_cst, path_pam50):
+    pam50_cord = os.path.join(path_pam50, 'template', 'PAM50_cord.nii.gz')
+    pam50_lvl = os.path.join(path_pam50, 'template', 'PAM50_levels.nii.gz')
 
-    img_cst.data[np.where(cst_mask_data == 0.0)] = 0.0
-    img_cst.save(fname_LFM_CST)
+    fname_out_lesion = fname_out.split('_LFM.nii.gz')[0] + '_sumLesion.nii.gz'
+    fname_out_cord = fname_out.split('_LFM.nii.gz')[0] + '_sumCord.nii.gz'
+    save_volume(sum_lesion, pam50_cord, fname_out_lesion)
+    save_volume(sum_cord, pam50_cord, fname_out_cord)
+
+    lfm_data = clean_LFM(lfm_ratio(sum_lesion, sum_cord), pam50_cord, pam50_lvl)
+    save_volume(lfm_data, pam50_cord, fname_out)
+    save_volume(mask_CST(lfm_data, [os.path.join(path_pam50, 'atlas', t) for t in TRACTS_LST]), pam50_cord, fname_out_cst)
 
 
 def generate_LFM(df, fname_out, fname_out_cst, path_data):
     path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50/')
     pam50_cord = os.path.join(path_pam50, 'template', 'PAM50_cord.nii.gz')
-    pam50_lvl = os.path.join(path_pam50, 'template', 'PAM50_levels.nii.gz')
-
-    fname_out_lesion = fname_out.split('_LFM.nii.gz')[0] + '_sumLesion.nii.gz'
-    fname_out_cord = fname_out.split('_LFM.nii.gz')[0] + '_sumCord.nii.gz'
-    initialise_sumFile(fname_out_lesion, pam50_cord)
-    initialise_sumFile(fname_out_cord, pam50_cord)
 
+    pair_lst = []
     for index, row in df.iterrows():
-        lesion_path = os.path.join(path_data, row.subject, 'spinalcord', 'lesion_mask_template.nii.gz')
-        cord_path = os.path.join(path_data, row.subject, 'spinalcord', 'cord_mask_template.nii.gz')
-        if os.path.isfile(lesion_path) and os.path.isfile(cord_path):
+        pair = subject_mask_pair(row, path_data)
+        if pair is not None:
             print row.subject
-            add_mask(lesion_path, fname_out_lesion)
-            add_mask(cord_path, fname_out_cord)
+            pair_lst.append(pair)
+
+    if config["lfm_sharded"]:
+        sum_lesion, sum_cord = sum_masks_sharded(pair_lst, pam50_cord, config["n_jobs"])
+    else:
+        sum_lesion, sum_cord = sum_masks(pair_lst, pam50_cord)
+    write_LFM(sum_lesion, sum_cord, fname_out, fname_out_cst, path_pam50)
+
 
-    sct.run(['sct_maths', '-i', fname_out_lesion,
-                         '-div', fname_out_cord,
-                         '-o', fname_out])
+def generate_LFM_subgroups(subj_data_df, subgroup_lst, fname_lst, path_data):
+    '''
+    Generate the LFMs of all the subgroups of subgroup_lst in a single pass over the subjects.
 
-    clean_LFM(fname_out, pam50_cord, pam50_lvl)
-    mask_CST(fname_out, fname_out_cst, [os.path.join(path_pam50, 'atlas', t) for t in TRACTS_LST])
+    fname_lst: (LFM path, CST LFM path) of each subgroup.
+    '''
+    path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50/')
+    pam50_cord = os.path.join(path_pam50, 'template', 'PAM50_cord.nii.gz')
+
+    # subject x subgroup membership
+    index_lst = [set(subgroup_df(subj_data_df, subgroup).index) for subgroup in subgroup_lst]
+
+    pair_lst, member_lst = [], []
+    for index, row in subj_data_df.iterrows():
+        group_lst = [i_group for i_group, group_index in enumerate(index_lst) if index in group_index]
+        pair = subject_mask_pair(row, path_data) if len(group_lst) else None
+        if pair is not None:
+            print row.subject
+            pair_lst.append(pair)
+            member_lst.append(group_lst)
+
+    sum_lesion, sum_cord = sum_masks_groups(pair_lst, member_lst, len(subgroup_lst), pam50_cord)
+    for i_group, (fname_out, fname_out_cst) in enumerate(fname_lst):
+        write_LFM(sum_lesion[i_group], sum_cord[i_group], fname_out, fname_out_cst, path_pam50)
+
+
+def update_matrix(subj_data_df, ofolder, path_data):
+    '''Build the subject x voxel matrix of all the subjects in ofolder if needed (see common/lfm_matrix.py), then load it.'''
+    path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50/')
+    pam50_cord = os.path.join(path_pam50, 'template', 'PAM50_cord.nii.gz')
+    pam50_lvl = os.path.join(path_pam50, 'template', 'PAM50_levels.nii.gz')
+
+    pair_lst = [subject_mask_pair(row, path_data) for index, row in subj_data_df.iterrows()]
+    if not matrix_uptodate(ofolder, list(subj_data_df.subject), pair_lst):
+        print('\nBuilding the subject x voxel matrix ('+str(len(subj_data_df.index))+' subjects).')
+        support_data = clean_LFM(np.ones(Image(pam50_cord).data.shape), pam50_cord, pam50_lvl)
+        cst_data = np.sum([Image(os.path.join(path_pam50, 'atlas', t)).data for t in TRACTS_LST], axis=0)
+        build_lfm_matrix(list(subj_data_df.subject), pair_lst, support_data, cst_data, pam50_cord, ofolder,
+                            zero_invalid=True)
+    return load_lfm_matrix(ofolder)
+
+
+def generate_LFM_matrix(lfm_mat, df, fname_out, fname_out_cst):
+    lfm_data, lfm_cst_data = lfm_query(lfm_mat, select_subjects(lfm_mat, df))
+    save_volume(lfm_data, lfm_mat['ref'], fname_out)
+    save_volume(lfm_cst_data, lfm_mat['ref'], fname_out_cst)
+
+
+def generate_LFM_incremental(subj_data_df, path_lfm_fold, path_data):
+    '''Update the sums of each subgroup with the added, removed or modified subjects (see common/lfm_incremental.py).'''
+    path_pam50 = os.path.join(commands.getstatusoutput('echo $SCT_DIR')[1], 'data/PAM50/')
+    pam50_cord = os.path.join(path_pam50, 'template', 'PAM50_cord.nii.gz')
+    path_sums = os.path.join(path_lfm_fold, 'spinalcord_sums')
+    manifest = load_manifest(os.path.join(path_sums, MANIFEST_FNAME))
+
+    group_pair_dct = {}
+    for subgroup in SUBGROUP_LST:
+        group_pair_dct[subgroup] = {}
+        for index, row in subgroup_df(subj_data_df, subgroup).iterrows():
+            pair = subject_mask_pair(row, path_data)
+            if pair is not None:
+                group_pair_dct[subgroup][row.subject] = pair
+
+    # each added or removed mask is read once for all the subgroups
+    sum_dct = update_sums(path_sums, group_pair_dct, pam50_cord, manifest)
+
+    for subgroup in SUBGROUP_LST:
+        path_lfm = os.path.join(path_lfm_fold, 'spinalcord_LFM_'+subgroup+'.nii.gz')
+        path_lfm_cst = os.path.join(path_lfm_fold, 'spinalcord_LFM_CST_'+subgroup+'.nii.gz')
+        if subgroup in sum_dct or not os.path.isfile(path_lfm) or not os.path.isfile(path_lfm_cst):
+            print('\nUpdating the LFM with '+subgroup+' subjects ('+str(len(group_pair_dct[subgroup]))+').')
+            if subgroup in sum_dct:
+                sum_lesion, sum_cord = sum_dct.pop(subgroup)
+            else:
+                sum_lesion, sum_cord = load_group_sums(path_sums, subgroup, Image(pam50_cord).data.shape)
+            write_LFM(sum_lesion, sum_cord, path_lfm, path_lfm_cst, path_pam50)
+
+    save_manifest(manifest, os.path.join(path_sums, MANIFEST_FNAME))
+
+
+def subgroup_df(subj_data_df, subgroup):
+    '''Subjects of the subgroup (see SUBGROUP_LST).'''
+    if subgroup == 'all':
+        return subj_data_df
+    elif subgroup == 'pro':
+        return subj_data_df[subj_data_df.phenotype.isin(['PP', 'SP'])]
+    elif subgroup == 'rem':
+        return subj_data_df[subj_data_df.phenotype.isin(['CIS', 'RR'])]
+    elif subgroup in ['CIS', 'RR', 'SP', 'PP']:
+        return subj_data_df[subj_data_df.phenotype == subgroup]
+    elif subgroup.startswith('edss_'):
+        if subgroup.endswith('low'):
+            return subj_data_df[subj_data_df.edss_M0 <= 2.5]
+        elif subgroup.endswith('high'):
+            return subj_data_df[subj_data_df.edss_M0 >= 6.0]
+        elif subgroup.endswith('med'):
+            return subj_data_df[(subj_data_df.edss_M0 < 6.0) & (subj_data_df.edss_M0 > 2.5)]
+    elif subgroup.startswith('edssPy_'):
+        if subgroup.endswith('low'):
+            return subj_data_df[subj_data_df.edss_py_M0 < 1.0]
+        elif subgroup.endswith('high'):
+            return subj_data_df[subj_data_df.edss_py_M0 >= 3.0]
+        elif subgroup.endswith('med'):
+            return subj_data_df[(subj_data_df.edss_py_M0 < 3.0) & (subj_data_df.edss_py_M0 >= 1.0)]
 
 
 def main(args=None):
@@ -100,35 +206,31 @@ def main(args=None):
     if not os.path.isdir(path_lfm_fold):
         os.makedirs(path_lfm_fold)
 
-    for subgroup in ['all', 'rem', 'pro', 'CIS', 'RR', 'SP', 'PP', 'edss_low', 'edss_med', 'edss_high', 'edssPy_low', 'edssPy_med', 'edssPy_high']:
+    if config["lfm_incremental"]:
+        generate_LFM_incremental(subj_data_df, path_lfm_fold, path_data)
+        return
+
+    lfm_mat = None
+    if config["lfm_matrix"]:
+        lfm_mat = update_matrix(subj_data_df, os.path.join(path_lfm_fold, 'spinalcord_matrix'), path_data)
+
+    todo_lst = []
+    for subgroup in SUBGROUP_LST:
         path_lfm = os.path.join(path_lfm_fold, 'spinalcord_LFM_'+subgroup+'.nii.gz')
         path_lfm_cst = os.path.join(path_lfm_fold, 'spinalcord_LFM_CST_'+subgroup+'.nii.gz')
-        if subgroup == 'all':
-            lfm_df = subj_data_df
-        elif subgroup == 'pro':
-            lfm_df = subj_data_df[subj_data_df.phenotype.isin(['PP', 'SP'])]
-        elif subgroup == 'rem':
-            lfm_df = subj_data_df[subj_data_df.phenotype.isin(['CIS', 'RR'])]
-        elif subgroup in ['CIS', 'RR', 'SP', 'PP']:
-            lfm_df = subj_data_df[subj_data_df.phenotype == subgroup]
-        elif subgroup.startswith('edss_'):
-            if subgroup.endswith('low'):
-                lfm_df = subj_data_df[subj_data_df.edss_M0 <= 2.5]
-            elif subgroup.endswith('high'):
-                lfm_df = subj_data_df[subj_data_df.edss_M0 >= 6.0]
-            elif subgroup.endswith('med'):
-                lfm_df = subj_data_df[(subj_data_df.edss_M0 < 6.0) & (subj_data_df.edss_M0 > 2.5)]
-        elif subgroup.startswith('edssPy_'):
-            if subgroup.endswith('low'):
-                lfm_df = subj_data_df[subj_data_df.edss_py_M0 < 1.0]
-            elif subgroup.endswith('high'):
-                lfm_df = subj_data_df[subj_data_df.edss_py_M0 >= 3.0]
-            elif subgroup.endswith('med'):
-                lfm_df = subj_data_df[(subj_data_df.edss_py_M0 < 3.0) & (subj_data_df.edss_py_M0 >= 1.0)]
+        lfm_df = subgroup_df(subj_data_df, subgroup)
 
         if not os.path.isfile(path_lfm) or not os.path.isfile(path_lfm_cst):
             print('\nGenerating the LFM with '+subgroup+' subjects ('+str(len(lfm_df.index))+').')
-            generate_LFM(lfm_df, path_lfm, path_lfm_cst, path_data)
+            if lfm_mat is not None:
+                generate_LFM_matrix(lfm_mat, lfm_df, path_lfm, path_lfm_cst)
+            elif config["lfm_single_pass"]:
+                todo_lst.append((subgroup, path_lfm, path_lfm_cst))
+            else:
+                generate_LFM(lfm_df, path_lfm, path_lfm_cst, path_data)
+
+    if len(todo_lst):
+        generate_LFM_subgroups(subj_data_df, [t[0] for t in todo_lst], [t[1:] for t in todo_lst], path_data)
 
 
 if __name__ == "__main__":
@@ -22,3 +22,40 @@ config["path_data"] = "/Volumes/projects/ms_brain_spine/data_processing/"
 config["csv_clinicalInfo"] = "/Volumes/projects/ms_brain_spine/clinical_data.csv"
 
 config["path_results"] = "/Volumes/projects/ms_brain_spine/results/"
+
+# Corticospinal tracts quantified, with their file in the PAM50 atlas
+config["dct_tracts"] = {'LCST-R': 'PAM50_atlas_05.nii.gz',
+                        'LCST-L': 'PAM50_atlas_04.nii.gz',
+                        'VCST-R': 'PAM50_atlas_23.nii.gz',
+                        'VCST-L': 'PAM50_atlas_22.nii.gz'}
+
+# If True, only the template files used by the quantification (vertebral levels and tracts of dct_tracts) are warped
+# to the native space, instead of the whole PAM50 template and atlas
+config["warp_template_selective"] = False
+
+# If True, the headers of the segmentation and labels are compared with the image header before the registration,
+# and replaced by the image header if they differ
+config["header_preflight"] = False
+
+# If True, 2_quantify.py also saves a per-lesion table (spinalcord_lesions.npz in path_results)
+config["lesion_table"] = False
+
+# Computation of the cord CSA per slice: 'sct' (sct_process_segmentation) or 'python' (in-process, see csa.py)
+config["csa_engine"] = 'sct'
+
+# Number of parallel workers (1: serial run)
+config["n_jobs"] = 1
+
+# If True, 3_generate_LFM.py generates all the missing subgroup LFMs in a single pass over the subjects
+config["lfm_single_pass"] = False
+
+# If True, 3_generate_LFM.py packs the masks of all the subjects in a subject x voxel matrix (rebuilt when a mask
+# changes), used to compute the subgroup LFMs without reading the masks again (see common/lfm_matrix.py)
+config["lfm_matrix"] = False
+
+# If True, 3_generate_LFM.py saves the sums of each subgroup, and only adds / subtracts the masks of the added, removed
+# or modified subjects on the next runs (see common/lfm_incremental.py)
+config["lfm_incremental"] = False
+
+# If True, 3_generate_LFM.py sums the masks of each subgroup by shards of subjects, in n_jobs worker processes
+config["lfm_sharded"] = False
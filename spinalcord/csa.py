@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Goal: Compute the cord cross-sectional area (CSA) per slice in-process, instead of running sct_process_segmentation.
+#
+# For each axial slice (RPI), the area of the segmentation is corrected by the angle between the cord centerline and
+# the z axis: CSA = area * cos(angle). The centerline is a polynomial fit (in mm) of the center of mass of each slice.
+# The table is saved with the same columns as sct_process_segmentation ('Slice (z)', 'CSA (mm^2)', 'Angle (deg)'),
+# as CSA_FNAME (next to the csa_per_slice.pickle of sct_process_segmentation, so that both engines can be compared).
+#
+# Created: 2026-10-18
+
+import os
+import numpy as np
+import pandas as pd
+
+CENTERLINE_DEGREE = 5  # degree of the polynomial fit of the centerline
+CSA_FNAME = 'csa_per_slice_python.pickle'
+
+
+def csa_per_slice(sc_data, res_x, res_y, res_z):
+    '''
+    CSA of the segmentation sc_data (RPI) on each slice containing the cord.
+
+    Return (z_arr, csa_arr [mm2], angle_arr [deg]).
+    '''
+    sc_data = sc_data.astype(np.float64)
+    area_arr = np.sum(sc_data, axis=(0, 1))
+    z_arr = np.flatnonzero(area_arr > 0)
+    if not len(z_arr):
+        return z_arr, np.zeros(0), np.zeros(0)
+
+    # center of mass of each slice, in mm
+    x_arr = np.arange(sc_data.shape[0]) * res_x
+    y_arr = np.arange(sc_data.shape[1]) * res_y
+    x_com_arr = np.dot(x_arr, np.sum(sc_data[:, :, z_arr], axis=1)) / area_arr[z_arr]
+    y_com_arr = np.dot(y_arr, np.sum(sc_data[:, :, z_arr], axis=0)) / area_arr[z_arr]
+
+    # derivatives of the centerline along z
+    deg = min(CENTERLINE_DEGREE, len(z_arr) - 1)
+    if deg > 0:
+        z_mm_arr = z_arr * res_z
+        dx_arr = np.polyval(np.polyder(np.polyfit(z_mm_arr, x_com_arr, deg)), z_mm_arr)
+        dy_arr = np.polyval(np.polyder(np.polyfit(z_mm_arr, y_com_arr, deg)), z_mm_arr)
+    else:
+        dx_arr, dy_arr = np.zeros(1), np.zeros(1)
+
+    cos_arr = 1.0 / np.sqrt(1.0 + dx_arr ** 2 + dy_arr ** 2)
+    csa_arr = area_arr[z_arr] * res_x * res_y * cos_arr
+    return z_arr, csa_arr, np.degrees(np.arccos(cos_arr))
+
+
+def compute_csa(sc_data, pixdim, ofolder):
+    '''
+    Compute the CSA per slice of the segmentation sc_data (RPI, already loaded by the caller) of voxel size
+    pixdim (res_x, res_y, res_z in mm), saved as ofolder/CSA_FNAME.
+    '''
+    res_x, res_y, res_z = pixdim
+    z_arr, csa_arr, angle_arr = csa_per_slice(sc_data, res_x, res_y, res_z)
+
+    if not os.path.isdir(ofolder):
+        os.makedirs(ofolder)
+    csa_pd = pd.DataFrame({'Slice (z)': z_arr, 'CSA (mm^2)': csa_arr, 'Angle (deg)': angle_arr},
+                            columns=['Slice (z)', 'CSA (mm^2)', 'Angle (deg)'])
+    csa_pd.to_pickle(os.path.join(ofolder, CSA_FNAME))
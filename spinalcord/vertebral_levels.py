@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Goal: Index the vertebral levels of PAM50_levels.nii.gz (warped to the native space) in a single pass.
+#
+# The index is cached as a json file next to the levels file (recomputed if the levels file is more recent):
+# - values: sorted voxel values of the levels file (including 0)
+# - z_lst: {level: sorted list of the slices (z, RPI) containing this level}
+# - z_range: {level: [z_min, z_max]}
+# - z_dominant: {z: level with the most voxels in this slice}
+#
+# Created: 2026-10-18
+
+import os
+import json
+import numpy as np
+
+from spinalcordtoolbox.image import Image
+
+INDEX_FNAME = 'PAM50_levels_index.json'
+
+
+def compute_level_index(levels_path):
+    '''Level index (see above) of levels_path, computed in a single pass over the volume.'''
+    levels_im = Image(levels_path).change_orientation('RPI')
+    levels_data = np.rint(levels_im.data).astype(np.int64)
+    del levels_im
+
+    nz = levels_data.shape[2]
+    value_lst = sorted([int(v) for v in np.unique(levels_data)])
+    idx_lst = np.nonzero(levels_data)
+    pair_arr, count_arr = np.unique(levels_data[idx_lst] * nz + idx_lst[2], return_counts=True)  # (level, z) pairs
+    lvl_arr, z_arr = pair_arr // nz, pair_arr % nz
+
+    index = {'values': value_lst, 'z_lst': {}, 'z_range': {}, 'z_dominant': {}}
+    for lvl in np.unique(lvl_arr):
+        z_lvl_lst = sorted([int(z) for z in z_arr[lvl_arr == lvl]])
+        index['z_lst'][int(lvl)] = z_lvl_lst
+        index['z_range'][int(lvl)] = [z_lvl_lst[0], z_lvl_lst[-1]]
+    for z in np.unique(z_arr):
+        index['z_dominant'][int(z)] = int(lvl_arr[z_arr == z][np.argmax(count_arr[z_arr == z])])
+    return index
+
+
+def level_index(levels_path):
+    '''Level index of levels_path, read from its cache if it is up to date, computed and cached otherwise.'''
+    index_path = os.path.join(os.path.dirname(levels_path), INDEX_FNAME)
+    if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(levels_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        # json keys are str
+        for key in ['z_lst', 'z_range', 'z_dominant']:
+            index[key] = dict((int(k), v) for k, v in index[key].items())
+        return index
+
+    index = compute_level_index(levels_path)
+    index_path_tmp = index_path + '.tmp'
+    with open(index_path_tmp, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+    os.rename(index_path_tmp, index_path)  # atomic: an interrupted run does not leave a truncated index
+    return index